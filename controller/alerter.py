@@ -56,7 +56,7 @@ class Alerter(Controller):
         # scheduler is needed for scheduling rules
         self.scheduler = Scheduler(self)
         # regular expression used to parse variables
-        self.variable_regexp = '^(DISTANCE|TIMESTAMP|ELAPSED|COUNT|SCHEDULE|POSITION_LABEL|POSITION_TEXT|)\s*(-\d+)?(,-\d+)?\s*(\S+)$'
+        self.variable_regexp = '^(DISTANCE|TIMESTAMP|ELAPSED|COUNT|AVG|MIN|MAX|SUM|SCHEDULE_NEXT|SCHEDULE|POSITION_LABEL|POSITION_TEXT|)\s*(-\d+)?(,-\d+)?\s*(\S+)$'
         # require module configuration before starting up
         self.config_schema = 2
         self.rules_config_schema = 2
@@ -4,23 +4,36 @@
 # OS: python-redis
 # Python: 
 ## CONFIGURATION:
-# required: hostname, port, database
-# optional: 
+# required: type, hostname (not for sqlite), port (not for sqlite), database
+# optional: username, password, layout, workers, replicas, read_your_writes, rollup_interval, cache_size, export_directory
 ## COMMUNICATION:
 # INBOUND: 
 # - SAVE: save a new measure for a sensor
+# - SAVE_BATCH: save multiple measures of one or more sensors at once
 # - SAVE_ALERT: save a new alert
 # - CALC_HOUR_STATS: calculate hourly aggregated stats
-# - CALC_DAY_STATS: calculate daily aggregated stats
+# - CALC_DAY_STATS: calculate daily aggregated stats, rolling up the closed day into the weekly/monthly/yearly stats
+# - FLUSH_ROLLUPS: recalculate the hours left dirty by a sensor (requested by the module itself for the sensors no longer saving values)
+# - COMPACT: seal the closed days of a sensor into compressed blocks (requested every hour by the module itself)
 # - PURGE_SENSOR: delete old measures from db
+# - PURGE_SENSORS: apply the retention policies to all the sensors at once, in background
 # - PURGE_ALERT: purge old alerts from db
 # - DELETE_SENSOR: delete from the db the data associated to a sensor
-# - GET: return measures from the db
+# - EXPORT: export the history of a sensor (raw and aggregated data) into a compressed file of the export directory, in background
+# - IMPORT: import into a sensor the history exported into a file of the export directory, in background
+# - STATS: return the cached statistics of the database, optionally filtered by key prefix, and of the result cache
+# - GET: return measures from the db (reading aggregated data if a resolution or max_points is requested, one page at a time if page_size is requested)
+# - GET_NEXT: return the next page of measures of a paged GET, given its cursor
+# - GET_MULTI: run multiple GET queries (of any of the variants below) on one or more sensors at once, returning their results keyed by query id
 # - GET_ELAPSED: return the elapsed time since the measure was taken
 # - GET_TIMESTAMP: return the timestamp of the measure
 # - GET_DISTANCE: return the distance from the measure
 # - GET_POSITION: return the name of the position
+# - GET_DISTANCES: return the distance over time of a position sensor from a point (the house by default)
+# - GET_WITHIN/GET_NEAREST: return the sensors whose latest position is within a radius from a point (a sensor or the house by default) or the nearest ones
+# - GET_SCHEDULE/GET_SCHEDULE_NEXT: return the text of the calendar's event currently running/of the next event
 # - GET_COUNT: return the number of measures of a given timeframe
+# - GET_AVG/GET_MIN/GET_MAX/GET_SUM: return the average/minimum/maximum/sum of the measures of a given timeframe
 # OUTBOUND: 
 # - */* SAVED: notify a new measure has been saved
 
@@ -28,11 +41,17 @@ import time
 import re
 import os
 import json
+import base64
+import copy
 import datetime
-from math import radians, cos, sin, asin, sqrt
+import calendar
+import threading
+import Queue
+import contextlib
 
 from sdk.python.module.controller import Controller
 from sdk.python.module.helpers.message import Message
+from sdk.python.module.helpers.scheduler import Scheduler
 from sdk.python.utils.datetimeutils import DateTimeUtils
 import sdk.python.utils.exceptions as exception
 
@@ -41,6 +60,15 @@ import sdk.python.utils.strings
 
 from db_redis import Db_redis
 from db_mongo import Db_mongo
+from db_mongo_bucket import Db_mongo_bucket
+from db_sqlite import Db_sqlite
+from db_rollup import Db_rollup
+from db_blocks import Db_blocks
+from db_cache import Db_cache
+from db_schedule import Db_schedule
+import db_export
+import db_downsample
+import db_geo
 
 class Db(Controller):
     # What to do when initializing    
@@ -51,6 +79,13 @@ class Db(Controller):
         self.alerts_key = self.root_key+"/alerts"
         self.logs_key = self.root_key+"/logs"
         self.version_key = self.root_key+"/version"
+        # geospatial indexes of the sensors holding positions: the track of each sensor and the latest position of all of them
+        self.geo_key = self.root_key+"/geo"
+        self.positions_key = self.geo_key+"/positions"
+        # aggregated statistics stored for each sensor
+        self.statistics = ["min", "avg", "max", "rate", "sum", "count", "count_unique"]
+        # periods the statistics are aggregated by
+        self.group_by = ["hour", "day", "week", "month", "year"]
         # module's configuration
         self.config = {}
         # date/time helper
@@ -58,6 +93,38 @@ class Db(Controller):
         self.house = None
         # database driver
         self.db = None
+        # running accumulators of the hourly/daily aggregated statistics
+        self.rollups = Db_rollup(self)
+        # when a rollup interval is configured, map (sensor_id, hour start) of the hours to recalculate with their calculations and sensor_id with the time of its last recalculation
+        self.dirty = {}
+        self.flushed = {}
+        # sensors whose recalculation has been requested to their worker
+        self.sweeping = set()
+        self.dirty_lock = threading.Lock()
+        # raw history of the sensors sealed into compressed blocks
+        self.blocks = Db_blocks(self)
+        self.compaction_pause = 0.2
+        # results of the timeframe queries, invalidated when their key changes
+        self.cache = Db_cache(self)
+        # parsed events of the calendar sensors
+        self.schedules = Db_schedule(self)
+        # latest value index, map a key with (timestamp, raw database entry) of its latest value (None if the key is empty)
+        self.latest = {}
+        # cached database statistics, map a key with its statistics and keep the statistics of the whole database
+        self.stats_keys = {}
+        self.stats_database = {}
+        self.stats_updated = None
+        self.stats_page_size = 500
+        # scheduler is needed for running background jobs
+        self.scheduler = Scheduler(self)
+        self.jobs_scheduled = False
+        # number of keys purged at once by the retention job and pause in seconds between each chunk
+        self.retention_chunk = 200
+        self.retention_pause = 0.2
+        self.retention_running = False
+        # when workers are configured, map each worker thread with its queue of requests
+        self.workers = []
+        self.queues = []
         # configuration override
         self.hostname = os.getenv("EGEOFFREY_DATABASE_HOSTNAME", None)
         self.port = os.getenv("EGEOFFREY_DATABASE_PORT", None)
@@ -69,104 +136,182 @@ class Db(Controller):
         self.add_configuration_listener(self.fullname, "+", True)
         self.add_configuration_listener("house", 1, True)
 
-    # calculate derived aggregations such as min, max and avg value
+    # calculate derived aggregations such as min, max and avg value by reading the entire period from the database
     def calculate(self, sensor_id, calculations, group_by, start, end):
-        # map for each statistics the key we need to be based upon
+        # map for each statistics the hourly statistics daily statistics are based upon
         keys_to_read = {
-            "hour": {
-                "avg": "",
-                "min_max": "",
-                "rate": "",
-                "sum": "",
-                "count": "",
-                "count_unique": ""
-            },
-            "day": {
-                "avg": "/hour/avg",
-                "min_max": "/hour/avg",
-                "rate": "/hour/avg",
-                "sum": "/hour/sum",
-                "count": "/hour/count",
-                "count_unique": "/hour/count_unique"
-            }
+            "avg": "avg",
+            "min_max": "avg",
+            "rate": "avg",
+            "sum": "sum",
+            "count": "count",
+            "count_unique": "count_unique"
         }
-        # keep track of keys already read
-        cache = {}
-        # set the database keys to read from and write into
+        # set the database keys to read from
         key = self.sensors_key+"/"+sensor_id
-        # set key to write and perform sanity checks
+        # perform sanity checks
         if group_by == "hour":
-            # write hourly summary
-            key_to_write = key+"/hour" 
             # ensure time boundaries are correct
             if start == 0 or end == 0 or end-start > 60*60:
-                self.log_warning("Unable to calculate "+group_by+" statistics for "+sensor_id+": invalid time boundaries ("+start+"-"+end+")")
-                return
-        elif group_by == "day":
-            # write daily summary
-            key_to_write = key+"/day" 
-            # ensure time boundaries are correct
-            if start == 0 or end == 0 or end-start > 24*60*60:
-                self.log_warning("Unable to calculate "+group_by+" statistics for "+sensor_id+": invalid time boundaries ("+start+"-"+end+")")
-                return
-        # calculate the derived values
+                self.log_warning("Unable to calculate "+group_by+" statistics for "+sensor_id+": invalid time boundaries ("+str(start)+"-"+str(end)+")")
+                return None
+            # retrieve from the database the data based on the given timeframe and rebuild the accumulator of the hour
+            with self.primary_reads():
+                data = self.blocks.get_by_timeframe(key, start, end, withscores=True)
+            stats = self.rollups.reset_hour(sensor_id, start, data)
+        elif group_by in ["day", "week", "month", "year"]:
+            # ensure time boundaries are correct (allowing for daylight saving in longer periods)
+            max_length = {"day": 24*60*60, "week": 7*24*60*60+3600, "month": 31*24*60*60+3600, "year": 366*24*60*60+3600}
+            if start == 0 or end == 0 or end-start > max_length[group_by]:
+                self.log_warning("Unable to calculate "+group_by+" statistics for "+sensor_id+": invalid time boundaries ("+str(start)+"-"+str(end)+")")
+                return None
+            # retrieve from the database the hourly (or daily for longer periods) statistics and rebuild the period out of them
+            sub_period = "hour" if group_by == "day" else "day"
+            entries = {}
+            with self.primary_reads():
+                for statistics in set([keys_to_read[calculation] for calculation in calculations if calculation in keys_to_read]):
+                    for timestamp, value in self.db.get_by_timeframe(key+"/"+sub_period+"/"+statistics, start, end, withscores=True):
+                        if timestamp not in entries: entries[timestamp] = {"avg": None, "sum": None, "count": None, "count_unique": None}
+                        entries[timestamp][statistics] = value
+            stats = self.rollups.reset_period(sensor_id, group_by, start, entries)
+        else: return None
+        self.save_rollup(sensor_id, calculations, group_by, start, end, stats)
+        return stats
+
+    # update the hourly/daily aggregations with a new value, recalculating them from the database only when the value cannot be accumulated
+    def update_rollups(self, sensor_id, calculations, timestamp, value, incremental):
+        # update the hour the value belongs to
+        hour_start = self.date.hour_start(timestamp)
+        hour_end = self.date.hour_end(timestamp)
+        stats = self.rollups.add_value(sensor_id, hour_start, timestamp, value) if incremental else None
+        if stats is None: stats = self.calculate(sensor_id, calculations, "hour", hour_start, hour_end)
+        else: self.save_rollup(sensor_id, calculations, "hour", hour_start, hour_end, stats)
+        if stats is None: return
+        self.update_day(sensor_id, calculations, hour_start, stats)
+
+    # update the day with the new statistics of the given hour
+    def update_day(self, sensor_id, calculations, hour_start, stats):
+        day_start = self.date.day_start(hour_start)
+        day_end = self.date.day_end(hour_start)
+        stats = self.rollups.add_entry(sensor_id, "day", day_start, hour_start, stats)
+        if stats is None: self.calculate(sensor_id, calculations, "day", day_start, day_end)
+        else: self.save_rollup(sensor_id, calculations, "day", day_start, day_end, stats)
+
+    # mark the hour of the given timestamp as to be recalculated, recalculating the sensor right away if not done within the rollup interval
+    def mark_dirty(self, sensor_id, calculations, timestamp):
+        with self.dirty_lock:
+            self.dirty[(sensor_id, self.date.hour_start(timestamp))] = calculations
+        self.flush_rollups(sensor_id, True)
+
+    # recalculate the dirty hours (and their days) of the given sensor or of all the sensors. If due is set, only of the sensors not recalculated within the rollup interval
+    def flush_rollups(self, sensor_id=None, due=False):
+        interval = self.config["rollup_interval"] if "rollup_interval" in self.config else 0
+        with self.dirty_lock:
+            entries = []
+            for (item_id, hour_start), calculations in self.dirty.iteritems():
+                if sensor_id is not None and item_id != sensor_id: continue
+                if due and time.time() - self.flushed.get(item_id, 0) < interval: continue
+                entries.append((item_id, hour_start, calculations))
+            for item_id, hour_start, calculations in entries:
+                del self.dirty[(item_id, hour_start)]
+                self.flushed[item_id] = time.time()
+        for item_id, hour_start, calculations in sorted(entries):
+            stats = self.calculate(item_id, calculations, "hour", hour_start, self.date.hour_end(hour_start))
+            if stats is not None: self.update_day(item_id, calculations, hour_start, stats)
+
+    # request the recalculation of the sensors left dirty and not recalculated within the rollup interval. Each sensor is recalculated by the worker in charge of it, in order with its other requests
+    def sweep_rollups(self):
+        if self.db is None or not self.db.connected: return
+        interval = self.config["rollup_interval"] if "rollup_interval" in self.config else 0
+        with self.dirty_lock:
+            sensors = set([item_id for item_id, hour_start in self.dirty.keys() if item_id not in self.sweeping and time.time() - self.flushed.get(item_id, 0) >= interval])
+            self.sweeping.update(sensors)
+        for sensor_id in sorted(sensors):
+            message = Message(self)
+            message.recipient = self.fullname
+            message.command = "FLUSH_ROLLUPS"
+            message.args = sensor_id
+            self.send(message)
+
+    # drop the pending recalculations of the given sensor
+    def discard_rollups(self, sensor_id):
+        with self.dirty_lock:
+            for item_id, hour_start in self.dirty.keys():
+                if item_id == sensor_id: del self.dirty[(item_id, hour_start)]
+            self.flushed.pop(sensor_id, None)
+
+    # roll up the statistics of a closed day into the week, month and year it belongs to, recalculating them from the database only when needed
+    def update_periods(self, sensor_id, calculations, day_start, stats):
+        for group_by in ["week", "month", "year"]:
+            start, end = self.period(group_by, day_start)
+            period_stats = self.rollups.add_entry(sensor_id, group_by, start, day_start, stats)
+            if period_stats is None: self.calculate(sensor_id, calculations, group_by, start, end)
+            else: self.save_rollup(sensor_id, calculations, group_by, start, end, period_stats)
+
+    # return the start and end timestamps of the week, month or year the given timestamp belongs to
+    def period(self, group_by, timestamp):
+        start = self.date.day_start(timestamp)
+        # work on the local date, inferring the timezone offset from the start of the day
+        offset = -start % 86400
+        if offset > 14*3600: offset = offset - 86400
+        date = datetime.datetime.utcfromtimestamp(start+offset).date()
+        if group_by == "week":
+            first = date - datetime.timedelta(days=date.weekday())
+            following = first + datetime.timedelta(days=7)
+        elif group_by == "month":
+            first = date.replace(day=1)
+            following = (first + datetime.timedelta(days=32)).replace(day=1)
+        else:
+            first = date.replace(month=1, day=1)
+            following = first.replace(year=first.year+1)
+        # back to the start of the local days, whose offset may differ because of daylight saving
+        first = self.date.day_start(calendar.timegm(first.timetuple())-offset+12*3600)
+        following = self.date.day_start(calendar.timegm(following.timetuple())-offset+12*3600)
+        return first, following-1
+
+    # store the requested aggregated statistics of a period and notify about them
+    def save_rollup(self, sensor_id, calculations, group_by, start, end, stats):
+        key_to_write = self.sensors_key+"/"+sensor_id+"/"+group_by
         timestamp = start
         min = avg = max = rate = sum = count = count_unique = "-"
         for statistics in ["avg", "min_max", "rate", "sum", "count", "count_unique"]:
             # if we don't need to calculate this statistics, go to the next
             if statistics not in calculations: 
                 continue
-            # set the key to read (can be different depending on the statistics)
-            key_to_read = key+keys_to_read[group_by][statistics]
-            # check if we retrieved already this key
-            if key_to_read in cache:
-                data = cache[key_to_read]
-            # otherwise get it from the database
-            else:
-                # retrieve from the database the data based on the given timeframe
-                data = self.db.get_by_timeframe(key_to_read, start, end, withscores=True)
-                # store it in cache
-                cache[key_to_read] = data
-            # split between values and timestamps
-            values = []
-            timestamps = []
-            for i in range(0,len(data)):
-                timestamps.append(data[i][0])
-                values.append(data[i][1])
             if statistics == "avg":
-                # calculate avg
-                avg = sdk.python.utils.numbers.avg(values)
+                avg = stats["avg"]
                 self.db.delete_by_timeframe(key_to_write+"/avg", start, end)
                 self.db.set_series(key_to_write+"/avg", avg, timestamp)
+                self.invalidate(key_to_write+"/avg")
             elif statistics == "min_max":
-                # calculate min
-                min = sdk.python.utils.numbers.min(values)
+                min = stats["min"]
                 self.db.delete_by_timeframe(key_to_write+"/min", start, end)
                 self.db.set_series(key_to_write+"/min", min, timestamp)
-                # calculate max
-                max = sdk.python.utils.numbers.max(values)
+                self.invalidate(key_to_write+"/min")
+                max = stats["max"]
                 self.db.delete_by_timeframe(key_to_write+"/max", start, end)
                 self.db.set_series(key_to_write+"/max", max, timestamp)
+                self.invalidate(key_to_write+"/max")
             elif statistics == "rate":
-                # calculate the rate of change
-                rate = sdk.python.utils.numbers.velocity(timestamps, values)
+                rate = stats["rate"]
                 self.db.delete_by_timeframe(key_to_write+"/rate", start, end)
                 self.db.set_series(key_to_write+"/rate", rate, timestamp)
+                self.invalidate(key_to_write+"/rate")
             elif statistics == "sum":
-                    # calculate the sum
-                    sum = sdk.python.utils.numbers.sum(values)
-                    self.db.delete_by_timeframe(key_to_write+"/sum", start, end)
-                    self.db.set_series(key_to_write+"/sum", sum, timestamp)
+                sum = stats["sum"]
+                self.db.delete_by_timeframe(key_to_write+"/sum", start, end)
+                self.db.set_series(key_to_write+"/sum", sum, timestamp)
+                self.invalidate(key_to_write+"/sum")
             elif statistics == "count":
-                    # count the values
-                    count = sdk.python.utils.numbers.count(values)
-                    self.db.delete_by_timeframe(key_to_write+"/count", start, end)
-                    self.db.set_series(key_to_write+"/count", count, timestamp)
+                count = stats["count"]
+                self.db.delete_by_timeframe(key_to_write+"/count", start, end)
+                self.db.set_series(key_to_write+"/count", count, timestamp)
+                self.invalidate(key_to_write+"/count")
             elif statistics == "count_unique":
-                    # count the unique values
-                    count_unique = sdk.python.utils.numbers.count_unique(values)
-                    self.db.delete_by_timeframe(key_to_write+"/count_unique", start, end)
-                    self.db.set_series(key_to_write+"/count_unique", count_unique, timestamp)
+                count_unique = stats["count_unique"]
+                self.db.delete_by_timeframe(key_to_write+"/count_unique", start, end)
+                self.db.set_series(key_to_write+"/count_unique", count_unique, timestamp)
+                self.invalidate(key_to_write+"/count_unique")
         # broadcast value updated message
         message = Message(self)
         message.recipient = "*/*"
@@ -178,11 +323,577 @@ class Db(Controller):
         self.send(message)
         self.log_debug("["+sensor_id+"] ("+self.date.timestamp2date(timestamp)+") updating summary of the "+group_by+" (min,avg,max,rate,sum,count,count_unique): ("+str(min)+","+str(avg)+","+str(max)+","+str(rate)+","+str(sum)+","+str(count)+","+str(count_unique)+")")
 
+    # return (timestamp, raw database entry) of the latest value of the given key, populating the index from the database if needed
+    def get_latest(self, key):
+        if key not in self.latest: 
+            # the index is kept until the key changes, it cannot be built out of a replica lagging behind
+            with self.primary_reads():
+                self.latest[key] = self.db.get_latest(key)
+        return self.latest[key]
+
+    # read from the primary database only within the block (for the internal reads of data about to be modified or indexed), the replicas are for the queries of the clients
+    @contextlib.contextmanager
+    def primary_reads(self):
+        replicas = getattr(self.db, "replicas", None)
+        if replicas is None:
+            yield
+            return
+        with replicas.primary_only():
+            yield
+
+    # keep the latest value index coherent with a value just saved into the given key
+    def index_latest(self, key, value, timestamp):
+        self.cache.bump(key)
+        self.schedules.forget(key)
+        if key not in self.latest: return
+        if self.latest[key] is None or timestamp >= self.latest[key][0]:
+            self.latest[key] = (timestamp, self.db.make_entry(value, timestamp))
+
+    # remove the given key from the latest value index after other changes to its data
+    def invalidate(self, key):
+        if key in self.latest: del self.latest[key]
+        self.cache.bump(key)
+        self.blocks.forget(key)
+        self.schedules.forget(key)
+
+    # get a range of values from the db based on the timestamp, serving repeated queries from the result cache
+    def get_by_timeframe(self, key, start=None, end=None, withscores=True, milliseconds=False, format_date=False, formatter=None, max_items=None, max_points=None, downsample="avg"):
+        # a timeframe relative to now cannot be cached
+        if not isinstance(start, (int, long, float)) or not isinstance(end, (int, long, float)):
+            return self.blocks.get_by_timeframe(key, start, end, withscores, milliseconds, format_date, formatter, max_items, max_points, downsample)
+        query = (key, start, end, withscores, milliseconds, format_date, formatter, max_items, max_points, downsample)
+        data = self.cache.get(query)
+        if data is not None: return data
+        generation = self.cache.generation(key)
+        data = self.blocks.get_by_timeframe(key, start, end, withscores, milliseconds, format_date, formatter, max_items, max_points, downsample)
+        self.cache.set(query, generation, data)
+        return data
+
+    # get a range of values from the db based on the position, serving the latest value from the index
+    def get_by_position(self, key, start=-1, end=-1, withscores=True, milliseconds=False, format_date=False, formatter=None, max_items=None, max_points=None, downsample="avg"):
+        if start != -1 or end != -1: 
+            return self.blocks.get_by_position(key, start, end, withscores, milliseconds, format_date, formatter, max_items, max_points, downsample)
+        latest = self.get_latest(key)
+        if latest is None: return []
+        return self.db.normalize_dataset([latest[1]], withscores, milliseconds, format_date, formatter)
+
+    # return a page of the entries of a timeframe query and the opaque cursor to retrieve the next page (None if there are no more entries). None if the page size is not valid
+    def get_page(self, query):
+        if not isinstance(query["page_size"], (int, long)) or query["page_size"] < 1:
+            self.log_warning("invalid page size requested: "+str(query["page_size"]))
+            return None
+        start = query["start"] if "start" in query else self.date.now()-24*3600
+        end = query["end"] if "end" in query else self.date.now()
+        formatter = query["formatter"] if "formatter" in query else None
+        # read one more entry to know if there is a next page
+        entries = self.blocks.get_page(query["key"], start, end, query["page_size"]+1, formatter)
+        cursor = None
+        if len(entries) > query["page_size"]:
+            entries = entries[:query["page_size"]]
+            # the next page starts just after the last timestamp returned, since each timestamp is unique within a key
+            next_query = dict([(option, query[option]) for option in ["key", "page_size", "withscores", "milliseconds", "format_date", "formatter"] if option in query])
+            next_query["start"] = entries[-1][0]+1
+            next_query["end"] = end
+            cursor = base64.urlsafe_b64encode(json.dumps(next_query))
+        data = db_downsample.format_points(entries, "withscores" in query and query["withscores"], "milliseconds" in query and query["milliseconds"], "format_date" in query and query["format_date"], self.date)
+        return data, cursor
+
+    # build the query of a GET request on the given item out of its payload, selecting the area of the database and calculating start and end of the requested timeframe
+    def prepare_query(self, item_id, query):
+        # select which area of the database to query (default to sensors)
+        scope = self.sensors_key
+        if "scope" in query:
+            if query["scope"] == "logs": scope = self.logs_key
+            if query["scope"] == "alerts": scope = self.alerts_key
+            del query["scope"]
+        query["key"] = scope+"/"+item_id
+        # handle timeframe requests, calculate start and end
+        if "timeframe" in query:
+            if query["timeframe"] == "today":
+                query["start"] = self.date.day_start(self.date.now())
+                query["end"] = self.date.day_end(self.date.now())
+                query["withscores"] = False
+            elif query["timeframe"] == "yesterday":
+                query["start"] = self.date.day_start(self.date.yesterday())
+                query["end"] = self.date.day_end(self.date.yesterday())
+                query["withscores"] = False
+            elif query["timeframe"].startswith("last_") or query["timeframe"].startswith("next_"):
+                # expect <last|next>_xx_<hours|days>
+                action, value, unit = query["timeframe"].split("_")
+                # convert the provided value in seconds
+                value = int(value)*3600 if unit == "hours" else int(value)*86400
+                # set start/end based on the requested action
+                query["start"] = self.date.now() - int(value) if action == "last" else self.date.now()
+                query["end"] = self.date.now() if action == "last" else self.date.now() + int(value)
+                query["withscores"] = True
+                query["milliseconds"] = True
+            del query["timeframe"]
+        return query
+
+    # return True if start and/or end of the given query are timestamps, False if they are positions
+    def is_timeframe(self, query):
+        if "start" in query and query["start"] > 1000000000: return True
+        if "end" in query and query["end"] > 1000000000: return True
+        return False
+
+    # run the query of a GET request and post-process its result according to the command. Return None if the result cannot be post-processed
+    def run_query(self, command, query):
+        # 1) if start and/or end are timestamps, use get_by_timeframe, otherwise use get_by_position
+        function = self.get_by_timeframe if self.is_timeframe(query) else self.get_by_position
+        # 2) set if we need timestamps together with the values
+        if command == "GET_ELAPSED" or command == "GET_TIMESTAMP": 
+            query["withscores"] = True
+        if "withscores" not in query: query["withscores"] = False
+        # paging applies to plain timeframe queries only, the others are returned in full
+        if "page_size" in query: del query["page_size"]
+        # 3) if range is requested, start asking for min first
+        is_range = False
+        if query["key"].endswith("/range"):
+            is_range = True
+            query["key"] = re.sub("/range$", "/min", query["key"])
+        # 4) call the function mapping parameters with the query
+        if command in ["GET_COUNT", "GET_AVG", "GET_MIN", "GET_MAX", "GET_SUM"]:
+            # aggregations are calculated by the database without retrieving the values
+            by_position = function == self.get_by_position
+            start = query["start"] if "start" in query else (-1 if by_position else None)
+            end = query["end"] if "end" in query else (-1 if by_position else None)
+            value = self.blocks.aggregate(query["key"], command.replace("GET_", "").lower(), start, end, by_position)
+            data = [value] if value is not None else []
+            is_range = False
+        elif command == "GET" and function == self.get_by_timeframe and query["key"].startswith(self.sensors_key+"/") and not is_range and ("resolution" in query or "max_points" in query):
+            # a resolution is requested, let the planner pick the raw and/or aggregated data to read
+            data = []
+            for subquery in self.plan(query):
+                data = data + function(**subquery)
+            if "max_items" in query and query["max_items"] is not None and len(data) > query["max_items"]: data = data[-query["max_items"]:]
+        else:
+            if "resolution" in query: del query["resolution"]
+            data = function(**query)
+        # 5) if a range is requested, ask for the max and combine the results
+        if is_range and len(data) > 0:
+            query["key"] = re.sub("/min$", "/max", query["key"])
+            query["withscores"] = False
+            data_max = function(**query)
+            for i, item in enumerate(data):
+                # ensure data_max has a correspondent value
+                if i < len(data_max):
+                    if (isinstance(item,list)): data[i].append(data_max[i])
+                    else: data.append(data_max[i])
+        # 6) postprocess if needed
+        return self.postprocess(command, data, query["key"])
+
+    # post-process the result of a GET request on the given key according to the command. Return None if the result is not valid for the command
+    def postprocess(self, command, data, key=None):
+        # elapsed since the measure was taken is requested, calculate the time difference in seconds
+        if command == "GET_ELAPSED":
+            if len(data) == 0: 
+                data = []
+            else: 
+                time_diff = self.date.now() - data[0][0]
+                data = [time_diff]
+        # the timestamp of the measure is requested, return it
+        elif command == "GET_TIMESTAMP":
+            if len(data) == 0: data = []
+            else: data = [data[0][0]]
+        # the distance of the measure from this house is requested
+        elif command == "GET_DISTANCE":
+            if len(data) == 0: return None
+            # get position (only the first one if multiple are provided)
+            try:
+                position = json.loads(data[0])
+            except Exception,e: 
+                self.log_warning("unable to get the distance from an invalid position: "+str(data)+" - "+exception.get(e))
+                return None
+            if "longitude" not in position or "latitude" not in position: 
+                self.log_warning("invalid position provided: "+str(position))
+                return None
+            distance = db_geo.distance(position["longitude"], position["latitude"], self.house["longitude"], self.house["latitude"])
+            if self.house["units"] == "imperial": distance = distance/db_geo.MILE
+            data = [int(distance)]
+        # the text associated to the position is requested
+        elif command == "GET_POSITION_TEXT":
+            if len(data) == 0: return None
+            try:
+                position = json.loads(data[0])
+            except Exception,e: 
+                self.log_warning("unable to get the text from an invalid position: "+str(data)+" - "+exception.get(e))
+                return None
+            if "text" not in position: 
+                self.log_warning("text missing: "+str(position))
+                return None
+            data = [position["text"]]
+        # the label associated to the position is requested
+        elif command == "GET_POSITION_LABEL":
+            if len(data) == 0: return None
+            try:
+                position = json.loads(data[0])
+            except Exception,e: 
+                self.log_warning("unable to get the label from an invalid position: "+str(data)+" - "+exception.get(e))
+                return None
+            if "label" not in position: 
+                self.log_warning("label missing: "+str(position))
+                return None
+            data = [position["label"]]
+        # the text of the calendar's event currently running or of the next one is requested
+        elif command == "GET_SCHEDULE" or command == "GET_SCHEDULE_NEXT":
+            if len(data) != 1: return None
+            # the calendar is parsed only the first time it is requested after having been saved
+            try:
+                schedule = self.schedules.get(key, data[0])
+            except Exception,e: 
+                self.log_warning("unable to parse calendar's data: "+str(data)+" - "+exception.get(e))
+                return None
+            if schedule is None: return None
+            text = schedule.active(self.date.now()) if command == "GET_SCHEDULE" else schedule.upcoming(self.date.now())
+            data = [text if text is not None else ""]
+        return data
+
+    # keep the geospatial index coherent with the [timestamp, value] rows just saved into the raw data of a sensor, ignoring the values which are not positions
+    def index_positions(self, sensor_id, rows):
+        locations = []
+        for timestamp, value in rows:
+            position = db_geo.parse(value)
+            if position is not None: locations.append((timestamp, position[0], position[1]))
+        if len(locations) == 0: return
+        self.db.geo_add(self.geo_key+"/tracks/"+sensor_id, locations)
+        # the latest position of each sensor is indexed for the geofence queries
+        location = max(locations)
+        latest = self.get_latest(self.sensors_key+"/"+sensor_id)
+        if latest is None or location[0] >= latest[0]: self.db.geo_add(self.positions_key, [(sensor_id, location[1], location[2])])
+
+    # index the positions saved into the raw data of the sensors before the geospatial index was introduced. Run only once
+    def index_history(self):
+        if self.db.exists(self.geo_key+"/version"): return
+        started = time.time()
+        sensors = 0
+        rows = 0
+        try:
+            for key in sorted(self.db.keys(self.sensors_key+"/*")):
+                if not self.blocks.is_candidate(key): continue
+                # position sensors are recognized by their latest value
+                latest = self.db.get_by_position(key, -1, -1, withscores=False)
+                if len(latest) == 0 or db_geo.parse(latest[0]) is None: continue
+                sensor_id = key[len(self.sensors_key+"/"):]
+                chunk = []
+                for row in self.iterate(key, 86400):
+                    chunk.append(row)
+                    if len(chunk) < 1000: continue
+                    self.index_positions(sensor_id, chunk)
+                    rows = rows + len(chunk)
+                    chunk = []
+                self.index_positions(sensor_id, chunk)
+                rows = rows + len(chunk)
+                sensors = sensors + 1
+            self.db.set_value(self.geo_key+"/version", 1)
+            if sensors > 0: self.log_info("indexed "+str(rows)+" positions of "+str(sensors)+" sensors in "+str(round(time.time()-started, 2))+"s")
+        except Exception,e:
+            self.log_error("unable to index the positions saved before the geospatial index: "+exception.get(e))
+
+    # return (longitude, latitude) of the point of a geospatial query: the requested one, the latest position of the given sensor if any, the house otherwise
+    def geo_center(self, sensor_id, query):
+        if "longitude" in query and "latitude" in query: return (float(query["longitude"]), float(query["latitude"]))
+        if sensor_id:
+            latest = self.get_by_position(self.sensors_key+"/"+sensor_id, -1, -1, withscores=False)
+            position = db_geo.parse(latest[0]) if len(latest) > 0 else None
+            if position is not None: return position
+        return (self.house["longitude"], self.house["latitude"])
+
+    # convert a distance in km into the units of the house
+    def to_house_units(self, distance):
+        if self.house["units"] == "imperial": distance = distance/db_geo.MILE
+        return round(distance, 3)
+
+    # run multiple plain queries (with the parameters of get_by_timeframe/get_by_position and by_position telling which one), serving what possible from
+    # the latest value index, the result cache and the sealed history and reading the rest from the database with a single round trip. Return the results in order
+    def get_many(self, queries):
+        results = [None]*len(queries)
+        pending = []
+        for i, query in enumerate(queries):
+            query = query.copy()
+            by_position = query["by_position"]
+            del query["by_position"]
+            key = query["key"]
+            start = query["start"] if "start" in query else (-1 if by_position else self.date.now()-24*3600)
+            end = query["end"] if "end" in query else (-1 if by_position else self.date.now())
+            withscores = query["withscores"] if "withscores" in query else False
+            milliseconds = query["milliseconds"] if "milliseconds" in query else False
+            format_date = query["format_date"] if "format_date" in query else False
+            formatter = query["formatter"] if "formatter" in query else None
+            max_items = query["max_items"] if "max_items" in query else None
+            cached = None
+            if by_position:
+                # the latest value is never sealed
+                if (start == -1 and end == -1 and key in self.latest) or (not (start == -1 and end == -1) and not self.blocks.is_live(key, start, end)):
+                    results[i] = self.get_by_position(**query)
+                    continue
+            else:
+                sealed = self.blocks.get_sealed(key)
+                if not isinstance(start, (int, long, float)) or not isinstance(end, (int, long, float)) or (sealed is not None and start <= sealed[1] and end >= sealed[0]):
+                    results[i] = self.get_by_timeframe(**query)
+                    continue
+                cached = (key, start, end, withscores, milliseconds, format_date, formatter, max_items, None, "avg")
+                results[i] = self.cache.get(cached)
+                if results[i] is not None: continue
+            pending.append((i, (key, start, end, by_position, formatter), (withscores, milliseconds, format_date, max_items), cached, self.cache.generation(key)))
+        if len(pending) == 0: return results
+        entries = self.db.get_many([request for i, request, options, cached, generation in pending])
+        for j, (i, request, options, cached, generation) in enumerate(pending):
+            withscores, milliseconds, format_date, max_items = options
+            data = db_downsample.format_points(entries[j], withscores, milliseconds, format_date, self.date)
+            if max_items is not None and len(data) > max_items: data = data[-max_items:]
+            if cached is not None: self.cache.set(cached, generation, data)
+            results[i] = data
+        return results
+
+    # plan a timeframe query on a sensor by picking the raw, hourly or daily series best matching the requested resolution (in seconds) or number of points, 
+    # stitching them together where finer data has been already purged. Return the list of queries to run
+    def plan(self, query):
+        query = query.copy()
+        resolution = query["resolution"] if "resolution" in query else None
+        if "resolution" in query: del query["resolution"]
+        # aggregated series can be used only for a plain sensor with a bounded timeframe
+        if re.search(r'/(hour|day|week|month|year)/[^/]+$', query["key"]) or "start" not in query or "end" not in query: return [query]
+        if not sdk.python.utils.numbers.is_number(query["start"]) or not sdk.python.utils.numbers.is_number(query["end"]): return [query]
+        start = query["start"]
+        end = query["end"]
+        if resolution is None: resolution = (end-start)/max(query["max_points"], 1)
+        # series available for each sensor with the time covered by each of their entries
+        tiers = [("", 0), ("/hour/avg", 3600), ("/day/avg", 86400), ("/week/avg", 7*86400), ("/month/avg", 30*86400), ("/year/avg", 365*86400)]
+        # start from the coarsest series whose entries are not wider than the requested resolution
+        first_tier = 0
+        for i, (suffix, seconds) in enumerate(tiers):
+            if seconds <= resolution: first_tier = i
+        # walk back in time, filling in with coarser series where the finer ones have no data
+        queries = []
+        until = end
+        for suffix, seconds in tiers[first_tier:]:
+            key = query["key"]+suffix
+            first = self.db.get_by_position(key, 0, 0, withscores=True)
+            # the sealed raw history comes before the live data
+            sealed = self.blocks.get_sealed(key) if suffix == "" else None
+            if sealed is not None: first = [[sealed[0]]]
+            if len(first) == 0: continue
+            since = max(start, first[0][0])
+            if since <= until:
+                subquery = query.copy()
+                subquery["key"] = key
+                subquery["start"] = since
+                subquery["end"] = until
+                if "max_items" in subquery: del subquery["max_items"]
+                # split the points budget across the series
+                if "max_points" in query: subquery["max_points"] = max(query["max_points"]*(until-since)/max(end-start, 1), 1)
+                queries.insert(0, subquery)
+            if since <= start: break
+            until = since-1
+        if len(queries) == 0: return [query]
+        self.log_debug("planned query on "+query["key"]+" into "+str([[subquery["key"], subquery["start"], subquery["end"]] for subquery in queries]))
+        return queries
+
+    # broadcast acknowledge a new value (or count values) has been saved for the given sensor
+    def send_saved(self, sensor_id, timestamp, value, statistics=None, count=None):
+        message = Message(self)
+        message.recipient = "*/*"
+        message.command = "SAVED"
+        message.args = sensor_id
+        message.set("from_save", True)
+        message.set("timestamp", timestamp)
+        message.set("value", sdk.python.utils.strings.truncate(value, 50))
+        if statistics is not None:
+            message.set("group_by", statistics.split("/")[0])
+            message.set("statistics", statistics)
+        if count is not None: message.set("count", count)
+        self.send(message)
+
+    # refresh the cached database statistics in background, one page of keys at a time
+    def refresh_stats(self):
+        if self.db is None or not self.db.connected: return
+        cursor = 0
+        seen = set()
+        try:
+            while True:
+                cursor, page = self.db.stats_page(cursor, self.stats_page_size)
+                # update the statistics incrementally so they are available while the refresh is still running
+                for stats in page:
+                    self.stats_keys[stats[0]] = stats
+                    seen.add(stats[0])
+                if cursor == 0 or self.stopping: break
+                # let other queries run in between the pages
+                time.sleep(0.1)
+            if self.stopping: return
+            # forget about the keys no more in the database
+            for key in list(self.stats_keys.keys()):
+                if key not in seen: del self.stats_keys[key]
+            self.stats_database = self.db.database_stats()
+            self.stats_updated = self.date.now()
+            self.log_debug("refreshed statistics of "+str(len(seen))+" keys")
+        except Exception,e:
+            self.log_warning("unable to refresh the database statistics: "+exception.get(e))
+
+    # return the (dataset, key) of the sensor subject to the given retention policies
+    def retention_targets(self, sensor_id, policies):
+        key = self.sensors_key+"/"+sensor_id
+        # define which keys to purge for each dataset
+        targets = {
+            "raw": [key, key+"/blocks"],
+            "hourly": [key+"/hour/"+statistics for statistics in self.statistics],
+            "daily": [key+"/day/"+statistics for statistics in self.statistics],
+            "weekly": [key+"/week/"+statistics for statistics in self.statistics],
+            "monthly": [key+"/month/"+statistics for statistics in self.statistics],
+            "yearly": [key+"/year/"+statistics for statistics in self.statistics],
+        }
+        output = []
+        for dataset, keys in targets.iteritems():
+            if dataset not in policies: continue
+            # keep data forever
+            if policies[dataset] == 0: continue
+            for key_to_purge in keys: output.append((dataset, key_to_purge))
+        return output
+
+    # request to seal the closed days of the raw history of the sensors into compressed blocks. Each sensor is sealed by the worker in charge of it, in order with its other requests
+    def compact(self):
+        if self.db is None or not self.db.connected: return
+        keys = 0
+        for key in sorted(self.stats_keys.keys()):
+            if self.stopping: return
+            if not self.blocks.is_candidate(key) or key in self.blocks.unsealable or key in self.blocks.retained: continue
+            message = Message(self)
+            message.recipient = self.fullname
+            message.command = "COMPACT"
+            message.args = key[len(self.sensors_key+"/"):]
+            self.send(message)
+            keys = keys + 1
+            # let other queries run in between the keys
+            time.sleep(self.compaction_pause)
+        self.log_debug("requested to seal the history of "+str(keys)+" keys into compressed blocks")
+
+    # apply the retention policies (map policy name with its policies) to the sensors (map sensor_id with the policy name), purging the keys in chunks
+    def apply_retention(self, policies, sensors):
+        if self.retention_running:
+            self.log_warning("retention policies are already being applied, skipping")
+            return
+        self.retention_running = True
+        try:
+            now = self.date.now()
+            for policy in sorted(policies.keys()):
+                started = time.time()
+                # collect the keys to purge of all the sensors with this policy
+                ranges = []
+                sensors_count = 0
+                for sensor_id in sorted(sensors.keys()):
+                    if sensors[sensor_id] != policy: continue
+                    sensors_count = sensors_count + 1
+                    for dataset, key in self.retention_targets(sensor_id, policies[policy]):
+                        ranges.append((key, "-inf", now - policies[policy][dataset]*86400))
+                        # the track of a position sensor follows the raw data
+                        if dataset == "raw" and key == self.sensors_key+"/"+sensor_id: self.db.geo_trim(self.geo_key+"/tracks/"+sensor_id, now - policies[policy][dataset]*86400)
+                # purge the keys one chunk at a time, pausing in between so not to slow down the other queries
+                total = 0
+                for i in range(0, len(ranges), self.retention_chunk):
+                    if self.stopping: return
+                    chunk = ranges[i:i+self.retention_chunk]
+                    deleted = self.db.delete_by_timeframe_batch(chunk)
+                    for j, (key, start, end) in enumerate(chunk):
+                        if deleted[j] == 0: continue
+                        self.invalidate(key)
+                        total = total + deleted[j]
+                    time.sleep(self.retention_pause)
+                self.log_info("retention policy "+policy+": deleted "+str(total)+" old values from "+str(len(ranges))+" keys of "+str(sensors_count)+" sensors in "+str(round(time.time()-started, 2))+"s")
+        except Exception,e:
+            self.log_error("unable to apply the retention policies: "+exception.get(e))
+        finally:
+            self.retention_running = False
+
+    # iterate over the [timestamp, value] rows of a key, including its sealed history, reading from the database one window (in seconds) at a time
+    def iterate(self, key, window):
+        first = self.db.get_by_position(key, 0, 0, withscores=True)
+        last = self.db.get_by_position(key, -1, -1, withscores=True)
+        if len(first) == 0 or len(last) == 0: return
+        sealed = self.blocks.get_sealed(key)
+        start = min(first[0][0], sealed[0]) if sealed is not None else first[0][0]
+        while start <= last[0][0]:
+            for row in self.blocks.get_by_timeframe(key, start, start+window-1, withscores=True):
+                yield row
+            start = start+window
+
+    # export the raw and aggregated data of the sensor of the given request into the requested file, one chunk at a time
+    def export_sensor(self, message):
+        sensor_id = message.args
+        filename = message.get("filename")
+        key = self.sensors_key+"/"+sensor_id
+        started = time.time()
+        rows = 0
+        keys = 0
+        try:
+            path = self.get_export_path(filename)
+            if not os.path.isdir(self.config["export_directory"]): os.makedirs(self.config["export_directory"])
+            with open(path, "wb") as f:
+                db_export.write_header(f, {"sensor_id": sensor_id, "exported": self.date.now()})
+                for suffix in [""]+["/"+group_by+"/"+statistics for group_by in self.group_by for statistics in self.statistics]:
+                    if not self.db.exists(key+suffix): continue
+                    keys = keys + 1
+                    # raw data is read one day at a time, aggregated data one year at a time
+                    chunk = []
+                    for row in self.iterate(key+suffix, 86400 if suffix == "" else 366*86400):
+                        chunk.append(row)
+                        if len(chunk) < db_export.CHUNK_SIZE: continue
+                        db_export.write_chunk(f, suffix, chunk)
+                        rows = rows + len(chunk)
+                        chunk = []
+                    if len(chunk) > 0: 
+                        db_export.write_chunk(f, suffix, chunk)
+                        rows = rows + len(chunk)
+            elapsed = time.time()-started
+            self.log_info("["+sensor_id+"] exported "+str(rows)+" values of "+str(keys)+" keys into "+filename+" in "+str(round(elapsed, 2))+"s ("+str(int(rows/max(elapsed, 0.001)))+" rows/s)")
+            output = {"filename": filename, "keys": keys, "rows": rows, "seconds": round(elapsed, 2), "rows_per_second": int(rows/max(elapsed, 0.001))}
+        except Exception,e:
+            self.log_error("["+sensor_id+"] unable to export into "+str(filename)+": "+exception.get(e))
+            output = {"filename": filename, "error": exception.get(e)}
+        message.reply()
+        message.set_data(output)
+        self.send(message)
+
+    # return the path of the given file within the export directory, raising an exception if not configured or the file is outside of it
+    def get_export_path(self, filename):
+        if "export_directory" not in self.config or self.config["export_directory"] in [None, ""]: raise Exception("no export directory configured")
+        if not isinstance(filename, basestring) or filename in ["", "."] or "/" in filename or "\\" in filename or ".." in filename: raise Exception("invalid filename "+str(filename))
+        return os.path.join(self.config["export_directory"], filename)
+
+    # import into the sensor of the given request (or the one exported if not provided) the data of the requested file, saving each chunk with a single bulk operation
+    def import_sensor(self, message):
+        filename = message.get("filename")
+        started = time.time()
+        rows = 0
+        saved = 0
+        try:
+            path = self.get_export_path(filename)
+            with open(path, "rb") as f:
+                header = db_export.read_header(f)
+                sensor_id = message.args if message.args is not None and message.args != "" else header["sensor_id"]
+                key = self.sensors_key+"/"+sensor_id
+                for suffix, chunk in db_export.read_chunks(f):
+                    statuses = self.db.save_batch([(key+suffix, value, timestamp, None) for timestamp, value in chunk])
+                    self.invalidate(key+suffix)
+                    if suffix == "": self.index_positions(sensor_id, chunk)
+                    rows = rows + len(chunk)
+                    saved = saved + statuses.count("saved") + statuses.count("replaced")
+                    if self.stopping: break
+            elapsed = time.time()-started
+            self.log_info("["+sensor_id+"] imported "+str(saved)+" new values out of "+str(rows)+" from "+filename+" in "+str(round(elapsed, 2))+"s ("+str(int(rows/max(elapsed, 0.001)))+" rows/s)")
+            output = {"filename": filename, "rows": rows, "saved": saved, "seconds": round(elapsed, 2), "rows_per_second": int(rows/max(elapsed, 0.001))}
+        except Exception,e:
+            self.log_error("unable to import "+str(filename)+": "+exception.get(e))
+            output = {"filename": filename, "error": exception.get(e)}
+        message.reply()
+        message.set_data(output)
+        self.send(message)
+
     # What to do when running
     def on_start(self):
         # initialize the database driver
         if self.config["type"] == "redis": self.db = Db_redis(self)
+        elif self.config["type"] == "mongodb" and "layout" in self.config and self.config["layout"] == "bucket": self.db = Db_mongo_bucket(self)
         elif self.config["type"] == "mongodb": self.db = Db_mongo(self)
+        elif self.config["type"] == "sqlite": self.db = Db_sqlite(self)
         else: 
             self.log_error("Invalid database type: "+str(self.config["type"]))
             self.join()
@@ -191,15 +902,101 @@ class Db(Controller):
         self.db.connect()
         # initialize the database if needed 
         self.db.init_database()
+        self.index_history()
+        # start the workers if configured
+        self.start_workers()
+        # size the result cache
+        self.cache.size = self.config["cache_size"] if "cache_size" in self.config else 1000
+        # schedule the background jobs (only once since this is called again when the configuration changes)
+        if not self.jobs_scheduled:
+            # refresh the database statistics every 5 minutes, starting right away
+            job = {"func": self.refresh_stats, "trigger": "interval", "minutes": 5, "next_run_time": datetime.datetime.now()}
+            self.scheduler.add_job(job)
+            # seal the closed days of the sensors every hour
+            job = {"func": self.compact, "trigger": "interval", "hours": 1}
+            self.scheduler.add_job(job)
+            # recalculate the hours left dirty by sensors no longer saving values
+            job = {"func": self.sweep_rollups, "trigger": "interval", "seconds": 5}
+            self.scheduler.add_job(job)
+            # commit the writes left pending by a database committing them in batches
+            job = {"func": self.commit_writes, "trigger": "interval", "seconds": 1}
+            self.scheduler.add_job(job)
+            self.scheduler.start()
+            self.jobs_scheduled = True
         
+    # commit the writes left pending after the last ones saved (SQLite only, the other databases commit each write)
+    def commit_writes(self):
+        if not isinstance(self.db, Db_sqlite) or not self.db.connected: return
+        try:
+            self.db.commit_pending()
+        except Exception,e:
+            self.log_error("unable to commit the pending writes: "+exception.get(e))
+
     # What to do when shutting down
     def on_stop(self):
+        # stop the scheduler
+        if self.jobs_scheduled: self.scheduler.stop()
+        # stop the workers, letting them complete the pending requests
+        for queue in self.queues: queue.put(None)
+        for worker in self.workers: worker.join()
+        self.workers = []
+        self.queues = []
+        # recalculate the hours still dirty
+        if self.db is not None and self.db.connected: self.flush_rollups()
         # disconnect from the database
         if self.db is not None:
             self.db.disconnect()
 
+    # start the configured number of workers, each processing requests from its own queue
+    def start_workers(self):
+        if len(self.workers) > 0 or "workers" not in self.config or self.config["workers"] < 2: return
+        self.log_debug("starting "+str(self.config["workers"])+" workers")
+        for i in range(self.config["workers"]):
+            queue = Queue.Queue()
+            worker = threading.Thread(target=self.worker, args=(queue,), name="db-worker-"+str(i))
+            worker.daemon = True
+            self.queues.append(queue)
+            self.workers.append(worker)
+            worker.start()
+
+    # process the requests of the given queue until stopped
+    def worker(self, queue):
+        while True:
+            message = queue.get()
+            if message is None: break
+            try:
+                self.process(message)
+            except Exception,e:
+                self.log_error("unable to process "+message.command+" from "+message.sender+": "+exception.get(e))
+
+    # return the queue in charge of the given sensor or item. Requests of the same sensor, including its aggregated data, are always handled by the same worker in order
+    def get_queue(self, item_id):
+        item_id = re.sub("/(hour|day|week|month|year)/[^/]+$", "", item_id)
+        return self.queues[hash(item_id) % len(self.queues)]
+
     # What to do when receiving a request for this module    
     def on_message(self, message):
+        # without workers, process the request right away
+        if len(self.workers) == 0: 
+            self.process(message)
+            return
+        # split a batch so that each worker saves the records of its sensors
+        if message.command == "SAVE_BATCH" and isinstance(message.get_data(), dict) and "records" in message.get_data():
+            batches = {}
+            for record in message.get("records"):
+                queue = self.get_queue(str(record["sensor_id"]) if "sensor_id" in record else "")
+                if queue not in batches: batches[queue] = []
+                batches[queue].append(record)
+            for queue, records in batches.iteritems():
+                batch = copy.copy(message)
+                batch.set_data(dict(message.get_data(), records=records))
+                queue.put(batch)
+            return
+        queue = self.get_queue(message.args if isinstance(message.args, basestring) and message.args != "" else message.command)
+        queue.put(message)
+
+    # process a request for this module
+    def process(self, message):
         if self.db is None or not self.db.connected: return # ignore the request if not connected yet
         item_id = message.args # item_id contains sensor_id, rule_id, etc.
         
@@ -208,97 +1005,149 @@ class Db(Controller):
             key = self.sensors_key+"/"+item_id
             # 1) if statistics to save the value to is explicit, set it
             if message.has("statistics"): key = key+"/"+message.get("statistics")
-            # 2) check if we need to apply any retention policy before saving the new value
-            if message.has("retain"):
-                retain = message.get("retain")
-                # if we have to keep up to "count" values, delete old values from the db
-                if "count" in retain:
-                    self.db.delete_by_position(key, 0, -retain["count"])
-                # if only measures with a newer timestamp than the latest can be added, apply the policy
-                if "new_only" in retain and retain["new_only"]:
-                    # retrieve the latest measure's timestamp
-                    last = self.db.get_by_position(key, -1, -1)
-                    if len(last) > 0:
-                        last_timestamp = last[0][0]
-                        # if the measure's timestamp is older or the same, skip it
-                        if message.get("timestamp") <= last_timestamp:
-                            self.log_debug("["+item_id+"] ("+self.date.timestamp2date(message.get("timestamp"))+") old event, ignoring "+key+": "+str(message.get("value")))
-                            return
-            # 3) check if there is already something stored with the same timestamp
-            old = self.db.get_by_timeframe(key, message.get("timestamp"), message.get("timestamp"))
-            if len(old) > 0:
-                if old[0][1] == message.get("value"):
-                    # if the value is also the same, skip it
-                    self.log_debug("["+item_id+"] ("+self.date.timestamp2date(message.get("timestamp"))+") already in the database, ignoring "+key+": "+str(message.get("value")))
-                    return
-                else: 
-                    # same timestamp but different value, remove the old value so to store the new one
-                    self.db.delete_by_timeframe(key, message.get("timestamp"), message.get("timestamp"))
-            # 4) save the new value
-            self.db.set_series(key, message.get("value"), message.get("timestamp"))
-            # 5) broadcast acknowledge value updated
-            ack_message = Message(self)
-            ack_message.recipient = "*/*"
-            ack_message.command = "SAVED"
-            ack_message.args = item_id
-            ack_message.set("from_save", True)
-            ack_message.set("timestamp", message.get("timestamp"))
-            ack_message.set("value", sdk.python.utils.strings.truncate(message.get("value"), 50))
-            if message.has("statistics"):
-                ack_message.set("group_by", message.get("statistics").split("/")[0])
-                ack_message.set("statistics", message.get("statistics"))
-            self.send(ack_message)
-            # 6) re-calculate the derived statistics for the hour/day
+            # 2) save the new value, applying any retention policy (count, new_only) and skipping duplicates in a single call
+            retain = message.get("retain") if message.has("retain") else None
+            if retain is not None and "count" in retain: self.blocks.retain_by_count(key, retain["count"])
+            status = self.db.save(key, message.get("value"), message.get("timestamp"), retain)
+            if status is None: return
+            # the count retention policy may have deleted old values even if the new one has been skipped
+            if retain is not None and "count" in retain: self.cache.bump(key)
+            # if the measure's timestamp is older or the same of the latest, it has been skipped
+            if status == "old":
+                self.log_debug("["+item_id+"] ("+self.date.timestamp2date(message.get("timestamp"))+") old event, ignoring "+key+": "+str(message.get("value")))
+                return
+            # if the value with the same timestamp was already there, it has been skipped
+            if status == "duplicate":
+                self.log_debug("["+item_id+"] ("+self.date.timestamp2date(message.get("timestamp"))+") already in the database, ignoring "+key+": "+str(message.get("value")))
+                return
+            self.index_latest(key, message.get("value"), message.get("timestamp"))
+            if not message.has("statistics"): self.index_positions(item_id, [[message.get("timestamp"), message.get("value")]])
+            # 3) broadcast acknowledge value updated
+            self.send_saved(item_id, message.get("timestamp"), message.get("value"), message.get("statistics") if message.has("statistics") else None)
+            # 4) re-calculate the derived statistics for the hour/day
             if message.has("calculate"):
-                self.calculate(item_id, message.get("calculate"), "hour", self.date.hour_start(message.get("timestamp")), self.date.hour_end(message.get("timestamp")))
-                self.calculate(item_id, message.get("calculate"), "day", self.date.day_start(message.get("timestamp")), self.date.day_end(message.get("timestamp")))
+                # when configured, coalesce the recalculations of the sensor within the rollup interval
+                if "rollup_interval" in self.config and self.config["rollup_interval"] > 0: 
+                    self.mark_dirty(item_id, message.get("calculate"), message.get("timestamp"))
+                    return
+                # a replaced value or values deleted by the count retention policy cannot be accumulated, the hour has to be read again
+                incremental = status == "saved" and (retain is None or "count" not in retain)
+                self.update_rollups(item_id, message.get("calculate"), message.get("timestamp"), message.get("value"), incremental)
         
+        # save multiple measures (of one or more sensors) at once
+        elif message.command == "SAVE_BATCH":
+            records = []
+            for record in message.get("records"):
+                if "timestamp" not in record or record["timestamp"] is None:
+                    self.log_warning("["+str(record["sensor_id"])+"] no timestamp provided, ignoring "+str(record["value"]))
+                    continue
+                records.append(record)
+            # 1) save all the values with a single bulk operation
+            batch = []
+            for record in records:
+                key = self.sensors_key+"/"+record["sensor_id"]
+                if "statistics" in record: key = key+"/"+record["statistics"]
+                batch.append((key, record["value"], record["timestamp"], record["retain"] if "retain" in record else None))
+                if "retain" in record and "count" in record["retain"]: self.blocks.retain_by_count(key, record["retain"]["count"])
+            statuses = self.db.save_batch(batch)
+            # 2) keep track of the latest value saved for each sensor and of the hours/days to re-calculate
+            saved = {}
+            hours = {}
+            days = {}
+            positions = {}
+            for i, record in enumerate(records):
+                if statuses[i] not in ["saved", "replaced"]: continue
+                self.index_latest(batch[i][0], record["value"], record["timestamp"])
+                statistics = record["statistics"] if "statistics" in record else None
+                if statistics is None: positions.setdefault(record["sensor_id"], []).append([record["timestamp"], record["value"]])
+                item = (record["sensor_id"], statistics)
+                if item not in saved: saved[item] = {"count": 0, "record": record}
+                saved[item]["count"] = saved[item]["count"] + 1
+                if record["timestamp"] >= saved[item]["record"]["timestamp"]: saved[item]["record"] = record
+                if "calculate" in record:
+                    hours[(record["sensor_id"], self.date.hour_start(record["timestamp"]))] = record["calculate"]
+                    days[(record["sensor_id"], self.date.day_start(record["timestamp"]))] = record["calculate"]
+            self.log_debug("saved "+str(statuses.count("saved")+statuses.count("replaced"))+" out of "+str(len(records))+" values")
+            for sensor_id, rows in positions.iteritems(): self.index_positions(sensor_id, rows)
+            # 3) broadcast a single acknowledge for each sensor
+            for (sensor_id, statistics), item in saved.iteritems():
+                self.send_saved(sensor_id, item["record"]["timestamp"], item["record"]["value"], statistics, item["count"])
+            # 4) re-calculate once each hour and then each day affected by the batch
+            for (sensor_id, start), calculations in sorted(hours.iteritems()):
+                self.calculate(sensor_id, calculations, "hour", start, self.date.hour_end(start))
+            for (sensor_id, start), calculations in sorted(days.iteritems()):
+                stats = self.calculate(sensor_id, calculations, "day", start, self.date.day_end(start))
+                # days already closed are rolled up into their week, month and year as well
+                if stats is not None and start < self.date.day_start(self.date.now()): self.update_periods(sensor_id, calculations, start, stats)
+
         # save alert
         elif message.command == "SAVE_ALERT":
             key = self.alerts_key+"/"+item_id
             self.db.set_series(key, message.get_data(), self.date.now())
+            self.index_latest(key, message.get_data(), self.date.now())
             self.log_debug("["+item_id+"] saving alert '"+message.get_data()+"'")
             
         # save log
         elif message.command == "SAVE_LOG":
             key = self.logs_key+"/"+item_id
             self.db.set_series(key, message.get_data(), self.date.now(), False)
+            self.index_latest(key, message.get_data(), self.date.now())
         
         # calculate hourly statistics for the requested sensor
         elif message.command == "CALC_HOUR_STATS":
+            # the hour is closed, recalculate any pending change first
+            self.flush_rollups(item_id)
             self.calculate(item_id, message.get_data(), "hour", self.date.hour_start(self.date.last_hour()), self.date.hour_end(self.date.last_hour()))
         # calculate daily statistics for the requested sensor
         elif message.command == "CALC_DAY_STATS":
-            self.calculate(item_id, message.get_data(), "day", self.date.day_start(self.date.yesterday()), self.date.day_end(self.date.yesterday()))
+            self.flush_rollups(item_id)
+            start = self.date.day_start(self.date.yesterday())
+            stats = self.calculate(item_id, message.get_data(), "day", start, self.date.day_end(self.date.yesterday()))
+            # roll up the closed day into the longer periods
+            if stats is not None: self.update_periods(item_id, message.get_data(), start, stats)
         
+        # recalculate the hours left dirty by the sensor
+        elif message.command == "FLUSH_ROLLUPS":
+            with self.dirty_lock:
+                self.sweeping.discard(item_id)
+            self.flush_rollups(item_id, True)
+
+        # seal the closed days of the sensor into compressed blocks
+        elif message.command == "COMPACT":
+            key = self.sensors_key+"/"+item_id
+            started = time.time()
+            count = self.blocks.compact(key)
+            if count > 0: self.log_debug("sealed "+str(count)+" values of "+key+" into compressed blocks in "+str(round(time.time()-started, 2))+"s")
+
         # apply sensors retention policies
         elif message.command == "PURGE_SENSOR":
             sensor_id = item_id
             policies = message.get_data()
             total = 0
-            # set the base database key for the sensor
-            key = self.sensors_key+"/"+sensor_id
-            # define which stat to purge for each dataset
-            targets = {
-                "raw": [""],
-                "hourly": ["/hour/min", "/hour/avg", "/hour/max", "/hour/rate", "/hour/sum"],
-                "daily": ["/day/min", "/day/avg", "/day/max", "/day/rate", "/day/sum"],
-            }
-            # for each dataset, purge the associated subkeys
-            for dataset, subkeys in targets.iteritems():
-                if dataset not in policies: continue
-                retention = policies[dataset]
-                # keep data forever
-                if retention == 0: continue 
-                # for each stat to purge
-                for subkey in subkeys:
-                    key_to_purge = key+subkey
-                    if self.db.exists(key_to_purge):
-                        # if the key exists, delete old data
-                        deleted = self.db.delete_by_timeframe(key_to_purge, "-inf", self.date.now() - retention*86400)
-                        self.log_debug("["+sensor_id+"] deleting from "+key_to_purge+" "+str(deleted)+" old items")
-                        total = total + deleted
+            # for each dataset, purge the associated keys
+            for dataset, key_to_purge in self.retention_targets(sensor_id, policies):
+                if self.db.exists(key_to_purge):
+                    # if the key exists, delete old data
+                    deleted = self.db.delete_by_timeframe(key_to_purge, "-inf", self.date.now() - policies[dataset]*86400)
+                    self.invalidate(key_to_purge)
+                    self.log_debug("["+sensor_id+"] deleting from "+key_to_purge+" "+str(deleted)+" old items")
+                    total = total + deleted
+            # the track of a position sensor follows the raw data
+            if "raw" in policies and policies["raw"] != 0: self.db.geo_trim(self.geo_key+"/tracks/"+sensor_id, self.date.now() - policies["raw"]*86400)
             if total > 0: self.log_info("["+sensor_id+"] deleted "+str(total)+" old values")
+
+        # apply the retention policies to all the sensors in background
+        elif message.command == "PURGE_SENSORS":
+            job = {"func": self.apply_retention, "trigger": "date", "run_date": datetime.datetime.now(), "args": [message.get("policies"), message.get("sensors")]}
+            self.scheduler.add_job(job)
+            
+        # export/import the history of a sensor in background
+        elif message.command == "EXPORT":
+            job = {"func": self.export_sensor, "trigger": "date", "run_date": datetime.datetime.now(), "args": [message]}
+            self.scheduler.add_job(job)
+        elif message.command == "IMPORT":
+            job = {"func": self.import_sensor, "trigger": "date", "run_date": datetime.datetime.now(), "args": [message]}
+            self.scheduler.add_job(job)
             
         # apply alerts retention policies
         elif message.command == "PURGE_ALERTS":
@@ -308,6 +1157,7 @@ class Db(Controller):
                 key = self.alerts_key+"/"+severity
                 if self.db.exists(key):
                     deleted = self.db.delete_by_timeframe(key,"-inf",self.date.now()-days*86400)
+                    self.invalidate(key)
                     self.log_debug("deleting from "+severity+" "+str(deleted)+" items")
                     total = total + deleted
             if total > 0: self.log_info("deleted "+str(total)+" old alerts")
@@ -320,6 +1170,7 @@ class Db(Controller):
                 key = self.logs_key+"/"+severity
                 if self.db.exists(key):
                     deleted = self.db.delete_by_timeframe(key,"-inf",self.date.now()-days*86400)
+                    self.invalidate(key)
                     self.log_debug("deleting from "+severity+" "+str(deleted)+" items")
                     total = total + deleted
             if total > 0: self.log_info("deleted "+str(total)+" old logs")
@@ -330,12 +1181,22 @@ class Db(Controller):
             self.log_info("deleting from the database sensor "+item_id)
             self.log_debug("deleting key "+key)
             self.db.delete(key)
-            for timeframe in ["hour", "day"]:
-                for stat in ["min", "avg", "max", "rate", "sum", "count", "count_unique"]:
+            self.invalidate(key)
+            self.rollups.forget(item_id)
+            self.discard_rollups(item_id)
+            if self.db.exists(key+"/blocks"):
+                self.log_debug("deleting key "+key+"/blocks")
+                self.db.delete(key+"/blocks")
+                self.invalidate(key+"/blocks")
+            self.db.delete(self.geo_key+"/tracks/"+item_id)
+            self.db.geo_remove(self.positions_key, [item_id])
+            for timeframe in self.group_by:
+                for stat in self.statistics:
                     subkey = key+"/"+timeframe+"/"+stat
                     if self.db.exists(subkey):
                         self.log_debug("deleting key "+subkey)
                         self.db.delete(subkey)
+                        self.invalidate(subkey)
 
         # rename a sensor in the database
         elif message.command == "RENAME_SENSOR":
@@ -344,172 +1205,137 @@ class Db(Controller):
             self.log_info("renaming sensor "+item_id+" into "+message.get_data())
             self.log_debug("renaming key "+old_key+" into "+new_key)
             self.db.rename(old_key, new_key)
-            for timeframe in ["hour", "day"]:
-                for stat in ["min", "avg", "max", "rate", "sum", "count", "count_unique"]:
+            self.invalidate(old_key)
+            self.invalidate(new_key)
+            self.rollups.forget(item_id)
+            self.discard_rollups(item_id)
+            if self.db.exists(old_key+"/blocks"):
+                self.log_debug("renaming key "+old_key+"/blocks into "+new_key+"/blocks")
+                self.db.rename(old_key+"/blocks", new_key+"/blocks")
+                self.invalidate(old_key+"/blocks")
+                self.invalidate(new_key+"/blocks")
+            if self.db.exists(self.geo_key+"/tracks/"+item_id):
+                self.db.rename(self.geo_key+"/tracks/"+item_id, self.geo_key+"/tracks/"+message.get_data())
+                self.db.geo_remove(self.positions_key, [item_id])
+                with self.primary_reads():
+                    self.index_positions(message.get_data(), self.get_by_position(new_key, -1, -1, withscores=True))
+            for timeframe in self.group_by:
+                for stat in self.statistics:
                     old_subkey = old_key+"/"+timeframe+"/"+stat
                     if self.db.exists(old_subkey):
                         new_subkey = new_key+"/"+timeframe+"/"+stat
                         self.log_debug("renaming key "+old_subkey+" into "+new_subkey)
                         self.db.rename(old_subkey, new_subkey)
+                        self.invalidate(old_subkey)
+                        self.invalidate(new_subkey)
             
         # database statistics
         elif message.command == "STATS":
+            # answer from the cached statistics, optionally filtering the keys by prefix
+            query = message.get_data() if isinstance(message.get_data(), dict) else {}
+            prefix = query["prefix"] if "prefix" in query else None
+            if not self.stats_database: self.stats_database = self.db.database_stats()
+            output = self.stats_database.copy()
+            output["keys"] = [stats for key, stats in sorted(self.stats_keys.items()) if prefix is None or key.startswith(prefix)]
+            output["updated"] = self.stats_updated
+            output.update(self.cache.stats())
             message.reply()
-            message.set_data(self.db.stats())
+            message.set_data(output)
             self.send(message)
         
+        # return the next page of a paged query
+        elif message.command == "GET_NEXT":
+            try:
+                query = json.loads(base64.urlsafe_b64decode(str(message.get("cursor"))))
+            except Exception,e:
+                self.log_warning("invalid cursor provided by "+message.sender+": "+exception.get(e))
+                return
+            page = self.get_page(query)
+            if page is None: return
+            message.reply()
+            message.set("data", page[0])
+            message.set("cursor", page[1])
+            self.send(message)
+
+        # distance over time of a position sensor from a point (the house by default)
+        elif message.command == "GET_DISTANCES":
+            query = self.prepare_query(item_id, message.get_data().copy() if isinstance(message.get_data(), dict) else {})
+            start = query["start"] if self.is_timeframe(query) and "start" in query else self.date.now()-24*3600
+            end = query["end"] if self.is_timeframe(query) and "end" in query else self.date.now()
+            longitude, latitude = self.geo_center(None, query)
+            # distances are calculated by the database out of the track of the sensor
+            data = [[int(timestamp), self.to_house_units(distance)] for timestamp, distance in self.db.geo_distances(self.geo_key+"/tracks/"+item_id, self.sensors_key+"/"+item_id, longitude, latitude, start, end)]
+            message.reply()
+            message.set("data", db_downsample.format_points(data, True, "milliseconds" in query and query["milliseconds"], "format_date" in query and query["format_date"], self.date))
+            self.send(message)
+
+        # sensors whose latest position is within a radius (in the units of the house) from a point or the nearest ones, nearest first
+        elif message.command == "GET_WITHIN" or message.command == "GET_NEAREST":
+            query = message.get_data() if isinstance(message.get_data(), dict) else {}
+            if message.command == "GET_WITHIN" and "radius" not in query:
+                self.log_warning("no radius provided by "+message.sender+" for "+message.command)
+                return
+            radius = None
+            if "radius" in query: radius = query["radius"]*db_geo.MILE if self.house["units"] == "imperial" else query["radius"]
+            count = query["count"] if "count" in query else (1 if message.command == "GET_NEAREST" else None)
+            longitude, latitude = self.geo_center(item_id, query)
+            data = []
+            # the sensor used as the point is not part of the result
+            for member, distance in self.db.geo_radius(self.positions_key, longitude, latitude, radius, count+1 if count is not None and item_id else count):
+                if member == item_id: continue
+                data.append([member, self.to_house_units(distance)])
+            if count is not None: data = data[:count]
+            message.reply()
+            message.set("data", data)
+            self.send(message)
+
+        # run multiple queries at once, returning their results keyed by query id
+        elif message.command == "GET_MULTI":
+            results = {}
+            batch = []
+            for query_id, request in message.get("queries").iteritems():
+                query = request.copy()
+                command = query["command"] if "command" in query else "GET"
+                if "command" in query: del query["command"]
+                item_id = query["sensor_id"]
+                del query["sensor_id"]
+                query = self.prepare_query(item_id, query)
+                # plain queries are fetched all together, the others one at a time
+                if command in ["GET", "GET_ELAPSED", "GET_TIMESTAMP", "GET_DISTANCE", "GET_POSITION_TEXT", "GET_POSITION_LABEL", "GET_SCHEDULE", "GET_SCHEDULE_NEXT"] and not query["key"].endswith("/range") and "resolution" not in query and "max_points" not in query and "page_size" not in query:
+                    if command == "GET_ELAPSED" or command == "GET_TIMESTAMP": query["withscores"] = True
+                    if "withscores" not in query: query["withscores"] = False
+                    query["by_position"] = not self.is_timeframe(query)
+                    batch.append((query_id, command, query))
+                else:
+                    data = self.run_query(command, query)
+                    results[query_id] = data if data is not None else []
+            fetched = self.get_many([query for query_id, command, query in batch])
+            for i, (query_id, command, query) in enumerate(batch):
+                data = self.postprocess(command, fetched[i], query["key"])
+                results[query_id] = data if data is not None else []
+            message.reply()
+            message.set("results", results)
+            self.log_debug(message.command+" from "+message.sender+" for "+str(len(results))+" queries")
+            self.send(message)
+
         # query the database
         elif message.command.startswith("GET"):
-            # 1) initialize query object. payload will be passed to the query function, adding missing parameter key
-            query = message.get_data().copy() if isinstance(message.get_data(), dict) else {}
-            # select which area of the database to query (default to sensors)
-            scope = self.sensors_key
-            if "scope" in query:
-                if query["scope"] == "logs": scope = self.logs_key
-                if query["scope"] == "alerts": scope = self.alerts_key
-                del query["scope"]
-            key = scope+"/"+item_id
-            query["key"] = key
-            # 2) handle timeframe requests, calculate start and end
-            if "timeframe" in query:
-                if query["timeframe"] == "today":
-                    query["start"] = self.date.day_start(self.date.now())
-                    query["end"] = self.date.day_end(self.date.now())
-                    query["withscores"] = False
-                elif query["timeframe"] == "yesterday":
-                    query["start"] = self.date.day_start(self.date.yesterday())
-                    query["end"] = self.date.day_end(self.date.yesterday())
-                    query["withscores"] = False
-                elif query["timeframe"].startswith("last_") or query["timeframe"].startswith("next_"):
-                    # expect <last|next>_xx_<hours|days>
-                    action, value, unit = query["timeframe"].split("_")
-                    # convert the provided value in seconds
-                    value = int(value)*3600 if unit == "hours" else int(value)*86400
-                    # set start/end based on the requested action
-                    query["start"] = self.date.now() - int(value) if action == "last" else self.date.now()
-                    query["end"] = self.date.now() if action == "last" else self.date.now() + int(value)
-                    query["withscores"] = True
-                    query["milliseconds"] = True
-                del query["timeframe"]
-            # 3) if start and/or end are timestamps, use get_by_timeframe, otherwise use get_by_position
-            if "start" in query and query["start"] > 1000000000:
-                function = self.db.get_by_timeframe
-            elif "end" in query and query["end"] > 1000000000:
-                function = self.db.get_by_timeframe
-            else: 
-                function = self.db.get_by_position
+            # initialize the query object out of the payload
+            query = self.prepare_query(item_id, message.get_data().copy() if isinstance(message.get_data(), dict) else {})
             # reply to the requesting module
             message.reply()
-            # 4) set if we need timestamps together with the values
-            if message.command == "GET_ELAPSED" or message.command == "GET_TIMESTAMP": 
-                query["withscores"] = True
-            if "withscores" not in query: query["withscores"] = False
-            # 5) if range is requested, start asking for min first
-            is_range = False
-            if query["key"].endswith("/range"):
-                is_range = True
-                query["key"] = re.sub("/range$", "/min", query["key"])
-            # 6) call the function mapping parameters with message payload input
-            data = function(**query)
-            # 7) postprocess if needed
-            if is_range and len(data) > 0:
-                # if a range is requested, ask for the max and combine the results
-                query["key"] = re.sub("/min$", "/max", query["key"])
-                query["withscores"] = False
-                data_max = function(**query)
-                for i, item in enumerate(data):
-                    # ensure data_max has a correspondent value
-                    if i < len(data_max):
-                        if (isinstance(item,list)): data[i].append(data_max[i])
-                        else: data.append(data_max[i])
-            # elapsed since the measure was taken is requested, calculate the time difference in seconds
-            if message.command == "GET_ELAPSED":
-                if len(data) == 0: 
-                    data = []
-                else: 
-                    time_diff = self.date.now() - data[0][0]
-                    data = [time_diff]
-            # the timestamp of the measure is requested, return it
-            elif message.command == "GET_TIMESTAMP":
-                if len(data) == 0: data = []
-                else: data = [data[0][0]]
-            # the distance of the measure from this house is requested
-            elif message.command == "GET_DISTANCE":
-                if len(data) == 0: return []
-                # get position (only the first one if multiple are provided)
-                try:
-                    position = json.loads(data[0])
-                except Exception,e: 
-                    self.log_warning("unable to get the distance from an invalid position: "+str(data)+" - "+exception.get(e))
-                    return
-                if "longitude" not in position or "latitude" not in position: 
-                    self.log_warning("invalid position provided: "+str(position))
-                    return
-                # convert decimal degrees to radians 
-                lon1, lat1, lon2, lat2 = map(radians, [position["longitude"], position["latitude"], self.house["longitude"], self.house["latitude"]])
-                # haversine formula 
-                dlon = lon2 - lon1 
-                dlat = lat2 - lat1 
-                a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
-                c = 2 * asin(sqrt(a)) 
-                distance = 6367 * c
-                if self.house["units"] == "imperial": distance = distance/1.609
-                data = [int(distance)]
-            # the text associated to the position is requested
-            elif message.command == "GET_POSITION_TEXT":
-                if len(data) == 0: return []
-                try:
-                    position = json.loads(data[0])
-                except Exception,e: 
-                    self.log_warning("unable to get the text from an invalid position: "+str(data)+" - "+exception.get(e))
-                    return
-                if "text" not in position: 
-                    self.log_warning("text missing: "+str(position))
-                    return
-                data = [position["text"]]
-            # the label associated to the position is requested
-            elif message.command == "GET_POSITION_LABEL":
-                if len(data) == 0: return []
-                try:
-                    position = json.loads(data[0])
-                except Exception,e: 
-                    self.log_warning("unable to get the label from an invalid position: "+str(data)+" - "+exception.get(e))
-                    return
-                if "label" not in position: 
-                    self.log_warning("label missing: "+str(position))
-                    return
-                data = [position["label"]]
-            # the timestamp of the measure is requested, return it
-            elif message.command == "GET_SCHEDULE":
-                if len(data) != 1: return []
-                # the calendar string is at position 0
-                try:
-                    calendar = json.loads(data[0])
-                except Exception,e: 
-                    self.log_warning("unable to parse calendar's data: "+str(data)+" - "+exception.get(e))
-                    return []
-                # the list of events is at position 1
-                if len(calendar) != 2: return []
-                events = json.loads(calendar[1])
-                found = False
-                for event in events:
-                    # generate the timestamp of start and end date
-                    start_date = datetime.datetime.strptime(event["start_date"],"%Y-%m-%dT%H:%M:%S.000Z")
-                    start_timestamp = self.date.timezone(self.date.timezone(int(time.mktime(start_date.timetuple()))))
-                    end_date = datetime.datetime.strptime(event["end_date"],"%Y-%m-%dT%H:%M:%S.000Z")
-                    end_timestamp = self.date.timezone(self.date.timezone(int(time.mktime(end_date.timetuple()))))
-                    now_ts = self.date.now()
-                    # check if we are within an event
-                    if now_ts > start_timestamp and now_ts < end_timestamp: 
-                        found = True
-                        data = [event["text"]]
-                if not found: data = [""]
-            # a count of the measures taken during the timeframe is requested,  count the values
-            elif message.command == "GET_COUNT":
-                data = [len(data)]
-            # 8) attach the result to the message payload
+            if message.command == "GET" and self.is_timeframe(query) and not query["key"].endswith("/range") and "page_size" in query:
+                # return the first page only, together with the cursor to retrieve the next one
+                page = self.get_page(query)
+                if page is None: return
+                data = page[0]
+                message.set("cursor", page[1])
+            else:
+                data = self.run_query(message.command, query)
+                if data is None: return
+            # attach the result to the message payload
             message.set("data", data)
-            # 10) send the response back
+            # send the response back
             self.log_debug(message.command+" from "+message.sender+" for "+str(query)+" returning "+str(message.get_data()))
             self.send(message)
             
@@ -521,6 +1347,7 @@ class Db(Controller):
         if message.args == "house" and not message.is_null:
             if not self.is_valid_configuration(["timezone"], message.get_data()): return False
             self.date = DateTimeUtils(message.get("timezone"))
+            self.schedules.clear()
             self.house = message.get_data()
         # module's configuration
         elif message.args == self.fullname:     
@@ -533,7 +1360,9 @@ class Db(Controller):
             if message.config_schema != self.config_schema: 
                 return False
             # ensure the configuration file contains all required settings
-            if not self.is_valid_configuration(["type", "hostname", "port", "database"], message.get_data()): return False
+            # an embedded sqlite database only needs the filename
+            required = ["type", "database"] if "type" in message.get_data() and message.get("type") == "sqlite" else ["type", "hostname", "port", "database"]
+            if not self.is_valid_configuration(required, message.get_data()): return False
             # if this is an updated configuration file, disconnect and reconnect
             if self.config: 
                 self.db.disconnect()
@@ -0,0 +1,256 @@
+# controller/db: compaction of the raw history of the sensors into compressed blocks
+
+import re
+import bisect
+
+import sdk.python.utils.numbers
+
+import db_downsample
+import db_gorilla
+
+class Db_blocks():
+    def __init__(self, module):
+        self.module = module
+        # map a key with (first timestamp, last timestamp) of its sealed history, None if nothing has been sealed
+        self.sealed = {}
+        # keys whose history cannot be sealed since not numeric
+        self.unsealable = set()
+        # keys retained by count, whose history is never sealed so the count can be applied to the live data only
+        self.retained = set()
+        # map a key with the (first timestamp, last timestamp, number of values) of each of its blocks, ordered by time
+        self.counts = {}
+
+    # return True if the history of the given key can be sealed (raw data of the sensors only)
+    def is_candidate(self, key):
+        if not key.startswith(self.module.sensors_key+"/"): return False
+        return re.search(r'/(hour|day|week|month|year)/[^/]+$|/blocks$', key) is None
+
+    # return (first timestamp, last timestamp) of the sealed history of the given key, None if nothing has been sealed
+    def get_sealed(self, key):
+        if not self.is_candidate(key): return None
+        if key not in self.sealed:
+            # kept until the blocks change, so read from the primary
+            with self.module.primary_reads():
+                first = self.module.db.get_by_position(key+"/blocks", 0, 0, withscores=True)
+                last = self.module.db.get_by_position(key+"/blocks", -1, -1, withscores=True)
+            if len(first) == 0 or len(last) == 0 or not db_gorilla.is_block(first[0][1]): self.sealed[key] = None
+            else: self.sealed[key] = (next(db_gorilla.decode(first[0][1]), [first[0][0]])[0], last[0][0])
+        return self.sealed[key]
+
+    # forget what is known about the sealed history of the given key (or of its blocks)
+    def forget(self, key):
+        key = re.sub("/blocks$", "", key)
+        self.sealed.pop(key, None)
+        self.counts.pop(key, None)
+        self.unsealable.discard(key)
+
+    # return the (first timestamp, last timestamp, number of values) of each block of the given key, reading the header of the blocks only the first time
+    def get_counts(self, key):
+        if key not in self.counts:
+            counts = []
+            with self.module.primary_reads():
+                blocks = self.module.db.get_by_position(key+"/blocks", 0, -1, withscores=True)
+            for timestamp, block in blocks:
+                if not db_gorilla.is_block(block): continue
+                count, first = db_gorilla.header(block)
+                if count > 0: counts.append((first, timestamp, count))
+            self.counts[key] = counts
+        return self.counts[key]
+
+    # turn a range of positions of the given key into (absolute start, absolute end, number of sealed values) counting the sealed history as well.
+    # None if live values have been saved into days already sealed (until sealed again), since their positions would be interleaved with the sealed ones
+    def resolve(self, key, start, end):
+        sealed = self.get_sealed(key)
+        if self.module.db.aggregate(key, "count", 0, sealed[1]) > 0: return None
+        sealed_count = sum([count for first, last, count in self.get_counts(key)])
+        total = sealed_count+self.module.db.aggregate(key, "count", 0, -1, True)
+        if start < 0: start = max(total+start, 0)
+        if end < 0: end = total+end
+        return (start, min(end, total-1), sealed_count)
+
+    # return the sealed [timestamp, value] points of the given key between two absolute positions, decoding only the blocks they fall in
+    def read_by_position(self, key, start, end):
+        blocks = []
+        offset = 0
+        for first, last, count in self.get_counts(key):
+            if offset <= end and offset+count > start: blocks.append((offset, last))
+            offset = offset+count
+        if len(blocks) == 0: return []
+        offsets = dict([(last, offset) for offset, last in blocks])
+        points = []
+        for timestamp, block in self.module.db.get_by_timeframe(key+"/blocks", blocks[0][1], blocks[-1][1], withscores=True):
+            if timestamp not in offsets or not db_gorilla.is_block(block): continue
+            offset = offsets[timestamp]
+            points = points + list(db_gorilla.decode(block))[max(start-offset, 0):end-offset+1]
+        return points
+
+    # return the sealed [timestamp, value] points of the given key between two timestamps
+    def read(self, key, start, end):
+        points = []
+        # each block is stored with the timestamp of its last value and spans a single day
+        for timestamp, block in self.module.db.get_by_timeframe(key+"/blocks", start, end+2*86400, withscores=True):
+            if not db_gorilla.is_block(block): continue
+            for point in db_gorilla.decode(block):
+                if point[0] >= start and point[0] <= end: points.append(point)
+        return points
+
+    # get a range of values based on the timestamp, merging the sealed history with the live data
+    def get_by_timeframe(self, key, start=None, end=None, withscores=True, milliseconds=False, format_date=False, formatter=None, max_items=None, max_points=None, downsample="avg"):
+        if start is None: start = self.module.date.now()-24*3600
+        if end is None: end = self.module.date.now()
+        sealed = self.get_sealed(key)
+        # nothing sealed within the timeframe, query the live data only
+        if sealed is None or not isinstance(start, (int, long, float)) or not isinstance(end, (int, long, float)) or start > sealed[1] or end < sealed[0]:
+            return self.module.db.get_by_timeframe(key, start, end, withscores, milliseconds, format_date, formatter, max_items, max_points, downsample)
+        points = {}
+        for timestamp, value in self.read(key, start, end):
+            points[timestamp] = value if formatter is None else sdk.python.utils.numbers.normalize(value, formatter)
+        # values saved after their day has been sealed take precedence
+        for timestamp, value in self.module.db.get_by_timeframe(key, start, end, withscores=True, formatter=formatter):
+            points[timestamp] = value
+        points = [[timestamp, points[timestamp]] for timestamp in sorted(points.keys())]
+        if max_points is not None: points = db_downsample.downsample(points, max_points, downsample, start=start, end=end)
+        data = db_downsample.format_points(points, withscores, milliseconds, format_date, self.module.date)
+        if max_items is not None and len(data) > max_items: data = data[-max_items:]
+        return data
+
+    # get up to count [timestamp, value] entries between two timestamps, reading the sealed history one day at a time
+    def get_page(self, key, start, end, count, formatter=None):
+        sealed = self.get_sealed(key)
+        if sealed is None or start > sealed[1]: return self.module.db.get_page(key, start, end, count, formatter)
+        # skip the time before the earliest value
+        first = self.module.db.get_by_position(key, 0, 0, withscores=True)
+        start = max(start, min(sealed[0], first[0][0]) if len(first) > 0 else sealed[0])
+        rows = []
+        while len(rows) < count and start <= end:
+            if start > sealed[1]:
+                rows = rows + self.module.db.get_page(key, start, end, count-len(rows), formatter)
+                break
+            day_end = min(self.module.date.day_end(start), end)
+            rows = rows + self.get_by_timeframe(key, start, day_end, withscores=True, formatter=formatter)[:count-len(rows)]
+            start = day_end+1
+        return rows
+
+    # return True if the given range of positions can be served by the live data only
+    def is_live(self, key, start, end):
+        if self.get_sealed(key) is None: return True
+        # positions counted from the end within the live data
+        return start < 0 and end < 0 and self.module.db.aggregate(key, "count", start, end, True) == end-start+1
+
+    # get a range of values based on the position, counting the sealed history as well
+    def get_by_position(self, key, start=-1, end=-1, withscores=True, milliseconds=False, format_date=False, formatter=None, max_items=None, max_points=None, downsample="avg"):
+        if self.is_live(key, start, end):
+            return self.module.db.get_by_position(key, start, end, withscores, milliseconds, format_date, formatter, max_items, max_points, downsample)
+        positions = self.resolve(key, start, end)
+        if positions is None:
+            # merge the whole history
+            sealed = self.get_sealed(key)
+            latest = self.module.db.get_by_position(key, -1, -1, withscores=True)
+            last = max(latest[0][0], sealed[1]) if len(latest) > 0 else sealed[1]
+            points = self.get_by_timeframe(key, sealed[0], last, withscores=True, formatter=formatter)
+            if start < 0: start = max(len(points)+start, 0)
+            if end < 0: end = len(points)+end
+            points = points[start:end+1]
+        else:
+            # the sealed values come first, followed by the live ones
+            start, end, sealed_count = positions
+            points = []
+            if start <= end and start < sealed_count:
+                points = [[timestamp, value if formatter is None else sdk.python.utils.numbers.normalize(value, formatter)] for timestamp, value in self.read_by_position(key, start, min(end, sealed_count-1))]
+            if start <= end and end >= sealed_count:
+                points = points + self.module.db.get_by_position(key, max(start-sealed_count, 0), end-sealed_count, withscores=True, formatter=formatter)
+        if max_points is not None: points = db_downsample.downsample(points, max_points, downsample, total=len(points))
+        data = db_downsample.format_points(points, withscores, milliseconds, format_date, self.module.date)
+        if max_items is not None and len(data) > max_items: data = data[-max_items:]
+        return data
+
+    # calculate an aggregation (count, avg, min, max, sum) of the values between two timestamps or positions, counting the sealed history as well
+    def aggregate(self, key, aggregation, start=None, end=None, by_position=False):
+        sealed = self.get_sealed(key)
+        if by_position:
+            if self.is_live(key, start, end): return self.module.db.aggregate(key, aggregation, start, end, by_position)
+            positions = self.resolve(key, start, end)
+            if positions is not None:
+                if aggregation == "count": return max(positions[1]-positions[0]+1, 0)
+                # let the database calculate the aggregation if the positions are all within the live data
+                if positions[0] >= positions[2]: return self.module.db.aggregate(key, aggregation, positions[0]-positions[2], positions[1]-positions[2], by_position)
+            points = self.get_by_position(key, start, end, withscores=True)
+        else:
+            if start is None: start = self.module.date.now()-24*3600
+            if end is None: end = self.module.date.now()
+            # let the database calculate the aggregation if nothing has been sealed within the timeframe
+            if sealed is None or start > sealed[1] or end < sealed[0]: return self.module.db.aggregate(key, aggregation, start, end, by_position)
+            points = self.get_by_timeframe(key, start, end, withscores=True)
+        if aggregation == "count": return len(points)
+        values = [point[1] for point in points if db_downsample.is_numeric(point)]
+        if len(values) == 0: return None
+        if aggregation == "avg": return sum(values)/len(values)
+        if aggregation == "min": return min(values)
+        if aggregation == "max": return max(values)
+        return sum(values)
+
+    # stop sealing the history of the given key since retained by count, moving back to the live data the latest values already sealed
+    def retain_by_count(self, key, count):
+        if key in self.retained or not self.is_candidate(key): return
+        self.retained.add(key)
+        with self.module.primary_reads():
+            self.unseal(key, count)
+
+    # move back to the live data up to the given number of the latest sealed values of the given key
+    def unseal(self, key, count):
+        sealed = self.get_sealed(key)
+        if sealed is None: return
+        # values saved again after their day has been sealed are already in the live data
+        live = set([point[0] for point in self.module.db.get_by_timeframe(key, sealed[0], sealed[1], withscores=True)])
+        points = [point for point in self.read(key, sealed[0], sealed[1]) if point[0] not in live][-count:]
+        for timestamp, value in points: self.module.db.set_series(key, value, timestamp)
+        self.module.db.delete(key+"/blocks")
+        self.forget(key)
+        self.module.log_debug("moved "+str(len(points))+" sealed values of "+key+" back to the live data since retained by count")
+
+    # seal the closed days of the given key into blocks, reading from the primary the data about to be replaced. Return the number of values sealed
+    def compact(self, key):
+        if key in self.unsealable or key in self.retained: return 0
+        with self.module.primary_reads():
+            return self.seal_days(key)
+
+    # seal the closed days of the given key one at a time. Return the number of values sealed
+    def seal_days(self, key):
+        latest = self.module.db.get_by_position(key, -1, -1, withscores=True)
+        if len(latest) == 0: return 0
+        # the current day and the day of the latest value are not sealed, so the latest value is always in the live data
+        until = min(self.module.date.day_start(self.module.date.now()), self.module.date.day_start(latest[0][0]))
+        total = 0
+        while not self.module.stopping:
+            first = self.module.db.get_by_position(key, 0, 0, withscores=True)
+            if len(first) == 0 or first[0][0] >= until: break
+            count = self.seal(key, self.module.date.day_start(first[0][0]), self.module.date.day_end(first[0][0]))
+            if count is None:
+                self.module.log_debug("unable to seal "+key+" since holding non numeric values")
+                self.unsealable.add(key)
+                break
+            total = total + count
+        return total
+
+    # seal the values of the given day into a block, merging them with the block already sealed for the same day if any.
+    # Return the number of values sealed, None if the values are not numeric
+    def seal(self, key, start, end):
+        data = self.module.db.get_by_timeframe(key, start, end, withscores=True)
+        if len(data) == 0: return 0
+        points = {}
+        for timestamp, value in self.read(key, start, end): points[timestamp] = value
+        for point in data:
+            if not db_downsample.is_numeric(point): return None
+            points[point[0]] = point[1]
+        points = [[timestamp, points[timestamp]] for timestamp in sorted(points.keys())]
+        # replace the block of the day and only then delete the values sealed
+        self.module.db.delete_by_timeframe(key+"/blocks", start, end)
+        self.module.db.set_series(key+"/blocks", db_gorilla.encode(points), points[-1][0])
+        self.module.db.delete_by_timeframe(key, start, end)
+        self.sealed.pop(key, None)
+        # keep the number of values of the blocks up to date, replacing the block of the day
+        if key in self.counts:
+            counts = [block for block in self.counts[key] if block[1] < start or block[1] > end]
+            bisect.insort(counts, (points[0][0], points[-1][0], len(points)))
+            self.counts[key] = counts
+        return len(data)
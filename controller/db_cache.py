@@ -0,0 +1,56 @@
+# controller/db: cache of the results of the queries, invalidated whenever the data of their key changes
+
+import re
+import threading
+import collections
+
+class Db_cache():
+    def __init__(self, module, size=1000):
+        self.module = module
+        # maximum number of results to keep, the least recently used are evicted first
+        self.size = size
+        # map a query (starting with its key) with the generation of the key when run and its result
+        self.entries = collections.OrderedDict()
+        # map a key with its generation, increased at every change of its data
+        self.generations = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    # return the current generation of the given key
+    def generation(self, key):
+        return self.generations.get(key, 0)
+
+    # signal the data of the given key has changed. Changes to the sealed blocks of a key affect the key itself
+    def bump(self, key):
+        key = re.sub("/blocks$", "", key)
+        with self.lock:
+            self.generations[key] = self.generations.get(key, 0) + 1
+
+    # return a copy of the cached result of the given query, None if not cached or the data of its key has changed since
+    def get(self, query):
+        with self.lock:
+            entry = self.entries.pop(query, None)
+            if entry is None or entry[0] != self.generations.get(query[0], 0):
+                self.misses = self.misses + 1
+                return None
+            # keep track this is the most recently used
+            self.entries[query] = entry
+            self.hits = self.hits + 1
+            return self.copy(entry[1])
+
+    # cache a copy of the result of the given query, run when its key was at the given generation
+    def set(self, query, generation, data):
+        if self.size <= 0: return
+        with self.lock:
+            self.entries.pop(query, None)
+            self.entries[query] = (generation, self.copy(data))
+            while len(self.entries) > self.size: self.entries.popitem(last=False)
+
+    # copy a result so that changes made by the caller do not affect the cache
+    def copy(self, data):
+        return [list(item) if isinstance(item, list) else item for item in data]
+
+    # return the statistics of the cache
+    def stats(self):
+        return {"cache_hits": self.hits, "cache_misses": self.misses, "cache_entries": len(self.entries)}
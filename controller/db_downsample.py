@@ -0,0 +1,86 @@
+# controller/db: downsampling of timeseries streamed out of the database
+
+# group an ordered stream of [timestamp, value] points into buckets, yielding the list of points of each bucket. bucket_of(i, point) returns the bucket of the i-th point
+def buckets(points, bucket_of):
+    current = None
+    group = []
+    for i, point in enumerate(points):
+        bucket = bucket_of(i, point)
+        if bucket != current and len(group) > 0:
+            yield group
+            group = []
+        current = bucket
+        group.append(point)
+    if len(group) > 0: yield group
+
+# return True if the value of the point can be downsampled
+def is_numeric(point):
+    return isinstance(point[1], (int, long, float)) and not isinstance(point[1], bool)
+
+# replace each bucket with a single point with the average timestamp and value
+def bucket_avg(groups):
+    for group in groups:
+        numbers = [point for point in group if is_numeric(point)]
+        # nothing to average, keep the latest point of the bucket
+        if len(numbers) == 0:
+            yield group[-1]
+            continue
+        timestamp = sum([point[0] for point in numbers])/len(numbers)
+        value = sum([float(point[1]) for point in numbers])/len(numbers)
+        yield [int(timestamp), value]
+
+# select from each bucket the point forming the largest triangle with the point selected in the previous bucket and the average of the next bucket (largest triangle three buckets)
+def bucket_lttb(groups):
+    current = next(groups, None)
+    if current is None: return
+    # the first point is always kept
+    previous = current[0]
+    yield previous
+    current = current[1:]
+    for following in groups:
+        if len(current) > 0:
+            avg_x = sum([float(point[0]) for point in following])/len(following)
+            avg_y = sum([float(point[1]) for point in following])/len(following)
+            selected = max(current, key=lambda point: abs((previous[0]-avg_x)*(point[1]-previous[1]) - (previous[0]-point[0])*(avg_y-previous[1])))
+            yield selected
+            previous = selected
+        current = following
+    # the last point is always kept
+    if len(current) > 0: yield current[-1]
+
+# downsample an ordered stream of [timestamp, value] points into at most max_points points, without loading the stream in memory.
+# points are distributed across buckets by timestamp between start and end or, if total is provided, by their position
+def downsample(points, max_points, mode="avg", start=None, end=None, total=None):
+    if mode == "lttb":
+        points = (point for point in points if is_numeric(point))
+        # a single point cannot hold both the first and the last point, keep the latest
+        if max_points == 1:
+            latest = None
+            for latest in points: pass
+            return [latest] if latest is not None else []
+        # first and last points are kept outside of the buckets
+        count = max(max_points-1, 1)
+        # the buckets are sized on the numeric points only, which have to be counted first
+        if total is not None:
+            points = list(points)
+            total = len(points)
+    else:
+        count = max_points
+    if total is not None:
+        bucket_of = lambda i, point: i*count/max(total, 1)
+    else:
+        span = max(end-start+1, 1)
+        bucket_of = lambda i, point: (point[0]-start)*count/span
+    groups = buckets(points, bucket_of)
+    if mode == "lttb": return list(bucket_lttb(groups))
+    return list(bucket_avg(groups))
+
+# format the timestamps of downsampled [timestamp, value] points the same way the database drivers do
+def format_points(points, withscores, milliseconds, format_date, date):
+    output = []
+    for timestamp, value in points:
+        if format_date: timestamp = date.timestamp2date(timestamp)
+        elif milliseconds: timestamp = timestamp*1000
+        if withscores: output.append([timestamp, value])
+        else: output.append(value)
+    return output
@@ -0,0 +1,82 @@
+# controller/db: compact columnar file format for exporting and importing the history of the sensors
+# file: magic, length-prefixed json header, then a sequence of length-prefixed zlib-compressed chunks
+# chunk: key (relative to the sensor), number of rows, type of the value column ("d" for numbers, "s" for strings), timestamps column, values column
+
+import struct
+import zlib
+import json
+
+# identifies the format and its version
+MAGIC = "EGDB1\n"
+# maximum number of rows of each chunk
+CHUNK_SIZE = 10000
+# length of a None value in a column of strings
+NONE = 0xFFFFFFFF
+
+# return the bytes of a value for a column of strings
+def to_bytes(value):
+    if isinstance(value, unicode): return value.encode("utf-8")
+    return str(value)
+
+# write the header of the file
+def write_header(f, header):
+    data = json.dumps(header)
+    f.write(MAGIC)
+    f.write(struct.pack(">I", len(data)))
+    f.write(data)
+
+# read the header of the file
+def read_header(f):
+    if f.read(len(MAGIC)) != MAGIC: raise Exception("not an export file")
+    length = struct.unpack(">I", f.read(4))[0]
+    return json.loads(f.read(length))
+
+# write a chunk of [timestamp, value] rows of the given key
+def write_chunk(f, key, rows):
+    # timestamps are stored as the difference with the previous one, which compresses well
+    timestamps = [int(row[0]) for row in rows]
+    deltas = [timestamps[0]] + [timestamps[i]-timestamps[i-1] for i in range(1, len(timestamps))]
+    numeric = all([isinstance(row[1], (int, long, float)) and not isinstance(row[1], bool) for row in rows])
+    key = to_bytes(key)
+    payload = [struct.pack(">H", len(key)), key, struct.pack(">Ic", len(rows), "d" if numeric else "s"), struct.pack(">%dq" % len(rows), *deltas)]
+    if numeric:
+        payload.append(struct.pack(">%dd" % len(rows), *[float(row[1]) for row in rows]))
+    else:
+        values = [to_bytes(row[1]) if row[1] is not None else None for row in rows]
+        payload.append(struct.pack(">%dI" % len(rows), *[len(value) if value is not None else NONE for value in values]))
+        payload.append("".join([value for value in values if value is not None]))
+    data = zlib.compress("".join(payload))
+    f.write(struct.pack(">I", len(data)))
+    f.write(data)
+
+# read the chunks of the file one at a time, yielding the key and the [timestamp, value] rows of each
+def read_chunks(f):
+    while True:
+        length = f.read(4)
+        if len(length) == 0: return
+        data = zlib.decompress(f.read(struct.unpack(">I", length)[0]))
+        key_length = struct.unpack_from(">H", data, 0)[0]
+        key = data[2:2+key_length]
+        offset = 2+key_length
+        count, column_type = struct.unpack_from(">Ic", data, offset)
+        offset = offset+5
+        deltas = struct.unpack_from(">%dq" % count, data, offset)
+        offset = offset+8*count
+        timestamps = []
+        timestamp = 0
+        for delta in deltas:
+            timestamp = timestamp+delta
+            timestamps.append(timestamp)
+        if column_type == "d":
+            values = list(struct.unpack_from(">%dd" % count, data, offset))
+        else:
+            lengths = struct.unpack_from(">%dI" % count, data, offset)
+            offset = offset+4*count
+            values = []
+            for length in lengths:
+                if length == NONE:
+                    values.append(None)
+                    continue
+                values.append(data[offset:offset+length])
+                offset = offset+length
+        yield key, [[timestamps[i], values[i]] for i in range(count)]
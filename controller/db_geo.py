@@ -0,0 +1,35 @@
+# controller/db: geospatial index of the sensors holding positions
+
+import json
+from math import radians, cos, sin, asin, sqrt
+
+# radius of the earth in km, as used to calculate the distances
+EARTH_RADIUS = 6367
+# a radius in km covering the whole earth from any point
+ANYWHERE = 20100
+# highest latitude which can be indexed (web mercator, as for redis)
+MAX_LATITUDE = 85.05112878
+# km in a mile
+MILE = 1.609
+
+# return (longitude, latitude) of a position value (json with latitude and longitude), None if not a position or it cannot be indexed
+def parse(value):
+    # cheap checks first since most of the values are not positions
+    if not isinstance(value, basestring) or not value.startswith("{") or "latitude" not in value: return None
+    try:
+        position = json.loads(value)
+        longitude = float(position["longitude"])
+        latitude = float(position["latitude"])
+    except (ValueError, TypeError, KeyError):
+        return None
+    if abs(longitude) > 180 or abs(latitude) > MAX_LATITUDE: return None
+    return (longitude, latitude)
+
+# return the distance in km between two points (haversine formula)
+def distance(longitude1, latitude1, longitude2, latitude2):
+    # convert decimal degrees to radians
+    lon1, lat1, lon2, lat2 = map(radians, [longitude1, latitude1, longitude2, latitude2])
+    dlon = lon2 - lon1
+    dlat = lat2 - lat1
+    a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
+    return EARTH_RADIUS * 2 * asin(sqrt(a))
@@ -0,0 +1,154 @@
+# controller/db: compression of numeric timeseries (delta-of-delta timestamps and XOR floats, as in Facebook's Gorilla)
+
+import struct
+import base64
+
+# prefix of the encoded blocks, with the version of the codec
+PREFIX = "g1:"
+
+# buckets of the delta-of-delta of the timestamps: (control bits, number of control bits, number of value bits)
+BUCKETS = [(0b10, 2, 7), (0b110, 3, 9), (0b1110, 4, 12)]
+
+class BitWriter():
+    def __init__(self):
+        self.data = bytearray()
+        self.current = 0
+        self.count = 0
+
+    # append the lowest bits of the given value
+    def write(self, value, bits):
+        while bits > 0:
+            take = min(8-self.count, bits)
+            self.current = (self.current << take) | ((value >> (bits-take)) & ((1 << take)-1))
+            self.count = self.count + take
+            bits = bits - take
+            if self.count == 8:
+                self.data.append(self.current)
+                self.current = 0
+                self.count = 0
+
+    # return the bytes written so far, padding the last one
+    def getvalue(self):
+        if self.count == 0: return str(self.data)
+        return str(self.data + bytearray([self.current << (8-self.count)]))
+
+class BitReader():
+    def __init__(self, data):
+        self.data = bytearray(data)
+        self.position = 0
+
+    # read the given number of bits as an unsigned integer
+    def read(self, bits):
+        value = 0
+        while bits > 0:
+            offset = self.position % 8
+            take = min(8-offset, bits)
+            byte = self.data[self.position/8]
+            value = (value << take) | ((byte >> (8-offset-take)) & ((1 << take)-1))
+            self.position = self.position + take
+            bits = bits - take
+        return value
+
+# return the 64 bits of a float as an integer
+def float2bits(value):
+    return struct.unpack(">Q", struct.pack(">d", value))[0]
+
+# return the float of the given 64 bits
+def bits2float(bits):
+    return struct.unpack(">d", struct.pack(">Q", bits))[0]
+
+# return the signed value of an integer of the given number of bits
+def signed(value, bits):
+    if value >= 1 << (bits-1): return value - (1 << bits)
+    return value
+
+# encode a list of [timestamp, value] points (ordered by timestamp, numeric values only) into a string
+def encode(points):
+    writer = BitWriter()
+    writer.write(len(points), 32)
+    if len(points) == 0: return PREFIX+base64.b64encode(writer.getvalue())
+    timestamp = int(points[0][0])
+    bits = float2bits(float(points[0][1]))
+    writer.write(timestamp & (2**64-1), 64)
+    writer.write(bits, 64)
+    delta = 0
+    leading = trailing = None
+    for point in points[1:]:
+        # timestamps: store the difference between two consecutive deltas, which is usually zero for periodic measures
+        new_delta = int(point[0])-timestamp
+        dod = new_delta-delta
+        if dod == 0: writer.write(0, 1)
+        else:
+            for control, control_bits, value_bits in BUCKETS:
+                if -(1 << (value_bits-1)) <= dod < 1 << (value_bits-1):
+                    writer.write(control, control_bits)
+                    writer.write(dod & ((1 << value_bits)-1), value_bits)
+                    break
+            else:
+                writer.write(0b1111, 4)
+                writer.write(dod & (2**64-1), 64)
+        timestamp = int(point[0])
+        delta = new_delta
+        # values: store the XOR with the previous value, reusing the previous window of meaningful bits if possible
+        new_bits = float2bits(float(point[1]))
+        xor = new_bits ^ bits
+        bits = new_bits
+        if xor == 0:
+            writer.write(0, 1)
+            continue
+        writer.write(1, 1)
+        new_leading = min(64-len(bin(xor))+2, 31)
+        new_trailing = len(bin(xor))-len(bin(xor).rstrip("0"))
+        if leading is not None and new_leading >= leading and new_trailing >= trailing:
+            writer.write(0, 1)
+            writer.write(xor >> trailing, 64-leading-trailing)
+        else:
+            leading = new_leading
+            trailing = new_trailing
+            writer.write(1, 1)
+            writer.write(leading, 5)
+            writer.write(64-leading-trailing-1, 6)
+            writer.write(xor >> trailing, 64-leading-trailing)
+    return PREFIX+base64.b64encode(writer.getvalue())
+
+# return True if the given value is an encoded block
+def is_block(value):
+    return isinstance(value, basestring) and value.startswith(PREFIX)
+
+# return (number of points, first timestamp) of a string produced by encode(), reading its header only
+def header(value):
+    reader = BitReader(base64.b64decode(value[len(PREFIX):len(PREFIX)+16]))
+    count = reader.read(32)
+    if count == 0: return (0, None)
+    return (count, signed(reader.read(64), 64))
+
+# decode a string produced by encode(), yielding its [timestamp, value] points
+def decode(value):
+    reader = BitReader(base64.b64decode(value[len(PREFIX):]))
+    count = reader.read(32)
+    if count == 0: return
+    timestamp = signed(reader.read(64), 64)
+    bits = reader.read(64)
+    yield [timestamp, bits2float(bits)]
+    delta = 0
+    leading = trailing = 0
+    for i in range(count-1):
+        # timestamps
+        if reader.read(1) == 0: dod = 0
+        else:
+            for control, control_bits, value_bits in BUCKETS:
+                # the leading 1 of the control bits has been already read, a 0 closes them
+                if reader.read(1) == 0:
+                    dod = signed(reader.read(value_bits), value_bits)
+                    break
+            else:
+                dod = signed(reader.read(64), 64)
+        delta = delta+dod
+        timestamp = timestamp+delta
+        # values
+        if reader.read(1) == 1:
+            if reader.read(1) == 1:
+                leading = reader.read(5)
+                trailing = 64-leading-reader.read(6)-1
+            bits = bits ^ (reader.read(64-leading-trailing) << trailing)
+        yield [timestamp, bits2float(bits)]
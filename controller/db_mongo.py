@@ -3,11 +3,14 @@
 import pymongo
 import sys
 import re
+import time
 
 import sdk.python.utils.exceptions as exception
 import sdk.python.utils.numbers
 import sdk.python.utils.strings
 
+import db_downsample
+from db_replicas import Db_replicas
 
 class Db_mongo():
     def __init__(self, module):
@@ -18,7 +21,12 @@ class Db_mongo():
         self.query_debug = False
         self.module = module
         self.db_version = None
-        self.collections = []
+        # catalog of the existing collections, reloaded from the database every catalog_ttl seconds
+        self.collections = set()
+        self.catalog_loaded = None
+        self.catalog_ttl = 300
+        # read replicas
+        self.replicas = None
         
      # connect to the database
     def connect(self):
@@ -30,16 +38,33 @@ class Db_mongo():
         while not self.connected:
             try: 
                 self.module.log_debug("Connecting to database "+str(database)+" at "+hostname+":"+str(port))
-                self.client = pymongo.MongoClient("mongodb://"+username+":"+password+"@"+hostname+":"+str(port)+"/"+str(database))
+                # the replicas (hostname:port) are members of the same replica set
+                hosts = [hostname+":"+str(port)]
+                if "replicas" in self.module.config: hosts = hosts + [replica if ":" in replica else replica+":"+str(port) for replica in self.module.config["replicas"]]
+                self.client = pymongo.MongoClient("mongodb://"+username+":"+password+"@"+",".join(hosts)+"/"+str(database))
                 self.db = self.client[database]
+                self.connect_replicas(database)
                 self.db_version = str(self.client.server_info()["version"])
                 self.module.log_info("Connected to database "+str(database)+" at "+hostname+":"+str(port)+", mongodb version "+self.db_version)
                 self.connected = True
+                self.load_catalog()
             except Exception,e:
                 self.module.log_error("Unable to connect to "+hostname+":"+str(port)+" - "+exception.get(e))
                 self.module.sleep(5)
                 if self.module.stopping: break       
 
+    # prepare the database handle for reading from the replicas
+    def connect_replicas(self, database):
+        read_your_writes = "read_your_writes" in self.module.config and self.module.config["read_your_writes"]
+        self.replicas = Db_replicas(self.module, self.db, read_your_writes)
+        if "replicas" not in self.module.config or len(self.module.config["replicas"]) == 0: return
+        # the driver takes care of load balancing across healthy secondaries and falling back to the primary
+        self.replicas.add("secondary", self.client.get_database(database, read_preference=pymongo.ReadPreference.SECONDARY_PREFERRED))
+
+    # return the database handle to use for reading the given key
+    def reader(self, key=None):
+        return self.replicas.reader(key)
+
     # disconnect from the database
     def disconnect(self):
         if self.connected: self.client.close()
@@ -50,29 +75,121 @@ class Db_mongo():
         if self.query_debug: self.module.log_debug("list_collection_names() "+filter)
         return self.db.list_collection_names(filter={"name": {"$regex": filter}})
 
+    # load the catalog of the existing collections from the database
+    def load_catalog(self):
+        if self.query_debug: self.module.log_debug("list_collection_names()")
+        self.collections = set(self.db.list_collection_names())
+        self.catalog_loaded = time.time()
+
+    # return the catalog of the existing collections, reloading it if expired so to catch changes made by others
+    def catalog(self):
+        if self.catalog_loaded is None or time.time() - self.catalog_loaded > self.catalog_ttl: self.load_catalog()
+        return self.collections
+
+    # create the collection with its index if not existing yet
+    def create_collection(self, key):
+        if key in self.catalog(): return
+        try:
+            self.db.create_collection(key)
+        except pymongo.errors.CollectionInvalid:
+            # the collection has been created in the meantime
+            pass
+        self.db[key].create_index([("timestamp", pymongo.DESCENDING)])
+        self.collections.add(key)
+
+    # create the collection of a geospatial index with its indexes if not existing yet
+    def create_geo_collection(self, key):
+        if key in self.catalog(): return
+        try:
+            self.db.create_collection(key)
+        except pymongo.errors.CollectionInvalid:
+            # the collection has been created in the meantime
+            pass
+        self.db[key].create_index([("location", pymongo.GEOSPHERE)])
+        self.db[key].create_index([("member", pymongo.ASCENDING)], unique=True)
+        self.collections.add(key)
+
     # save a timeseries value to the db
     def set_series(self, key, value, timestamp, log=True):
         if timestamp is None: 
             if log: self.module.log_warning("no timestamp provided for key "+key)
             return 
-        # check if the collection has been hit already (in cache)
-        if key not in self.collections:
-            # check if the collection is already in the database
-            result = self.db.list_collection_names(filter={"name": key})
-            # if not, create the collection and the index
-            if len(result) == 0:
-                self.db.create_collection(key)
-                self.db[key].create_index([("timestamp", pymongo.DESCENDING)])
-                # add it to the cache
-                self.collections.append(key)
+        self.create_collection(key)
         # insert a new document
         document = {
             "timestamp": timestamp,
             "value": str(value),
         }
         if self.query_debug: self.module.log_debug(key+" insert_one() "+str(document))
+        self.replicas.wrote(key)
         self.db[key].insert_one(document)
 
+    # save a timeseries value applying count/new_only retention policies and skipping duplicates. Return saved, replaced, old or duplicate
+    def save(self, key, value, timestamp, retain=None):
+        if timestamp is None: 
+            self.module.log_warning("no timestamp provided for key "+key)
+            return None
+        # if we have to keep up to "count" values, delete old values from the db
+        if retain is not None and "count" in retain:
+            self.delete_by_position(key, 0, -retain["count"])
+        # if only measures with a newer timestamp than the latest can be added, apply the policy
+        if retain is not None and "new_only" in retain and retain["new_only"]:
+            last = self.db[key].find_one({}, sort=[("timestamp", pymongo.DESCENDING)])
+            if last is not None and timestamp <= last["timestamp"]: return "old"
+        # check if there is already something stored with the same timestamp
+        status = "saved"
+        old = self.db[key].find_one({"timestamp": timestamp})
+        if old is not None:
+            if old["value"] == str(value): return "duplicate"
+            # same timestamp but different value, remove the old value so to store the new one
+            self.delete_by_timeframe(key, timestamp, timestamp)
+            status = "replaced"
+        self.set_series(key, value, timestamp)
+        return status
+
+    # save multiple timeseries values (list of key, value, timestamp, retain) with a bulk write for each key. Return the status of each save
+    def save_batch(self, records):
+        statuses = [None]*len(records)
+        # group the records by key
+        keys = {}
+        for i, record in enumerate(records):
+            if record[0] not in keys: keys[record[0]] = []
+            keys[record[0]].append(i)
+        for key, indexes in keys.iteritems():
+            self.create_collection(key)
+            timestamps = [records[i][2] for i in indexes]
+            # retrieve with a single query what is already stored within the timeframe of the batch and the latest timestamp
+            stored = {}
+            for document in self.db[key].find({"timestamp": {"$gte": min(timestamps), "$lte": max(timestamps)}}):
+                stored[document["timestamp"]] = document["value"]
+            last = self.db[key].find_one({}, sort=[("timestamp", pymongo.DESCENDING)])
+            last_timestamp = last["timestamp"] if last is not None else None
+            # apply the same policies of save() to each record, in order
+            operations = []
+            count = None
+            for i in indexes:
+                key, value, timestamp, retain = records[i]
+                if retain is not None and "count" in retain: count = retain["count"]
+                if retain is not None and "new_only" in retain and retain["new_only"] and last_timestamp is not None and timestamp <= last_timestamp:
+                    statuses[i] = "old"
+                    continue
+                statuses[i] = "saved"
+                if timestamp in stored:
+                    if stored[timestamp] == str(value):
+                        statuses[i] = "duplicate"
+                        continue
+                    operations.append(pymongo.DeleteMany({"timestamp": timestamp}))
+                    statuses[i] = "replaced"
+                operations.append(pymongo.InsertOne({"timestamp": timestamp, "value": str(value)}))
+                stored[timestamp] = str(value)
+                if last_timestamp is None or timestamp > last_timestamp: last_timestamp = timestamp
+            if self.query_debug: self.module.log_debug(key+" bulk_write() "+str(len(operations))+" operations")
+            self.replicas.wrote(key)
+            if len(operations) > 0: self.db[key].bulk_write(operations, ordered=True)
+            # if we have to keep up to "count" values, delete old values from the db
+            if count is not None: self.delete_by_position(key, 0, -(count+1))
+        return statuses
+
     # set a single value into the db
     def set_value(self, key, value):
         # delete the collection first
@@ -83,18 +200,21 @@ class Db_mongo():
         }
         if self.query_debug: self.module.log_debug(key+" insert_one() "+str(document))
         self.db[key].insert_one(document)
+        self.collections.add(key)
 
     # get a single value from the db
     def get_value(self, key):
         if self.query_debug: self.module.log_debug("find_one() "+key)
         result = self.db[key].find_one()
+        if result is None: return None
         if result != "": return result["value"]
         else: return ""
 
     # get a range of values from the db based on the timestamp
-    def get_by_timeframe(self, key, start=None, end=None, withscores=True, milliseconds=False, format_date=False, formatter=None, max_items=None):
+    def get_by_timeframe(self, key, start=None, end=None, withscores=True, milliseconds=False, format_date=False, formatter=None, max_items=None, max_points=None, downsample="avg"):
         if start is None: start = self.module.date.now()-24*3600
         if end is None: end = self.module.date.now()
+        bounded = start not in ["-inf", "+inf"] and end not in ["-inf", "+inf"]
         if start == "-inf": start = 0
         if start == "+inf": start = sys.maxint
         if end == "-inf": end = 0
@@ -105,14 +225,74 @@ class Db_mongo():
                 {"timestamp" : {"$lte": end}}
             ]
         }
-        if self.query_debug: self.module.log_debug("find() "+key+" "+str(start)+" "+str(end))
-        result = list(self.db[key].find(filter))
-        data = self.normalize_dataset(result, withscores, milliseconds, format_date, formatter)
+        # if requested, stream the range out of the db and downsample it
+        db = self.reader(key)
+        if max_points is not None:
+            points = self.normalize_entries(self.iterate_by_timeframe(key, start, end), True, False, False, formatter)
+            if bounded: data = db_downsample.downsample(points, max_points, downsample, start=start, end=end)
+            else: data = db_downsample.downsample(points, max_points, downsample, total=db[key].count_documents(filter))
+            data = db_downsample.format_points(data, withscores, milliseconds, format_date, self.module.date)
+        else:
+            if self.query_debug: self.module.log_debug("find() "+key+" "+str(start)+" "+str(end))
+            result = list(db[key].find(filter))
+            data = self.normalize_dataset(result, withscores, milliseconds, format_date, formatter)
         if max_items is not None and len(data) > max_items: data = data[-max_items:]
         return data
         
+    # get up to count [timestamp, value] entries between two timestamps, reading only the requested page from the db
+    def get_page(self, key, start, end, count, formatter=None):
+        if self.query_debug: self.module.log_debug("find() "+key+" "+str(start)+" "+str(end)+" limit "+str(count))
+        result = self.reader(key)[key].find({"timestamp": {"$gte": start, "$lte": end}}).sort("timestamp", pymongo.ASCENDING).limit(count)
+        return self.normalize_dataset(result, True, False, False, formatter)
+
+    # run multiple plain queries (list of key, start, end, by_position, formatter) within a single aggregation, joining the collections of the keys with $unionWith.
+    # Return the [timestamp, value] entries of each
+    def get_many(self, queries):
+        # $unionWith requires mongodb 4.4, run the queries one at a time otherwise
+        if self.db_version is None or [int(part) for part in self.db_version.split(".")[0:2]] < [4, 4]:
+            return [self.get_by_position(key, start, end, withscores=True, formatter=formatter) if by_position else self.get_by_timeframe(key, start, end, withscores=True, formatter=formatter) for key, start, end, by_position, formatter in queries]
+        db = self.reader([request[0] for request in queries])
+        pipelines = []
+        for i, (key, start, end, by_position, formatter) in enumerate(queries):
+            if by_position and start < 0 and end < 0:
+                # start from the end, including the latest item
+                if abs(start) < abs(end): continue
+                pipeline = [{"$sort": {"timestamp": pymongo.DESCENDING}}, {"$skip": abs(end+1)}, {"$limit": abs(start)-abs(end)+1}]
+            else:
+                if by_position:
+                    bounds = self.resolve_positions(key, start, end, db)
+                    if bounds is None: continue
+                    start, end = bounds
+                if start == "-inf": start = 0
+                if start == "+inf": start = sys.maxint
+                if end == "-inf": end = 0
+                if end == "+inf": end = sys.maxint
+                pipeline = [{"$match": {"timestamp": {"$gte": start, "$lte": end}}}]
+            # tag each document with the query it belongs to
+            pipelines.append((key, pipeline+[{"$addFields": {"query": i}}]))
+        results = [[] for request in queries]
+        if len(pipelines) == 0: return results
+        pipeline = pipelines[0][1]+[{"$unionWith": {"coll": key, "pipeline": subpipeline}} for key, subpipeline in pipelines[1:]]
+        if self.query_debug: self.module.log_debug("aggregate() "+pipelines[0][0]+" "+str(pipeline))
+        for document in db[pipelines[0][0]].aggregate(pipeline):
+            results[document["query"]].append(document)
+        for result in results: result.sort(key=lambda document: document["timestamp"])
+        return [self.normalize_dataset(results[i], True, False, False, queries[i][4]) for i in range(len(queries))]
+
     # get a range of values from the db
-    def get_by_position(self, key, start=-1, end=-1, withscores=True, milliseconds=False, format_date=False, formatter=None, max_items=None):
+    def get_by_position(self, key, start=-1, end=-1, withscores=True, milliseconds=False, format_date=False, formatter=None, max_items=None, max_points=None, downsample="avg"):
+        db = self.reader(key)
+        # if requested, stream the range out of the db through the cursor between the timestamps of its first and last position and downsample it
+        if max_points is not None:
+            bounds = self.resolve_positions(key, start, end, db)
+            if bounds is None: return []
+            filter = {"timestamp": {"$gte": bounds[0], "$lte": bounds[1]}}
+            if self.query_debug: self.module.log_debug("find() "+key+" "+str(bounds[0])+" "+str(bounds[1])+" ASC")
+            points = self.normalize_entries(db[key].find(filter).sort("timestamp", pymongo.ASCENDING).batch_size(1000), True, False, False, formatter)
+            data = db_downsample.downsample(points, max_points, downsample, total=db[key].count_documents(filter))
+            data = db_downsample.format_points(data, withscores, milliseconds, format_date, self.module.date)
+            if max_items is not None and len(data) > max_items: data = data[-max_items:]
+            return data
         # if requested from the end, sort by timestamp in desending order and use skip and limit to get the values
         if start < 0 and end < 0: 
             # start from the end, including the latest item
@@ -120,37 +300,155 @@ class Db_mongo():
             # limit by tje difference between start and end
             limit = abs(start)-abs(end)+1
             if self.query_debug: self.module.log_debug("find() "+key+" DESC skip "+str(skip)+" limit "+str(limit))
-            result = list(self.db[key].find().sort("timestamp", pymongo.DESCENDING).skip(skip).limit(limit))
-        # otherwise get all the data and use the array positions to get the requested values
+            result = list(db[key].find().sort("timestamp", pymongo.DESCENDING).skip(skip).limit(limit))
+            # return the values in chronological order
+            result.reverse()
+        # otherwise resolve the positions into timestamps and query the range
         else:
-            self.module.log_warning("not optimized query get_by_position("+key+","+str(start)+","+str(end)+")")
-            include_last = False
-            # include the boundary
-            if end >= 0 or (end < 0 and end != -1): 
-                end = end+1
-            # end is -1 so cannot include it directly (would be 0)
-            if end == -1: 
-                include_last = True
-            if self.query_debug: self.module.log_debug("find() "+key+" start "+str(start)+" end "+str(end))
-            all_values = list(self.db[key].find())
-            result = all_values[start:end]
-            # if include the latest value, add it to the result
-            if include_last and len(all_values) > 0: 
-                result+[all_values[-1]]
+            bounds = self.resolve_positions(key, start, end, db)
+            if bounds is None: result = []
+            else:
+                if self.query_debug: self.module.log_debug("find() "+key+" "+str(bounds[0])+" "+str(bounds[1])+" ASC")
+                result = list(db[key].find({"timestamp": {"$gte": bounds[0], "$lte": bounds[1]}}).sort("timestamp", pymongo.ASCENDING))
         data = self.normalize_dataset(result, withscores, milliseconds, format_date, formatter)
         if max_items is not None and len(data) > max_items: data = data[-max_items:]
         return data
 
+    # return the timestamp of the document at the given position (negative positions count from the end) reading from the given database handle (the primary by default), None if out of range
+    def resolve_position(self, key, position, db=None):
+        if db is None: db = self.db
+        if position >= 0: 
+            order = pymongo.ASCENDING
+            skip = position
+        else:
+            order = pymongo.DESCENDING
+            skip = abs(position)-1
+        if self.query_debug: self.module.log_debug("find() "+key+" "+("ASC" if order == pymongo.ASCENDING else "DESC")+" skip "+str(skip)+" limit 1")
+        result = list(db[key].find({}, {"timestamp": 1}).sort("timestamp", order).skip(skip).limit(1))
+        if len(result) == 0: return None
+        return result[0]["timestamp"]
+
+    # translate a range of positions into a (start, end) range of timestamps, using the index on the timestamp. Return None if the range is empty
+    def resolve_positions(self, key, start, end, db=None):
+        start_timestamp = self.resolve_position(key, start, db)
+        if start_timestamp is None:
+            # a start before the first document is the first document, after the last one the range is empty
+            if start >= 0: return None
+            start_timestamp = self.resolve_position(key, 0, db)
+            if start_timestamp is None: return None
+        end_timestamp = self.resolve_position(key, end, db)
+        if end_timestamp is None:
+            # an end after the last document is the last document, before the first one the range is empty
+            if end < 0: return None
+            end_timestamp = self.resolve_position(key, -1, db)
+            if end_timestamp is None: return None
+        if start_timestamp > end_timestamp: return None
+        return (start_timestamp, end_timestamp)
+
+    # calculate within the database an aggregation (count, avg, min, max, sum) of the values between two timestamps or positions
+    def aggregate(self, key, aggregation, start=None, end=None, by_position=False):
+        db = self.reader(key)
+        pipeline = []
+        if not by_position:
+            if start is None: start = self.module.date.now()-24*3600
+            if end is None: end = self.module.date.now()
+            if start == "-inf": start = 0
+            if end == "+inf": end = sys.maxint
+            filter = {"timestamp": {"$gte": start, "$lte": end}}
+            if aggregation == "count": 
+                if self.query_debug: self.module.log_debug("count_documents() "+key+" "+str(filter))
+                return db[key].count_documents(filter)
+            pipeline.append({"$match": filter})
+        else:
+            # select the documents between the two positions, counting from the end when both are negative
+            total = None
+            if start < 0 and end < 0: 
+                pipeline = [{"$sort": {"timestamp": pymongo.DESCENDING}}, {"$skip": abs(end+1)}, {"$limit": abs(start)-abs(end)+1}]
+            else:
+                total = db[key].count_documents({})
+                if start < 0: start = max(total+start, 0)
+                if end < 0: end = total+end
+                if end < start: return 0 if aggregation == "count" else None
+                pipeline = [{"$sort": {"timestamp": pymongo.ASCENDING}}, {"$skip": start}, {"$limit": end-start+1}]
+            if aggregation == "count" and total is not None: return max(min(end, total-1)-start+1, 0)
+        if aggregation == "count":
+            pipeline.append({"$count": "value"})
+        else:
+            # values are stored as strings, convert them into numbers ignoring those which are not
+            pipeline.append({"$project": {"value": {"$convert": {"input": "$value", "to": "double", "onError": None, "onNull": None}}}})
+            pipeline.append({"$match": {"value": {"$ne": None}}})
+            pipeline.append({"$group": {"_id": None, "value": {"$"+aggregation: "$value"}}})
+        if self.query_debug: self.module.log_debug("aggregate() "+key+" "+str(pipeline))
+        result = list(db[key].aggregate(pipeline))
+        if len(result) == 0: return 0 if aggregation == "count" else None
+        return result[0]["value"]
+
+    # iterate over the raw entries between two timestamps, reading them from the db in batches through a cursor
+    def iterate_by_timeframe(self, key, start, end, chunk=1000):
+        if self.query_debug: self.module.log_debug("find() "+key+" "+str(start)+" "+str(end)+" ASC")
+        return self.reader(key)[key].find({"timestamp": {"$gte": start, "$lte": end}}).sort("timestamp", pymongo.ASCENDING).batch_size(chunk)
+
+    # get the latest value of a key as (timestamp, raw entry) reading from the given database handle (a replica by default), None if the key is empty
+    def get_latest(self, key, db=None):
+        if db is None: db = self.reader(key)
+        if self.query_debug: self.module.log_debug("find_one() "+key+" DESC")
+        document = db[key].find_one({}, sort=[("timestamp", pymongo.DESCENDING)])
+        if document is None: return None
+        return (document["timestamp"], document)
+
+    # build a raw entry (as returned by the database) out of a value, to be normalized with normalize_dataset()
+    def make_entry(self, value, timestamp):
+        return {"timestamp": timestamp, "value": str(value)}
+
+    # add or update the members (list of member, longitude, latitude) of a geospatial index
+    def geo_add(self, key, locations):
+        self.create_geo_collection(key)
+        operations = [pymongo.ReplaceOne({"member": member}, {"member": member, "location": {"type": "Point", "coordinates": [longitude, latitude]}}, upsert=True) for member, longitude, latitude in locations]
+        if self.query_debug: self.module.log_debug(key+" bulk_write() "+str(len(operations))+" operations")
+        self.replicas.wrote(key)
+        self.db[key].bulk_write(operations, ordered=False)
+
+    # return [member, distance in km] of the members of a geospatial index within the given radius in km (anywhere if None) from a point, nearest first.
+    # Optionally return up to count members and only the members matching the given query
+    def geo_radius(self, key, longitude, latitude, radius=None, count=None, query=None):
+        # $geoNear requires the geospatial index
+        if key not in self.catalog(): return []
+        near = {"near": {"type": "Point", "coordinates": [longitude, latitude]}, "distanceField": "distance", "spherical": True}
+        if radius is not None: near["maxDistance"] = radius*1000
+        if query is not None: near["query"] = query
+        pipeline = [{"$geoNear": near}]
+        if count is not None: pipeline.append({"$limit": count})
+        pipeline.append({"$project": {"_id": 0, "member": 1, "distance": 1}})
+        if self.query_debug: self.module.log_debug("aggregate() "+key+" "+str(pipeline))
+        return [[document["member"], document["distance"]/1000] for document in self.reader(key)[key].aggregate(pipeline)]
+
+    # return [timestamp, distance in km] from a point of the members of a geospatial index (timestamps) saved into the given timeseries between start and end
+    def geo_distances(self, key, series_key, longitude, latitude, start, end):
+        return sorted(self.geo_radius(key, longitude, latitude, query={"member": {"$gte": start, "$lte": end}}))
+
+    # delete from a geospatial index the (numeric) members lower than the given one. Return the number of members deleted
+    def geo_trim(self, key, before):
+        if self.query_debug: self.module.log_debug("delete_many() "+key+" member < "+str(before))
+        return self.db[key].delete_many({"member": {"$lt": before}}).deleted_count
+
+    # delete the given members from a geospatial index
+    def geo_remove(self, key, members):
+        if self.query_debug: self.module.log_debug("delete_many() "+key+" "+str(members))
+        return self.db[key].delete_many({"member": {"$in": members}}).deleted_count
+
     # delete a key
     def delete(self, key):
         if self.query_debug: self.module.log_debug("drop() "+key)
-        if key in self.collections: self.collections.remove(key)
+        self.collections.discard(key)
         return self.db[key].drop()
 
     # rename a key
     def rename(self, key,new_key):
         if self.query_debug: self.module.log_debug("rename() "+key+" "+new_key)
-        return self.db[key].rename(new_key)
+        result = self.db[key].rename(new_key)
+        self.collections.discard(key)
+        self.collections.add(new_key)
+        return result
 
     # delete all elements between a given score
     def delete_by_timeframe(self, key, start, end):
@@ -168,6 +466,14 @@ class Db_mongo():
         result = self.db[key].delete_many(filter)
         return result.deleted_count
 
+    # delete the elements between the given timestamps of multiple keys (list of key, start, end), skipping those not existing. Return the number of elements deleted from each key
+    def delete_by_timeframe_batch(self, ranges):
+        deleted = []
+        for key, start, end in ranges:
+            if self.exists(key): deleted.append(self.delete_by_timeframe(key, start, end))
+            else: deleted.append(0)
+        return deleted
+
     # delete all elements between a given rank
     def delete_by_position(self, key, start, end):
         # if requested from the end, sort by timestamp in desending order and use skip and limit to get the values
@@ -178,21 +484,11 @@ class Db_mongo():
             limit = abs(start)-abs(end)+1
             if self.query_debug: self.module.log_debug("find() "+key+" DESC skip "+str(skip)+" limit "+str(limit))
             result = list(self.db[key].find({}, {'_id': 1}).sort("timestamp", pymongo.DESCENDING).skip(skip).limit(limit))
-        # otherwise get all the data and use the array positions to get the requested values
+        # otherwise resolve the positions into timestamps and delete the range
         else:
-            include_last = False
-            # include the boundary
-            if end >= 0 or (end < 0 and end != -1): 
-                end = end+1
-            # end is -1 so cannot include it directly (would be 0)
-            if end == -1: 
-                include_last = True
-            if self.query_debug: self.module.log_debug("find() "+key+" start "+str(start)+" end "+str(end))
-            all_values = list(self.db[key].find())
-            result = all_values[start:end]
-            # if include the latest value, add it to the result
-            if include_last and len(all_values) > 0: 
-                result+[all_values[-1]]
+            bounds = self.resolve_positions(key, start, end)
+            if bounds is None: return 0
+            return self.delete_by_timeframe(key, bounds[0], bounds[1])
         # delete each document
         ids = []
         for item in result: ids.append(item["_id"])
@@ -203,9 +499,7 @@ class Db_mongo():
     # check if a key exists
     def exists(self, key):
         if self.query_debug: self.module.log_debug("exists "+key)
-        collections = self.db.list_collection_names()
-        if key in collections: return True
-        return False
+        return key in self.catalog()
 
     # empty the database
     def flushdb(self):
@@ -213,27 +507,44 @@ class Db_mongo():
         collections = self.db.list_collection_names()
         for collection in collections:
             self.db[collection].drop()
+        self.collections = set()
         
-    # generate database statistics (key, #items, latest timestamp, earliest timestamp, latest value)
-    def stats(self):
+    # generate statistics of the whole database (size, type, version)
+    def database_stats(self):
         output = {}
-        output["keys"] = []
-        keys = self.keys("*")
-        for key in sorted(keys):
-            first = self.db[key].find_one({"timestamp": {"$exists": True}}, sort=[("timestamp", pymongo.ASCENDING)])
-            last = self.db[key].find_one({"timestamp": {"$exists": True}}, sort=[("timestamp", pymongo.DESCENDING)])
-            if first is None or last is None or "timestamp" not in first or "timestamp" not in last: continue
-            start = first["timestamp"]
-            end = last["timestamp"]
-            value = last["value"]
-            key_stats = self.db.command("collstats", key)
-            output["keys"].append([key, self.db[key].count(), key_stats["size"], start, end, sdk.python.utils.strings.truncate(value, 300)])
         db_stats = self.db.command("dbstats")
         output["database_size"] = db_stats["dataSize"]
         output["database_type"] = self.module.config["type"]
         output["database_version"] = self.db_version
         return output
 
+    # return a page of the sorted keys of the catalog starting from the given offset, together with the offset of the next page (0 when done)
+    def catalog_page(self, cursor, count, prefix):
+        keys = sorted([key for key in self.catalog() if prefix is None or key.startswith(prefix)])
+        page = keys[cursor:cursor+count]
+        cursor = cursor+count if cursor+count < len(keys) else 0
+        return cursor, page
+
+    # generate the statistics of a page of keys (key, #items, size, earliest timestamp, latest timestamp, latest value) starting from the given cursor (0 to start).
+    # Return the cursor of the next page (0 when done) and the statistics
+    def stats_page(self, cursor=0, count=500, prefix=None):
+        cursor, keys = self.catalog_page(cursor, count, prefix)
+        db = self.reader()
+        output = []
+        for key in keys:
+            if key.startswith("system."): continue
+            # items and size come from the storage statistics, without scanning the collection
+            if self.query_debug: self.module.log_debug("aggregate() "+key+" $collStats")
+            storage = list(db[key].aggregate([{"$collStats": {"storageStats": {}}}]))
+            if len(storage) == 0: continue
+            storage = storage[0]["storageStats"]
+            # earliest and latest timestamp come from the index
+            first = db[key].find_one({"timestamp": {"$exists": True}}, sort=[("timestamp", pymongo.ASCENDING)])
+            last = db[key].find_one({"timestamp": {"$exists": True}}, sort=[("timestamp", pymongo.DESCENDING)])
+            if first is None or last is None: continue
+            output.append([key, storage["count"], storage["size"], first["timestamp"], last["timestamp"], sdk.python.utils.strings.truncate(last["value"], 300)])
+        return cursor, output
+
     # initialize an empty database
     def init_database(self):
         version = None
@@ -256,7 +567,10 @@ class Db_mongo():
         
     # normalize the output
     def normalize_dataset(self, data, withscores, milliseconds, format_date, formatter):
-        output = []
+        return list(self.normalize_entries(data, withscores, milliseconds, format_date, formatter))
+
+    # normalize the output one entry at a time
+    def normalize_entries(self, data, withscores, milliseconds, format_date, formatter):
         for entry in data:
             # get the timestamp 
             timestamp = int(entry["timestamp"])
@@ -273,6 +587,5 @@ class Db_mongo():
             # normalize "None" in null
             if value == "None": value = None
             # prepare the output
-            if (withscores): output.append([timestamp, value])
-            else: output.append(value)
-        return output
+            if (withscores): yield [timestamp, value]
+            else: yield value
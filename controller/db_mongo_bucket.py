@@ -0,0 +1,482 @@
+# controller/db: database driver for MongoDB storing the timeseries into bucket documents
+
+import pymongo
+import sys
+import re
+import time
+import itertools
+
+import sdk.python.utils.exceptions as exception
+import sdk.python.utils.numbers
+import sdk.python.utils.strings
+
+import db_downsample
+from db_mongo import Db_mongo
+
+# instead of a collection for each key with a document for each measure, the measures of all the keys are stored in a single collection
+# as bucket documents ({key, start, samples: [{timestamp, value}]}), each holding the measures of a key within a time span in chronological order
+class Db_mongo_bucket(Db_mongo):
+    def __init__(self, module):
+        Db_mongo.__init__(self, module)
+        self.db_schema_version = 2
+        # collection storing the buckets of all the timeseries
+        self.series_collection = "series"
+        # collection storing single values
+        self.values_collection = "values"
+        # collection storing the members of all the geospatial indexes
+        self.geo_collection = "geo"
+        # number of buckets to retrieve at once when iterating over a timeseries
+        self.chunk = 10
+
+    # connect to the database
+    def connect(self):
+        Db_mongo.connect(self)
+        if not self.connected: return
+        # buckets are looked up by key and start, single values by key
+        self.db[self.series_collection].create_index([("key", pymongo.ASCENDING), ("start", pymongo.ASCENDING)], unique=True)
+        self.db[self.values_collection].create_index([("key", pymongo.ASCENDING)], unique=True)
+        # members of the geospatial indexes are looked up by key and location
+        self.db[self.geo_collection].create_index([("key", pymongo.ASCENDING), ("member", pymongo.ASCENDING)], unique=True)
+        self.db[self.geo_collection].create_index([("key", pymongo.ASCENDING), ("location", pymongo.GEOSPHERE)])
+
+    # load the catalog of the existing keys from the database
+    def load_catalog(self):
+        if self.query_debug: self.module.log_debug("distinct() key")
+        self.collections = set(self.db[self.series_collection].distinct("key") + self.db[self.values_collection].distinct("key") + self.db[self.geo_collection].distinct("key"))
+        self.catalog_loaded = time.time()
+
+    # return the time span covered by a bucket of the given key, larger for aggregated data which is less dense
+    def bucket_span(self, key):
+        if "/year/" in key: return 3653*86400
+        if "/month/" in key or "/week/" in key: return 366*86400
+        if "/day/" in key: return 30*86400
+        if "/hour/" in key: return 86400
+        return 3600
+
+    # return the start of the bucket the given timestamp of the key belongs to
+    def bucket_start(self, key, timestamp):
+        return timestamp - timestamp % self.bucket_span(key)
+
+    # normalize the given timeframe, returning start, end and if the timeframe is bounded
+    def timeframe(self, start, end):
+        if start is None: start = self.module.date.now()-24*3600
+        if end is None: end = self.module.date.now()
+        bounded = start not in ["-inf", "+inf"] and end not in ["-inf", "+inf"]
+        if start == "-inf": start = 0
+        if start == "+inf": start = sys.maxint
+        if end == "-inf": end = 0
+        if end == "+inf": end = sys.maxint
+        return start, end, bounded
+
+    # return the filter selecting the buckets of a key which may contain measures between start and end
+    def buckets_filter(self, key, start, end):
+        return {"key": key, "start": {"$gt": start-self.bucket_span(key), "$lte": end}}
+
+    # show the available keys applying the given filter
+    def keys(self, key):
+        filter = {"key": {"$regex": re.escape(key).replace('\\*', '.*')}}
+        if self.query_debug: self.module.log_debug("distinct() "+str(filter))
+        db = self.reader()
+        return sorted(set(db[self.series_collection].distinct("key", filter) + db[self.values_collection].distinct("key", filter)))
+
+    # buckets are created when the first measure is added
+    def create_collection(self, key):
+        pass
+
+    # save a timeseries value to the db
+    def set_series(self, key, value, timestamp, log=True):
+        if timestamp is None:
+            if log: self.module.log_warning("no timestamp provided for key "+key)
+            return
+        # add the measure to its bucket (creating it if needed), keeping the measures sorted
+        filter = {"key": key, "start": self.bucket_start(key, timestamp)}
+        update = {"$push": {"samples": {"$each": [{"timestamp": timestamp, "value": str(value)}], "$sort": {"timestamp": pymongo.ASCENDING}}}}
+        if self.query_debug: self.module.log_debug(key+" update_one() "+str(filter)+" "+str(update))
+        self.replicas.wrote(key)
+        self.db[self.series_collection].update_one(filter, update, upsert=True)
+        self.collections.add(key)
+
+    # save a timeseries value applying count/new_only retention policies and skipping duplicates. Return saved, replaced, old or duplicate
+    def save(self, key, value, timestamp, retain=None):
+        if timestamp is None:
+            self.module.log_warning("no timestamp provided for key "+key)
+            return None
+        # if we have to keep up to "count" values, delete old values from the db
+        if retain is not None and "count" in retain:
+            self.delete_by_position(key, 0, -retain["count"])
+        # if only measures with a newer timestamp than the latest can be added, apply the policy
+        if retain is not None and "new_only" in retain and retain["new_only"]:
+            latest = self.get_latest(key, self.db)
+            if latest is not None and timestamp <= latest[0]: return "old"
+        # check if there is already something stored with the same timestamp, retrieving only that measure from the bucket
+        status = "saved"
+        filter = {"key": key, "start": self.bucket_start(key, timestamp)}
+        if self.query_debug: self.module.log_debug(key+" find_one() "+str(filter)+" "+str(timestamp))
+        old = self.db[self.series_collection].find_one({"key": key, "start": filter["start"], "samples.timestamp": timestamp}, {"samples.$": 1})
+        if old is not None:
+            if old["samples"][0]["value"] == str(value): return "duplicate"
+            # same timestamp but different value, remove the old value so to store the new one
+            self.db[self.series_collection].update_one(filter, {"$pull": {"samples": {"timestamp": timestamp}}})
+            status = "replaced"
+        self.set_series(key, value, timestamp)
+        return status
+
+    # save multiple timeseries values (list of key, value, timestamp, retain) with a single bulk write. Return the status of each save
+    def save_batch(self, records):
+        statuses = [None]*len(records)
+        # group the records by key
+        keys = {}
+        for i, record in enumerate(records):
+            if record[0] not in keys: keys[record[0]] = []
+            keys[record[0]].append(i)
+        operations = []
+        counts = {}
+        for key, indexes in keys.iteritems():
+            # retrieve with a single query the buckets the batch is going to write into and the latest timestamp
+            starts = list(set([self.bucket_start(key, records[i][2]) for i in indexes]))
+            stored = {}
+            for bucket in self.db[self.series_collection].find({"key": key, "start": {"$in": starts}}):
+                for sample in bucket["samples"]: stored[sample["timestamp"]] = sample["value"]
+            latest = self.get_latest(key, self.db)
+            last_timestamp = latest[0] if latest is not None else None
+            # apply the same policies of save() to each record, in order, collecting the measures to remove and to add to each bucket
+            pulls = {}
+            pushes = {}
+            for i in indexes:
+                key, value, timestamp, retain = records[i]
+                if retain is not None and "count" in retain: counts[key] = retain["count"]
+                if retain is not None and "new_only" in retain and retain["new_only"] and last_timestamp is not None and timestamp <= last_timestamp:
+                    statuses[i] = "old"
+                    continue
+                statuses[i] = "saved"
+                start = self.bucket_start(key, timestamp)
+                if start not in pushes:
+                    pulls[start] = []
+                    pushes[start] = {}
+                if timestamp in stored:
+                    if stored[timestamp] == str(value):
+                        statuses[i] = "duplicate"
+                        continue
+                    pulls[start].append(timestamp)
+                    statuses[i] = "replaced"
+                pushes[start][timestamp] = {"timestamp": timestamp, "value": str(value)}
+                stored[timestamp] = str(value)
+                if last_timestamp is None or timestamp > last_timestamp: last_timestamp = timestamp
+            for start in pushes:
+                filter = {"key": key, "start": start}
+                if len(pulls[start]) > 0: operations.append(pymongo.UpdateOne(filter, {"$pull": {"samples": {"timestamp": {"$in": pulls[start]}}}}))
+                if len(pushes[start]) == 0: continue
+                self.replicas.wrote(key)
+                operations.append(pymongo.UpdateOne(filter, {"$push": {"samples": {"$each": pushes[start].values(), "$sort": {"timestamp": pymongo.ASCENDING}}}}, upsert=True))
+                self.collections.add(key)
+        if self.query_debug: self.module.log_debug("bulk_write() "+str(len(operations))+" operations")
+        if len(operations) > 0: self.db[self.series_collection].bulk_write(operations, ordered=True)
+        # if we have to keep up to "count" values, delete old values from the db
+        for key, count in counts.iteritems():
+            self.delete_by_position(key, 0, -(count+1))
+        return statuses
+
+    # set a single value into the db
+    def set_value(self, key, value):
+        if self.query_debug: self.module.log_debug(key+" replace_one() "+str(value))
+        self.db[self.values_collection].replace_one({"key": key}, {"key": key, "value": str(value)}, upsert=True)
+        self.collections.add(key)
+
+    # get a single value from the db
+    def get_value(self, key):
+        if self.query_debug: self.module.log_debug("find_one() "+key)
+        result = self.db[self.values_collection].find_one({"key": key})
+        if result is None: return None
+        return result["value"]
+
+    # iterate over the measures of a key between two timestamps (any if None) in chronological or reverse order, reading the buckets in batches through a cursor
+    def iterate(self, key, start=None, end=None, descending=False):
+        filter = {"key": key}
+        if start is not None and end is not None: filter = self.buckets_filter(key, start, end)
+        order = pymongo.DESCENDING if descending else pymongo.ASCENDING
+        if self.query_debug: self.module.log_debug("find() "+str(filter)+" "+("DESC" if descending else "ASC"))
+        for bucket in self.reader(key)[self.series_collection].find(filter).sort("start", order).batch_size(self.chunk):
+            samples = reversed(bucket["samples"]) if descending else bucket["samples"]
+            for sample in samples:
+                if start is not None and sample["timestamp"] < start: continue
+                if end is not None and sample["timestamp"] > end: continue
+                yield sample
+
+    # iterate over the raw entries between two timestamps
+    def iterate_by_timeframe(self, key, start, end, chunk=1000):
+        return self.iterate(key, start, end)
+
+    # get a range of values from the db based on the timestamp
+    def get_by_timeframe(self, key, start=None, end=None, withscores=True, milliseconds=False, format_date=False, formatter=None, max_items=None, max_points=None, downsample="avg"):
+        start, end, bounded = self.timeframe(start, end)
+        # if requested, stream the range out of the db and downsample it
+        if max_points is not None:
+            points = self.normalize_entries(self.iterate(key, start, end), True, False, False, formatter)
+            if bounded: data = db_downsample.downsample(points, max_points, downsample, start=start, end=end)
+            else: data = db_downsample.downsample(points, max_points, downsample, total=self.aggregate(key, "count", start, end))
+            data = db_downsample.format_points(data, withscores, milliseconds, format_date, self.module.date)
+        else:
+            data = self.normalize_dataset(self.iterate(key, start, end), withscores, milliseconds, format_date, formatter)
+        if max_items is not None and len(data) > max_items: data = data[-max_items:]
+        return data
+
+    # get up to count [timestamp, value] entries between two timestamps, reading only the requested page from the db
+    def get_page(self, key, start, end, count, formatter=None):
+        # buckets are read from the cursor only until the page is full
+        return self.normalize_dataset(itertools.islice(self.iterate(key, start, end), count), True, False, False, formatter)
+
+    # run multiple plain queries (list of key, start, end, by_position, formatter) reading the buckets of all of them with a single find. Return the [timestamp, value] entries of each
+    def get_many(self, queries):
+        # turn the positions into timestamps first, None if the range is empty
+        ranges = []
+        for key, start, end, by_position, formatter in queries:
+            if by_position: ranges.append(self.resolve_positions(key, start, end, self.reader(key)))
+            else: ranges.append(self.timeframe(start, end)[0:2])
+        filters = [self.buckets_filter(queries[i][0], ranges[i][0], ranges[i][1]) for i in range(len(queries)) if ranges[i] is not None]
+        samples = [[] for request in queries]
+        if len(filters) > 0:
+            if self.query_debug: self.module.log_debug("find() "+str(len(filters))+" keys ASC")
+            for bucket in self.reader([request[0] for request in queries])[self.series_collection].find({"$or": filters}).sort("start", pymongo.ASCENDING).batch_size(self.chunk):
+                for i, request in enumerate(queries):
+                    if ranges[i] is None or request[0] != bucket["key"]: continue
+                    samples[i].extend([sample for sample in bucket["samples"] if sample["timestamp"] >= ranges[i][0] and sample["timestamp"] <= ranges[i][1]])
+        return [self.normalize_dataset(samples[i], True, False, False, queries[i][4]) for i in range(len(queries))]
+
+    # get a range of values from the db
+    def get_by_position(self, key, start=-1, end=-1, withscores=True, milliseconds=False, format_date=False, formatter=None, max_items=None, max_points=None, downsample="avg"):
+        # resolve the positions into timestamps and query the range
+        bounds = self.resolve_positions(key, start, end, self.reader(key))
+        if bounds is None: return []
+        return self.get_by_timeframe(key, bounds[0], bounds[1], withscores, milliseconds, format_date, formatter, max_items, max_points, downsample)
+
+    # return the timestamp of the measure at the given position (negative positions count from the end) reading from the given database handle (the primary by default), None if out of range
+    def resolve_position(self, key, position, db=None):
+        if db is None: db = self.db
+        skip = position if position >= 0 else abs(position)-1
+        # walk through the size of the buckets to find the one containing the position
+        order = pymongo.ASCENDING if position >= 0 else pymongo.DESCENDING
+        pipeline = [
+            {"$match": {"key": key}},
+            {"$sort": {"start": order}},
+            {"$project": {"size": {"$size": "$samples"}}},
+        ]
+        if self.query_debug: self.module.log_debug("aggregate() "+key+" "+str(pipeline))
+        for bucket in db[self.series_collection].aggregate(pipeline):
+            if skip < bucket["size"]:
+                # retrieve only the measure at the requested position
+                index = skip if position >= 0 else -(skip+1)
+                result = db[self.series_collection].find_one({"_id": bucket["_id"]}, {"samples": {"$slice": [index, 1]}})
+                if result is None or len(result["samples"]) == 0: return None
+                return result["samples"][0]["timestamp"]
+            skip = skip - bucket["size"]
+        return None
+
+    # calculate within the database an aggregation (count, avg, min, max, sum) of the values between two timestamps or positions
+    def aggregate(self, key, aggregation, start=None, end=None, by_position=False):
+        db = self.reader(key)
+        if by_position:
+            bounds = self.resolve_positions(key, start, end, db)
+            if bounds is None: return 0 if aggregation == "count" else None
+            start, end = bounds
+        else:
+            start, end, bounded = self.timeframe(start, end)
+        pipeline = [
+            {"$match": self.buckets_filter(key, start, end)},
+            {"$unwind": "$samples"},
+            {"$match": {"samples.timestamp": {"$gte": start, "$lte": end}}},
+        ]
+        if aggregation == "count":
+            pipeline.append({"$count": "value"})
+        else:
+            # values are stored as strings, convert them into numbers ignoring those which are not
+            pipeline.append({"$project": {"value": {"$convert": {"input": "$samples.value", "to": "double", "onError": None, "onNull": None}}}})
+            pipeline.append({"$match": {"value": {"$ne": None}}})
+            pipeline.append({"$group": {"_id": None, "value": {"$"+aggregation: "$value"}}})
+        if self.query_debug: self.module.log_debug("aggregate() "+key+" "+str(pipeline))
+        result = list(db[self.series_collection].aggregate(pipeline))
+        if len(result) == 0: return 0 if aggregation == "count" else None
+        return result[0]["value"]
+
+    # get the latest value of a key as (timestamp, raw entry), None if the key is empty
+    def get_latest(self, key, db=None):
+        if db is None: db = self.reader(key)
+        if self.query_debug: self.module.log_debug("find_one() "+key+" DESC")
+        bucket = db[self.series_collection].find_one({"key": key}, {"samples": {"$slice": -1}}, sort=[("start", pymongo.DESCENDING)])
+        if bucket is None or len(bucket["samples"]) == 0: return None
+        sample = bucket["samples"][0]
+        return (sample["timestamp"], sample)
+
+    # add or update the members (list of member, longitude, latitude) of a geospatial index
+    def geo_add(self, key, locations):
+        operations = [pymongo.ReplaceOne({"key": key, "member": member}, {"key": key, "member": member, "location": {"type": "Point", "coordinates": [longitude, latitude]}}, upsert=True) for member, longitude, latitude in locations]
+        if self.query_debug: self.module.log_debug(key+" bulk_write() "+str(len(operations))+" operations")
+        self.replicas.wrote(key)
+        self.db[self.geo_collection].bulk_write(operations, ordered=False)
+        self.collections.add(key)
+
+    # return [member, distance in km] of the members of a geospatial index within the given radius in km (anywhere if None) from a point, nearest first.
+    # Optionally return up to count members and only the members matching the given query
+    def geo_radius(self, key, longitude, latitude, radius=None, count=None, query=None):
+        near = {"near": {"type": "Point", "coordinates": [longitude, latitude]}, "distanceField": "distance", "spherical": True, "query": dict(query if query is not None else {}, key=key)}
+        if radius is not None: near["maxDistance"] = radius*1000
+        pipeline = [{"$geoNear": near}]
+        if count is not None: pipeline.append({"$limit": count})
+        pipeline.append({"$project": {"_id": 0, "member": 1, "distance": 1}})
+        if self.query_debug: self.module.log_debug("aggregate() "+str(pipeline))
+        return [[document["member"], document["distance"]/1000] for document in self.reader(key)[self.geo_collection].aggregate(pipeline)]
+
+    # delete from a geospatial index the (numeric) members lower than the given one. Return the number of members deleted
+    def geo_trim(self, key, before):
+        if self.query_debug: self.module.log_debug("delete_many() "+key+" member < "+str(before))
+        return self.db[self.geo_collection].delete_many({"key": key, "member": {"$lt": before}}).deleted_count
+
+    # delete the given members from a geospatial index
+    def geo_remove(self, key, members):
+        if self.query_debug: self.module.log_debug("delete_many() "+key+" "+str(members))
+        return self.db[self.geo_collection].delete_many({"key": key, "member": {"$in": members}}).deleted_count
+
+    # delete a key
+    def delete(self, key):
+        if self.query_debug: self.module.log_debug("delete_many() "+key)
+        self.db[self.series_collection].delete_many({"key": key})
+        self.db[self.values_collection].delete_many({"key": key})
+        self.db[self.geo_collection].delete_many({"key": key})
+        self.collections.discard(key)
+
+    # rename a key
+    def rename(self, key, new_key):
+        if self.query_debug: self.module.log_debug("update_many() "+key+" "+new_key)
+        self.db[self.series_collection].update_many({"key": key}, {"$set": {"key": new_key}})
+        self.db[self.values_collection].update_many({"key": key}, {"$set": {"key": new_key}})
+        self.db[self.geo_collection].update_many({"key": key}, {"$set": {"key": new_key}})
+        self.collections.discard(key)
+        self.collections.add(new_key)
+
+    # delete all elements between a given score
+    def delete_by_timeframe(self, key, start, end):
+        start, end, bounded = self.timeframe(start, end)
+        deleted = self.aggregate(key, "count", start, end)
+        if deleted == 0: return 0
+        if self.query_debug: self.module.log_debug("delete_many() "+key+" "+str(start)+" "+str(end))
+        # buckets entirely within the timeframe are deleted, the others are trimmed
+        self.db[self.series_collection].delete_many({"key": key, "start": {"$gte": start, "$lte": end-self.bucket_span(key)+1}})
+        self.db[self.series_collection].update_many(self.buckets_filter(key, start, end), {"$pull": {"samples": {"timestamp": {"$gte": start, "$lte": end}}}})
+        self.db[self.series_collection].delete_many({"key": key, "samples": {"$size": 0}})
+        return deleted
+
+    # delete all elements between a given rank
+    def delete_by_position(self, key, start, end):
+        bounds = self.resolve_positions(key, start, end)
+        if bounds is None: return 0
+        return self.delete_by_timeframe(key, bounds[0], bounds[1])
+
+    # empty the database
+    def flushdb(self):
+        if self.query_debug: self.module.log_debug("flushdb")
+        self.db[self.series_collection].drop()
+        self.db[self.values_collection].drop()
+        self.db[self.geo_collection].drop()
+        self.collections = set()
+
+    # generate the statistics of a page of keys, estimating their size from the average size of a bucket
+    def stats_page(self, cursor=0, count=500, prefix=None):
+        cursor, keys = self.catalog_page(cursor, count, prefix)
+        if len(keys) == 0: return cursor, []
+        # aggregate the buckets of all the keys of the page at once
+        pipeline = [
+            {"$match": {"key": {"$in": keys}}},
+            {"$project": {"key": 1, "size": {"$size": "$samples"}, "first": {"$min": "$samples.timestamp"}, "last": {"$max": "$samples.timestamp"}}},
+            {"$group": {"_id": "$key", "count": {"$sum": "$size"}, "buckets": {"$sum": 1}, "first": {"$min": "$first"}, "last": {"$max": "$last"}}},
+            {"$sort": {"_id": pymongo.ASCENDING}},
+        ]
+        if self.query_debug: self.module.log_debug("aggregate() "+str(pipeline))
+        collection_stats = self.db.command("collstats", self.series_collection)
+        bucket_size = collection_stats["avgObjSize"] if "avgObjSize" in collection_stats else 0
+        output = []
+        for key in self.reader()[self.series_collection].aggregate(pipeline):
+            if key["count"] == 0: continue
+            latest = self.get_latest(key["_id"])
+            value = latest[1]["value"] if latest is not None else ""
+            output.append([key["_id"], key["count"], bucket_size*key["buckets"], key["first"], key["last"], sdk.python.utils.strings.truncate(value, 300)])
+        return cursor, output
+
+    # initialize an empty database
+    def init_database(self):
+        version = self.get_value(self.module.version_key)
+        # no version found, check if the database is using the layout with a collection for each key
+        if version is None and len(self.db.list_collection_names(filter={"name": self.module.version_key})) > 0:
+            version = Db_mongo.get_value(self, self.module.version_key)
+        # no version found, assuming first installation
+        if version is None:
+            self.module.log_info("Setting database schema to v"+str(self.db_schema_version))
+            self.set_value(self.module.version_key, self.db_schema_version)
+        else:
+            version = int(version)
+            # already at the latest version
+            if version == self.db_schema_version:
+                pass
+            # database schema needs to be upgraded
+            elif version < self.db_schema_version:
+                self.upgrade_database(version)
+            # higher version, something strange is happening
+            elif version > self.db_schema_version:
+                self.module.log_error("database schema v"+str(version)+" is higher than the supported schema v"+str(self.db_schema_version))
+
+    # upgrade the database schema from the given version
+    def upgrade_database(self, version):
+        # v1 -> v2: move the content of each collection into buckets
+        if version < 2:
+            self.module.log_info("Upgrading database schema from v"+str(version)+" to v2, moving the measures of each collection into buckets")
+            for collection in self.db.list_collection_names():
+                if collection in [self.series_collection, self.values_collection, self.geo_collection, self.module.version_key] or collection.startswith("system."): continue
+                try:
+                    if self.db[collection].find_one({"timestamp": {"$exists": True}}, {"_id": 1}) is not None:
+                        self.migrate_collection(collection)
+                    elif self.db[collection].find_one({"location": {"$exists": True}}, {"_id": 1}) is not None:
+                        self.migrate_geo_collection(collection)
+                    else:
+                        document = self.db[collection].find_one()
+                        if document is not None and "value" in document: self.set_value(collection, document["value"])
+                    self.db[collection].drop()
+                except Exception,e:
+                    self.module.log_error("Unable to migrate "+collection+" - "+exception.get(e))
+                    return
+            # leave the new version in the old layout as well so the database will not be used by mistake with it
+            Db_mongo.set_value(self, self.module.version_key, 2)
+        self.load_catalog()
+        self.set_value(self.module.version_key, self.db_schema_version)
+        self.module.log_info("Database schema upgraded to v"+str(self.db_schema_version))
+
+    # move the members of a geospatial index collection into the geospatial index with the same name
+    def migrate_geo_collection(self, key):
+        locations = []
+        count = 0
+        for document in self.db[key].find({"location": {"$exists": True}}).batch_size(1000):
+            locations.append((document["member"], document["location"]["coordinates"][0], document["location"]["coordinates"][1]))
+            count = count + 1
+            if len(locations) < 1000: continue
+            self.geo_add(key, locations)
+            locations = []
+        if len(locations) > 0: self.geo_add(key, locations)
+        self.module.log_debug("migrated "+str(count)+" members of "+key)
+
+    # move the documents of a collection into the buckets of the key with the same name
+    def migrate_collection(self, key):
+        operations = []
+        start = None
+        samples = []
+        count = 0
+        for document in self.db[key].find({"timestamp": {"$exists": True}}).sort("timestamp", pymongo.ASCENDING).batch_size(1000):
+            bucket_start = self.bucket_start(key, document["timestamp"])
+            if bucket_start != start and len(samples) > 0:
+                operations.append(pymongo.UpdateOne({"key": key, "start": start}, {"$push": {"samples": {"$each": samples, "$sort": {"timestamp": pymongo.ASCENDING}}}}, upsert=True))
+                samples = []
+            start = bucket_start
+            samples.append({"timestamp": document["timestamp"], "value": str(document["value"])})
+            count = count + 1
+            if len(operations) >= 100:
+                self.db[self.series_collection].bulk_write(operations, ordered=True)
+                operations = []
+        if len(samples) > 0: operations.append(pymongo.UpdateOne({"key": key, "start": start}, {"$push": {"samples": {"$each": samples, "$sort": {"timestamp": pymongo.ASCENDING}}}}, upsert=True))
+        if len(operations) > 0: self.db[self.series_collection].bulk_write(operations, ordered=True)
+        self.module.log_debug("migrated "+str(count)+" measures of "+key)
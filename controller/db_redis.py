@@ -1,19 +1,99 @@
 # controller/db: database driver for Redis
 
 import redis
+import struct
 
 import sdk.python.utils.exceptions as exception
 import sdk.python.utils.numbers
 import sdk.python.utils.strings
 
+import db_downsample
+import db_geo
+from db_replicas import Db_replicas
+
+# numeric values are stored as packed members (marker, timestamp, value multiplied by the scale of the marker), anything else as a "timestamp:value" string
+PACKED = struct.Struct(">BIi")
+# marker of the packed members with the scale of their value
+SCALES = {1: 1, 2: 10, 3: 100}
+# marker a value already normalized by the given formatter is packed with
+FORMATTERS = {"int": 1, "float_1": 2, "float_2": 3}
+
+# lua script applying retention, new_only and deduplication policies before adding a new value in a single round trip
+# KEYS[1]: key, ARGV[1]: timestamp, ARGV[2]: member to add, ARGV[3]: number of values to retain (0 to disable), ARGV[4]: new_only (1 or 0)
+SAVE_SCRIPT = """
+local count = tonumber(ARGV[3])
+if count > 0 then
+    redis.call('ZREMRANGEBYRANK', KEYS[1], 0, -count)
+end
+if ARGV[4] == '1' then
+    local last = redis.call('ZRANGE', KEYS[1], -1, -1, 'WITHSCORES')
+    if #last > 0 and tonumber(ARGV[1]) <= tonumber(last[2]) then
+        return 'old'
+    end
+end
+local status = 'saved'
+local old = redis.call('ZRANGEBYSCORE', KEYS[1], ARGV[1], ARGV[1])
+if #old > 0 then
+    if old[1] == ARGV[2] then
+        return 'duplicate'
+    end
+    redis.call('ZREMRANGEBYSCORE', KEYS[1], ARGV[1], ARGV[1])
+    status = 'replaced'
+end
+redis.call('ZADD', KEYS[1], ARGV[1], ARGV[2])
+return status
+"""
+
+# lua script calculating an aggregation (count, avg, min, max, sum) of the numeric values within a range of scores or ranks
+# KEYS[1]: key, ARGV[1]: score or rank, ARGV[2]: start, ARGV[3]: end, ARGV[4]: aggregation
+AGGREGATE_SCRIPT = """
+local entries
+if ARGV[1] == 'score' then
+    entries = redis.call('ZRANGEBYSCORE', KEYS[1], ARGV[2], ARGV[3])
+else
+    entries = redis.call('ZRANGE', KEYS[1], ARGV[2], ARGV[3])
+end
+local count = 0
+local sum = 0
+local min = nil
+local max = nil
+local scales = {1, 10, 100}
+for i, entry in ipairs(entries) do
+    local value
+    local marker = string.byte(entry, 1)
+    if marker ~= nil and marker <= 3 and #entry == 9 then
+        local _, timestamp, number = struct.unpack('>BI4i4', entry)
+        value = number / scales[marker]
+    else
+        value = tonumber(string.match(entry, ':(.*)$'))
+    end
+    if value ~= nil then
+        count = count + 1
+        sum = sum + value
+        if min == nil or value < min then min = value end
+        if max == nil or value > max then max = value end
+    end
+end
+if count == 0 then return false end
+if ARGV[4] == 'avg' then return tostring(sum/count) end
+if ARGV[4] == 'min' then return tostring(min) end
+if ARGV[4] == 'max' then return tostring(max) end
+return tostring(sum)
+"""
+
 class Db_redis():
     def __init__(self, module):
         self.db = None
         self.connected = False
-        self.db_schema_version = 1
+        self.db_schema_version = 2
         self.query_debug = False
         self.module = module
         self.db_version = None
+        # registered lua scripts
+        self.save_script = None
+        self.aggregate_script = None
+        # read replicas
+        self.replicas = None
         
      # connect to the database
     def connect(self):
@@ -30,20 +110,46 @@ class Db_redis():
                 if self.db.ping():
                     self.db_version = self.db.info().get('redis_version')
                     self.module.log_info("Connected to database #"+str(database)+" at "+hostname+":"+str(port)+", redis version "+self.db_version)
+                    self.save_script = self.db.register_script(SAVE_SCRIPT)
+                    self.aggregate_script = self.db.register_script(AGGREGATE_SCRIPT)
+                    self.connect_replicas(port, database, password)
                     self.connected = True
             except Exception,e:
                 self.module.log_error("Unable to connect to "+hostname+":"+str(port)+" - "+exception.get(e))
                 self.module.sleep(5)
                 if self.module.stopping: break       
 
+    # prepare the clients of the configured read replicas (hostname:port)
+    def connect_replicas(self, port, database, password):
+        read_your_writes = "read_your_writes" in self.module.config and self.module.config["read_your_writes"]
+        # a replica is healthy if in sync with its master
+        self.replicas = Db_replicas(self.module, self.db, read_your_writes, lambda client: client.info("replication").get("master_link_status", "up") == "up")
+        if "replicas" not in self.module.config: return
+        for replica in self.module.config["replicas"]:
+            replica_hostname, replica_port = replica.split(":", 1) if ":" in replica else (replica, port)
+            self.module.log_debug("Reading from database replica "+replica_hostname+":"+str(replica_port))
+            self.replicas.add(replica, redis.StrictRedis(host=replica_hostname, port=int(replica_port), db=int(database), password=password))
+
+    # run a read query (a function taking the client to use) on a replica if any, falling back to the primary if the replica is not reachable
+    def read(self, key, query):
+        client = self.replicas.reader(key)
+        if client is self.db: return query(client)
+        try:
+            return query(client)
+        except (redis.exceptions.ConnectionError, redis.exceptions.TimeoutError), e:
+            self.replicas.failed(client, e)
+            return query(self.db)
+
     # disconnect from the database
     def disconnect(self):
-        if self.connected: self.db.connection_pool.disconnect()
+        if self.connected: 
+            self.db.connection_pool.disconnect()
+            for replica in self.replicas.replicas: replica["client"].connection_pool.disconnect()
         
     # show the available keys applying the given filter
     def keys(self, key):
         if self.query_debug: self.module.log_debug("keys "+key)
-        return self.db.keys(key)
+        return self.read(None, lambda client: client.keys(key))
 
     # save a timeseries value to the db
     def set_series(self, key, value, timestamp, log=True):
@@ -51,9 +157,32 @@ class Db_redis():
             if log: self.module.log_warning("no timestamp provided for key "+key)
             return 
         # zadd with the score
-        value = str(timestamp)+":"+str(value)
         if self.query_debug and log: self.module.log_debug("zadd "+key+" "+str(timestamp)+" "+str(value))
-        return self.db.zadd(key, timestamp, value)
+        self.replicas.wrote(key)
+        return self.db.zadd(key, timestamp, self.encode(value, timestamp))
+
+    # save a timeseries value applying count/new_only retention policies and skipping duplicates in a single round trip. Return saved, replaced, old or duplicate
+    def save(self, key, value, timestamp, retain=None):
+        if timestamp is None: 
+            self.module.log_warning("no timestamp provided for key "+key)
+            return None
+        count = retain["count"] if retain is not None and "count" in retain else 0
+        new_only = 1 if retain is not None and "new_only" in retain and retain["new_only"] else 0
+        if self.query_debug: self.module.log_debug("evalsha save "+key+" "+str(timestamp)+" "+str(value)+" "+str(count)+" "+str(new_only))
+        # duplicates are checked by the script on the primary, so always against the latest data
+        self.replicas.wrote(key)
+        return self.save_script(keys=[key], args=[timestamp, self.encode(value, timestamp), count, new_only])
+
+    # save multiple timeseries values (list of key, value, timestamp, retain) in a single pipelined round trip. Return the status of each save
+    def save_batch(self, records):
+        if self.query_debug: self.module.log_debug("evalsha save "+str(len(records))+" values")
+        pipeline = self.db.pipeline(transaction=False)
+        for key, value, timestamp, retain in records:
+            count = retain["count"] if retain is not None and "count" in retain else 0
+            new_only = 1 if retain is not None and "new_only" in retain and retain["new_only"] else 0
+            self.replicas.wrote(key)
+            self.save_script(keys=[key], args=[timestamp, self.encode(value, timestamp), count, new_only], client=pipeline)
+        return pipeline.execute()
 
     # set a single value into the db
     def set_value(self, key, value):
@@ -66,21 +195,170 @@ class Db_redis():
         return self.db.get(key)
 
     # get a range of values from the db based on the timestamp
-    def get_by_timeframe(self, key, start=None, end=None, withscores=True, milliseconds=False, format_date=False, formatter=None, max_items=None):
+    def get_by_timeframe(self, key, start=None, end=None, withscores=True, milliseconds=False, format_date=False, formatter=None, max_items=None, max_points=None, downsample="avg"):
         if start is None: start = self.module.date.now()-24*3600
         if end is None: end = self.module.date.now()
-        if self.query_debug: self.module.log_debug("zrangebyscore "+key+" "+str(start)+" "+str(end))
-        data = self.normalize_dataset(self.db.zrangebyscore(key, start, end, withscores=True), withscores, milliseconds, format_date, formatter)
+        # if requested, stream the range out of the db and downsample it
+        if max_points is not None:
+            client = self.replicas.reader(key)
+            points = self.normalize_entries(self.iterate_by_timeframe(key, start, end, client=client), True, False, False, formatter)
+            if sdk.python.utils.numbers.is_number(start) and sdk.python.utils.numbers.is_number(end): 
+                data = db_downsample.downsample(points, max_points, downsample, start=start, end=end)
+            else: 
+                data = db_downsample.downsample(points, max_points, downsample, total=client.zcount(key, start, end))
+            data = db_downsample.format_points(data, withscores, milliseconds, format_date, self.module.date)
+        else:
+            if self.query_debug: self.module.log_debug("zrangebyscore "+key+" "+str(start)+" "+str(end))
+            data = self.normalize_dataset(self.read(key, lambda client: client.zrangebyscore(key, start, end, withscores=True)), withscores, milliseconds, format_date, formatter)
         if max_items is not None and len(data) > max_items: data = data[-max_items:]
         return data
         
+    # get up to count [timestamp, value] entries between two timestamps, reading only the requested page from the db
+    def get_page(self, key, start, end, count, formatter=None):
+        if self.query_debug: self.module.log_debug("zrangebyscore "+key+" "+str(start)+" "+str(end)+" limit 0 "+str(count))
+        return self.normalize_dataset(self.read(key, lambda client: client.zrangebyscore(key, start, end, start=0, num=count, withscores=True)), True, False, False, formatter)
+
+    # run multiple plain queries (list of key, start, end, by_position, formatter) in a single pipelined round trip. Return the [timestamp, value] entries of each
+    def get_many(self, queries):
+        if self.query_debug: self.module.log_debug("zrange/zrangebyscore "+str(len(queries))+" keys")
+        def query(client):
+            pipeline = client.pipeline(transaction=False)
+            for key, start, end, by_position, formatter in queries:
+                if by_position: pipeline.zrange(key, start, end, withscores=True)
+                else: pipeline.zrangebyscore(key, start, end, withscores=True)
+            return pipeline.execute()
+        results = self.read([request[0] for request in queries], query)
+        return [self.normalize_dataset(results[i], True, False, False, queries[i][4]) for i in range(len(queries))]
+
     # get a range of values from the db
-    def get_by_position(self, key,start=-1, end=-1, withscores=True, milliseconds=False, format_date=False, formatter=None, max_items=None):
-        if self.query_debug: self.module.log_debug("zrange "+key+" "+str(start)+" "+str(end))
-        data = self.normalize_dataset(self.db.zrange(key, start, end, withscores=True), withscores, milliseconds, format_date, formatter)
+    def get_by_position(self, key,start=-1, end=-1, withscores=True, milliseconds=False, format_date=False, formatter=None, max_items=None, max_points=None, downsample="avg"):
+        # if requested, stream the range out of the db and downsample it
+        if max_points is not None:
+            client = self.replicas.reader(key)
+            # turn the positions into absolute ranks
+            total = client.zcard(key)
+            if start < 0: start = max(total+start, 0)
+            if end < 0 or end >= total: end = total-1 if end >= total else total+end
+            points = self.normalize_entries(self.iterate_by_position(key, start, end, client=client), True, False, False, formatter)
+            data = db_downsample.downsample(points, max_points, downsample, total=end-start+1)
+            data = db_downsample.format_points(data, withscores, milliseconds, format_date, self.module.date)
+        else:
+            if self.query_debug: self.module.log_debug("zrange "+key+" "+str(start)+" "+str(end))
+            data = self.normalize_dataset(self.read(key, lambda client: client.zrange(key, start, end, withscores=True)), withscores, milliseconds, format_date, formatter)
         if max_items is not None and len(data) > max_items: data = data[-max_items:]
         return data
 
+    # iterate over the raw entries between two absolute ranks, reading them from the db in chunks
+    def iterate_by_position(self, key, start, end, chunk=1000, client=None):
+        if client is None: client = self.db
+        position = start
+        while position <= end:
+            if self.query_debug: self.module.log_debug("zrange "+key+" "+str(position)+" "+str(min(position+chunk-1, end)))
+            data = client.zrange(key, position, min(position+chunk-1, end), withscores=True)
+            if len(data) == 0: break
+            for entry in data: 
+                yield entry
+            position = position+len(data)
+
+    # iterate over the raw entries between two scores, reading them from the db in chunks
+    def iterate_by_timeframe(self, key, start, end, chunk=1000, client=None):
+        if client is None: client = self.db
+        # the rank of the first entry is the number of entries with a lower score
+        first = client.zcount(key, "-inf", "("+str(start)) if start != "-inf" else 0
+        total = client.zcount(key, start, end)
+        return self.iterate_by_position(key, first, first+total-1, chunk, client)
+
+    # calculate within the database an aggregation (count, avg, min, max, sum) of the values between two timestamps or positions
+    def aggregate(self, key, aggregation, start=None, end=None, by_position=False):
+        if not by_position:
+            if start is None: start = self.module.date.now()-24*3600
+            if end is None: end = self.module.date.now()
+        if aggregation == "count":
+            if not by_position:
+                if self.query_debug: self.module.log_debug("zcount "+key+" "+str(start)+" "+str(end))
+                return self.read(key, lambda client: client.zcount(key, start, end))
+            # the number of values between two positions comes from the size of the key
+            if self.query_debug: self.module.log_debug("zcard "+key)
+            total = self.read(key, lambda client: client.zcard(key))
+            if start < 0: start = max(total+start, 0)
+            if end < 0: end = total+end
+            return max(min(end, total-1)-start+1, 0)
+        if self.query_debug: self.module.log_debug("evalsha aggregate "+key+" "+aggregation+" "+str(start)+" "+str(end))
+        value = self.read(key, lambda client: self.aggregate_script(keys=[key], args=["rank" if by_position else "score", start, end, aggregation], client=client))
+        if value is None: return None
+        return float(value)
+
+    # get the latest value of a key as (timestamp, raw entry), None if the key is empty
+    def get_latest(self, key):
+        if self.query_debug: self.module.log_debug("zrange "+key+" -1 -1")
+        data = self.read(key, lambda client: client.zrange(key, -1, -1, withscores=True))
+        if len(data) == 0: return None
+        return (int(data[0][1]), data[0])
+
+    # build a raw entry (as returned by the database) out of a value, to be normalized with normalize_dataset()
+    def make_entry(self, value, timestamp):
+        return (self.encode(value, timestamp), timestamp)
+
+    # encode a value into a member of the timeseries, packing the numbers which can be stored as an integer of up to two decimals
+    def encode(self, value, timestamp):
+        if isinstance(value, (int, long, float)) and not isinstance(value, bool) and isinstance(timestamp, (int, long)) and 0 <= timestamp < 2**32:
+            for marker in [1, 2, 3]:
+                number = int(round(value*SCALES[marker])) if value == value and abs(value) < 2**31 else None
+                if number is None or number < -2**31 or number >= 2**31: break
+                if float(number)/SCALES[marker] == value: return PACKED.pack(marker, timestamp, number)
+        return str(timestamp)+":"+str(value)
+
+    # decode a member of the timeseries into (marker, value), with a None marker for values stored as a string
+    def decode(self, member):
+        if len(member) == PACKED.size and member[0] <= "\x03":
+            marker, timestamp, number = PACKED.unpack(member)
+            if marker == 1: return marker, number
+            return marker, float(number)/SCALES[marker]
+        return None, member.split(":",1)[1]
+
+    # add or update the members (list of member, longitude, latitude) of a geospatial index
+    def geo_add(self, key, locations):
+        if self.query_debug: self.module.log_debug("geoadd "+key+" "+str(len(locations))+" members")
+        values = []
+        for member, longitude, latitude in locations: values.extend([longitude, latitude, member])
+        self.replicas.wrote(key)
+        return self.db.geoadd(key, *values)
+
+    # return [member, distance in km] of the members of a geospatial index within the given radius in km (anywhere if None) from a point, nearest first, optionally up to count members
+    def geo_radius(self, key, longitude, latitude, radius=None, count=None):
+        if self.query_debug: self.module.log_debug("georadius "+key+" "+str(longitude)+" "+str(latitude)+" "+str(radius)+" km")
+        return self.read(key, lambda client: client.georadius(key, longitude, latitude, radius if radius is not None else db_geo.ANYWHERE, unit="km", withdist=True, count=count, sort="ASC"))
+
+    # return [timestamp, distance in km] from a point of the members of a geospatial index (timestamps) saved into the given timeseries between start and end
+    def geo_distances(self, key, series_key, longitude, latitude, start, end):
+        # the members of the index are sorted by location, the timestamps within the range come from the timeseries
+        if self.query_debug: self.module.log_debug("zrangebyscore "+series_key+" "+str(start)+" "+str(end))
+        timestamps = [int(timestamp) for member, timestamp in self.read(series_key, lambda client: client.zrangebyscore(series_key, start, end, withscores=True))]
+        if len(timestamps) == 0: return []
+        # distances are between two members, so the point is added as a temporary member within the same transaction
+        if self.query_debug: self.module.log_debug("geodist "+key+" "+str(len(timestamps))+" members")
+        pipeline = self.db.pipeline(transaction=True)
+        pipeline.geoadd(key, longitude, latitude, "reference")
+        for timestamp in timestamps: pipeline.geodist(key, timestamp, "reference", unit="km")
+        pipeline.zrem(key, "reference")
+        distances = pipeline.execute()[1:-1]
+        return [[timestamp, distances[i]] for i, timestamp in enumerate(timestamps) if distances[i] is not None]
+
+    # delete from a geospatial index the (numeric) members lower than the given one. Return the number of members deleted
+    def geo_trim(self, key, before):
+        if self.query_debug: self.module.log_debug("zscan "+key)
+        # members are sorted by location, so they have to be all checked
+        members = [member for member, score in self.db.zscan_iter(key, count=1000) if float(member) < before]
+        for i in range(0, len(members), 1000):
+            if self.query_debug: self.module.log_debug("zrem "+key+" "+str(len(members[i:i+1000]))+" members")
+            self.db.zrem(key, *members[i:i+1000])
+        return len(members)
+
+    # delete the given members from a geospatial index
+    def geo_remove(self, key, members):
+        if self.query_debug: self.module.log_debug("zrem "+key+" "+str(members))
+        return self.db.zrem(key, *members)
+
     # delete a key
     def delete(self, key):
         if self.query_debug: self.module.log_debug("del "+key)
@@ -96,6 +374,13 @@ class Db_redis():
         if self.query_debug: self.module.log_debug("zremrangebyscore "+key+" "+str(start)+" "+str(end))
         return self.db.zremrangebyscore(key, start, end)
 
+    # delete the elements between the given scores of multiple keys (list of key, start, end) in a single round trip. Return the number of elements deleted from each key
+    def delete_by_timeframe_batch(self, ranges):
+        if self.query_debug: self.module.log_debug("zremrangebyscore "+str(len(ranges))+" keys")
+        pipeline = self.db.pipeline(transaction=False)
+        for key, start, end in ranges: pipeline.zremrangebyscore(key, start, end)
+        return pipeline.execute()
+
     # delete all elements between a given rank
     def delete_by_position(self, key,start,end):
         if self.query_debug: self.module.log_debug("zremrangebyrank "+key+" "+str(start)+" "+str(end))
@@ -111,26 +396,47 @@ class Db_redis():
         if self.query_debug: self.module.log_debug("flushdb")
         return self.db.flushdb()
         
-    # generate database statistics (key, #items, latest timestamp, earliest timestamp, latest value)
-    def stats(self):
+    # generate statistics of the whole database (size, type, version)
+    def database_stats(self):
         output = {}
-        output["keys"] = []
-        keys = self.keys("*")
-        for key in sorted(keys):
-            if self.db.type(key) != "zset": continue
-            data = self.get_by_position(key, 1, 1)
-            start = data[0][0] if len(data) > 0 else ""
-            data = self.get_by_position(key, -1, -1)
-            end = data[0][0] if len(data) > 0 else ""
-            value = data[0][1] if len(data) > 0 else ""
-            key_size = self.db.execute_command("MEMORY USAGE", key)
-            output["keys"].append([key, self.db.zcard(key), key_size, start, end, sdk.python.utils.strings.truncate(value, 300)])
         db_stats = self.db.info()
         output["database_size"] = db_stats["used_memory_rss"]
         output["database_type"] = self.module.config["type"]
         output["database_version"] = self.db_version
         return output   
 
+    # generate the statistics of a page of keys (key, #items, size, earliest timestamp, latest timestamp, latest value) starting from the given cursor (0 to start).
+    # Return the cursor of the next page (0 when done) and the statistics
+    def stats_page(self, cursor=0, count=500, prefix=None):
+        return self.read(None, lambda client: self.scan_stats(client, cursor, count, prefix))
+
+    # generate the statistics of a page of keys reading from the given client
+    def scan_stats(self, client, cursor, count, prefix):
+        if self.query_debug: self.module.log_debug("scan "+str(cursor)+" "+str(prefix))
+        cursor, keys = client.scan(cursor, match=(prefix if prefix is not None else "")+"*", count=count)
+        # probe the type of all the keys of the page in a single round trip. Geospatial indexes are sorted sets as well but not timeseries
+        pipeline = client.pipeline(transaction=False)
+        for key in keys: pipeline.type(key)
+        keys = [key for key, type in zip(keys, pipeline.execute()) if type == "zset" and not key.startswith(self.module.geo_key+"/")]
+        # then retrieve the statistics of all the timeseries in a single round trip
+        pipeline = client.pipeline(transaction=False)
+        for key in keys: 
+            pipeline.zrange(key, 0, 0, withscores=True)
+            pipeline.zrange(key, -1, -1, withscores=True)
+            pipeline.zcard(key)
+            pipeline.execute_command("MEMORY USAGE", key)
+        results = pipeline.execute()
+        output = []
+        for i, key in enumerate(keys):
+            first, last, items, key_size = results[i*4:i*4+4]
+            first = self.normalize_dataset(first, True, False, False, None)
+            last = self.normalize_dataset(last, True, False, False, None)
+            start = first[0][0] if len(first) > 0 else ""
+            end = last[0][0] if len(last) > 0 else ""
+            value = last[0][1] if len(last) > 0 else ""
+            output.append([key, items, key_size, start, end, sdk.python.utils.strings.truncate(value, 300)])
+        return int(cursor), output
+
     # initialize an empty database
     def init_database(self):
         version = None
@@ -146,30 +452,77 @@ class Db_redis():
                 pass
             # database schema needs to be upgraded
             elif version < self.db_schema_version: 
-                pass
+                self.upgrade_database(version)
             # higher version, something strange is happening
             elif version > self.db_schema_version: 
                 self.module.log_error("database schema v"+str(version)+" is higher than the supported schema v"+str(self.db_schema_version))
         
+    # upgrade the database schema from the given version
+    def upgrade_database(self, version):
+        # v2: numeric values are stored as packed members
+        if version < 2:
+            self.module.log_info("Upgrading database schema from v"+str(version)+" to v2, packing numeric values")
+            cursor = None
+            keys = 0
+            while cursor != 0:
+                cursor, page = self.db.scan(cursor or 0, count=500)
+                for key in page:
+                    if self.db.type(key) != "zset": continue
+                    self.pack_key(key)
+                    keys = keys + 1
+            self.module.log_info("Packed the numeric values of "+str(keys)+" keys")
+        self.set_value(self.module.version_key, self.db_schema_version)
+
+    # replace the "timestamp:value" members of a timeseries holding a number with their packed version
+    def pack_key(self, key, chunk=1000):
+        for position in range(0, self.db.zcard(key), chunk):
+            pipeline = self.db.pipeline(transaction=True)
+            for member, timestamp in self.db.zrange(key, position, position+chunk-1, withscores=True):
+                marker, value = self.decode(member)
+                if marker is not None: continue
+                number = self.parse_number(value)
+                if number is None: continue
+                packed = self.encode(number, int(timestamp))
+                if packed == member: continue
+                pipeline.zrem(key, member)
+                pipeline.zadd(key, timestamp, packed)
+            pipeline.execute()
+
+    # parse a string into a number, None if not a number or if it would not be formatted back the same way (e.g. "007")
+    def parse_number(self, value):
+        for cast in [int, float]:
+            try:
+                number = cast(value)
+            except ValueError:
+                continue
+            if str(number) == value or repr(number) == value: return number
+        return None
+
     # normalize the output
     def normalize_dataset(self, data, withscores, milliseconds, format_date, formatter):
-        output = []
+        return list(self.normalize_entries(data, withscores, milliseconds, format_date, formatter))
+
+    # normalize the output one entry at a time
+    def normalize_entries(self, data, withscores, milliseconds, format_date, formatter):
         for entry in data:
             # get the timestamp 
             timestamp = int(entry[1])
             if format_date: timestamp = self.module.date.timestamp2date(timestamp)
             elif milliseconds: timestamp = timestamp*1000
-            # normalize the value (entry is timetime:value)
-            value_string = entry[0].split(":",1)[1];
-            if formatter is None:
+            # normalize the value (entry is either packed or timestamp:value)
+            marker, value = self.decode(entry[0])
+            if marker is not None:
+                # packed values are numbers already, normalized when packed with the marker of the formatter
+                if formatter is None: value = float(value)
+                elif FORMATTERS.get(formatter) != marker: value = sdk.python.utils.numbers.normalize(value, formatter)
+            elif formatter is None:
                 # no formatter provided, guess the type
-                value = float(value_string) if sdk.python.utils.numbers.is_number(value_string) else str(value_string)
+                value = float(value) if sdk.python.utils.numbers.is_number(value) else str(value)
             else:
                 # formatter provided, normalize the value
-                value = sdk.python.utils.numbers.normalize(value_string, formatter)
+                value = sdk.python.utils.numbers.normalize(value, formatter)
             # normalize "None" in null
             if value == "None": value = None
             # prepare the output
-            if (withscores): output.append([timestamp,value])
-            else: output.append(value)
-        return output
\ No newline at end of file
+            if (withscores): yield [timestamp,value]
+            else: yield value
\ No newline at end of file
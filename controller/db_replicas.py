@@ -0,0 +1,82 @@
+# controller/db: routing of the read queries across the database replicas
+
+import time
+import threading
+import contextlib
+
+import sdk.python.utils.exceptions as exception
+
+class Db_replicas():
+    def __init__(self, module, primary, read_your_writes=False, check=None):
+        self.module = module
+        # client of the primary database, used for writes and as a fallback for reads
+        self.primary = primary
+        # list of replicas, each with its name, client, health status and time of the last health check
+        self.replicas = []
+        # function returning True if the given replica client is healthy
+        self.check = check
+        # seconds to wait before checking again an unhealthy replica
+        self.check_interval = 30
+        # if set, keys written within the last lag seconds are read from the primary
+        self.read_your_writes = read_your_writes
+        self.lag = 5
+        # map a key with the time it has been last written
+        self.written = {}
+        # index of the next replica to use
+        self.next = 0
+        self.lock = threading.Lock()
+        # number of nested blocks of the current thread reading from the primary only
+        self.pinned = threading.local()
+
+    # add a replica
+    def add(self, name, client):
+        self.replicas.append({"name": name, "client": client, "healthy": True, "checked": time.time()})
+
+    # keep track a key has been written
+    def wrote(self, key):
+        if self.read_your_writes: self.written[key] = time.time()
+
+    # read from the primary only within the block, for data about to be modified which the replicas may not have received yet
+    @contextlib.contextmanager
+    def primary_only(self):
+        self.pinned.depth = getattr(self.pinned, "depth", 0)+1
+        try:
+            yield
+        finally:
+            self.pinned.depth = self.pinned.depth-1
+
+    # return the client to use for reading the given key (or list of keys), picking the next healthy replica (round-robin) or the primary if none is available
+    def reader(self, key=None):
+        if len(self.replicas) == 0 or getattr(self.pinned, "depth", 0) > 0: return self.primary
+        # if the key (or any of the given keys) has been just written, the replicas may not have it yet
+        for key in (key if isinstance(key, list) else [key]):
+            if key is None or key not in self.written: continue
+            if time.time() - self.written.get(key, 0) < self.lag: return self.primary
+            self.written.pop(key, None)
+        for i in range(len(self.replicas)):
+            with self.lock:
+                replica = self.replicas[self.next % len(self.replicas)]
+                self.next = self.next + 1
+            if replica["healthy"]: return replica["client"]
+            # check periodically if an unhealthy replica is back
+            if time.time() - replica["checked"] > self.check_interval and self.is_healthy(replica):
+                self.module.log_info("database replica "+replica["name"]+" is back online")
+                return replica["client"]
+        return self.primary
+
+    # check the health of a replica
+    def is_healthy(self, replica):
+        replica["checked"] = time.time()
+        try:
+            replica["healthy"] = self.check(replica["client"]) if self.check is not None else True
+        except Exception,e:
+            replica["healthy"] = False
+        return replica["healthy"]
+
+    # mark the replica of the given client as not healthy so it will not be used until the next successful health check
+    def failed(self, client, e):
+        for replica in self.replicas:
+            if replica["client"] is not client: continue
+            replica["healthy"] = False
+            replica["checked"] = time.time()
+            self.module.log_warning("database replica "+replica["name"]+" is not reachable, reading from the primary - "+exception.get(e))
@@ -0,0 +1,121 @@
+# controller/db: incremental calculation of the aggregated statistics
+
+import sdk.python.utils.numbers
+
+class Db_rollup():
+    def __init__(self, module):
+        self.module = module
+        # map sensor_id with the running accumulator of the latest hour seen
+        self.hours = {}
+        # map sensor_id with group_by and the aggregated statistics of each sub-period of the latest period seen
+        self.periods = {}
+
+    # return an empty accumulator for the hour starting at the given timestamp
+    def new_accumulator(self, start):
+        return {
+            "start": start,
+            "last": None,
+            "first_value": None,
+            "last_value": None,
+            "count": 0,
+            "numbers": 0,
+            "sum": 0.0,
+            "min": None,
+            "max": None,
+            "sx": 0.0,
+            "sxx": 0.0,
+            "sxy": 0.0,
+            "unique": set(),
+        }
+
+    # add a value to the given accumulator
+    def accumulate(self, accumulator, timestamp, value):
+        if value is None: return
+        if sdk.python.utils.numbers.is_number(value): value = float(value)
+        accumulator["last"] = timestamp
+        if accumulator["first_value"] is None: accumulator["first_value"] = value
+        accumulator["last_value"] = value
+        accumulator["count"] = accumulator["count"] + 1
+        accumulator["unique"].add(value)
+        if not isinstance(value, float): return
+        # keep track of the terms needed for min, max, sum, avg and the linear regression of the rate
+        x = float(timestamp - accumulator["start"])
+        accumulator["numbers"] = accumulator["numbers"] + 1
+        accumulator["sum"] = accumulator["sum"] + value
+        if accumulator["min"] is None or value < accumulator["min"]: accumulator["min"] = value
+        if accumulator["max"] is None or value > accumulator["max"]: accumulator["max"] = value
+        accumulator["sx"] = accumulator["sx"] + x
+        accumulator["sxx"] = accumulator["sxx"] + x*x
+        accumulator["sxy"] = accumulator["sxy"] + x*value
+
+    # return the statistics of the given hour accumulator
+    def hour_stats(self, accumulator):
+        n = accumulator["numbers"]
+        rate = None
+        # the rate of change is the slope of the least squares regression line
+        denominator = n*accumulator["sxx"] - accumulator["sx"]*accumulator["sx"]
+        if n > 1 and denominator != 0: rate = (n*accumulator["sxy"] - accumulator["sx"]*accumulator["sum"])/denominator
+        return {
+            "avg": accumulator["sum"]/n if n > 0 else None,
+            "min": accumulator["min"],
+            "max": accumulator["max"],
+            "rate": rate,
+            "sum": accumulator["sum"] if n > 0 else None,
+            "count": accumulator["count"],
+            "count_unique": len(accumulator["unique"]),
+        }
+
+    # return the statistics of a period from the statistics of its sub-periods
+    def period_stats(self, entries):
+        timestamps = sorted(entries.keys())
+        values = [entries[timestamp]["avg"] for timestamp in timestamps]
+        return {
+            "avg": sdk.python.utils.numbers.avg(values),
+            "min": sdk.python.utils.numbers.min(values),
+            "max": sdk.python.utils.numbers.max(values),
+            "rate": sdk.python.utils.numbers.velocity(timestamps, values),
+            "sum": sdk.python.utils.numbers.sum([entries[timestamp]["sum"] for timestamp in timestamps]),
+            "count": sdk.python.utils.numbers.count([entries[timestamp]["count"] for timestamp in timestamps]),
+            "count_unique": sdk.python.utils.numbers.count_unique([entries[timestamp]["count_unique"] for timestamp in timestamps]),
+        }
+
+    # rebuild the accumulator of the hour starting at start from the given [timestamp, value] data and return its statistics
+    def reset_hour(self, sensor_id, start, data):
+        accumulator = self.new_accumulator(start)
+        for timestamp, value in data:
+            self.accumulate(accumulator, timestamp, value)
+        # keep the accumulator only if not older than the one we are already tracking
+        if sensor_id not in self.hours or start >= self.hours[sensor_id]["start"]:
+            self.hours[sensor_id] = accumulator
+        return self.hour_stats(accumulator)
+
+    # add a new value to the running hour. Return the updated statistics or None if they have to be recalculated from the database
+    def add_value(self, sensor_id, start, timestamp, value):
+        if sensor_id not in self.hours: return None
+        accumulator = self.hours[sensor_id]
+        # a different hour or an out-of-order value cannot be accumulated
+        if accumulator["start"] != start: return None
+        if accumulator["last"] is not None and timestamp < accumulator["last"]: return None
+        self.accumulate(accumulator, timestamp, value)
+        return self.hour_stats(accumulator)
+
+    # rebuild the period starting at start from the statistics of its sub-periods (map sub-period start with its statistics) and return its statistics
+    def reset_period(self, sensor_id, group_by, start, entries):
+        if sensor_id not in self.periods: self.periods[sensor_id] = {}
+        periods = self.periods[sensor_id]
+        if group_by not in periods or start >= periods[group_by]["start"]:
+            periods[group_by] = {"start": start, "entries": entries}
+        return self.period_stats(entries)
+
+    # update the statistics of a sub-period of the running period. Return the updated statistics or None if they have to be recalculated from the database
+    def add_entry(self, sensor_id, group_by, start, entry_start, entry):
+        if sensor_id not in self.periods or group_by not in self.periods[sensor_id]: return None
+        period = self.periods[sensor_id][group_by]
+        if period["start"] != start: return None
+        period["entries"][entry_start] = entry
+        return self.period_stats(period["entries"])
+
+    # forget everything about the given sensor
+    def forget(self, sensor_id):
+        if sensor_id in self.hours: del self.hours[sensor_id]
+        if sensor_id in self.periods: del self.periods[sensor_id]
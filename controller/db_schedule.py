@@ -0,0 +1,77 @@
+# controller/db: index of the events of the calendar sensors, parsed once for each value saved
+
+import json
+import time
+import bisect
+import datetime
+import threading
+
+class Schedule():
+    def __init__(self, events, to_timestamp):
+        # start timestamp, end timestamp and text of each event in the order of the calendar
+        intervals = []
+        for event in events:
+            start = to_timestamp(datetime.datetime.strptime(event["start_date"],"%Y-%m-%dT%H:%M:%S.000Z"))
+            end = to_timestamp(datetime.datetime.strptime(event["end_date"],"%Y-%m-%dT%H:%M:%S.000Z"))
+            intervals.append((start, end, event["text"]))
+        # split the time at the start and end of each event, keeping the text of the event running exactly at each point and in between two points
+        self.points = sorted(set([interval[0] for interval in intervals] + [interval[1] for interval in intervals]))
+        self.at = [None]*len(self.points)
+        self.inside = [None]*len(self.points)
+        # events are running strictly between their start and end, the latest in the calendar takes precedence if overlapping
+        for start, end, text in intervals:
+            first = bisect.bisect_left(self.points, start)
+            last = bisect.bisect_left(self.points, end)
+            for i in range(first, last):
+                self.inside[i] = text
+                if i > first: self.at[i] = text
+        # events sorted by start, to find the next one
+        upcoming = sorted([(start, i) for i, (start, end, text) in enumerate(intervals)])
+        self.starts = [start for start, i in upcoming]
+        self.texts = [intervals[i][2] for start, i in upcoming]
+
+    # return the text of the event running at the given timestamp, None if there is none
+    def active(self, timestamp):
+        i = bisect.bisect_right(self.points, timestamp)-1
+        if i < 0: return None
+        if self.points[i] == timestamp: return self.at[i]
+        return self.inside[i]
+
+    # return the text of the first event starting after the given timestamp, None if there is none
+    def upcoming(self, timestamp):
+        i = bisect.bisect_right(self.starts, timestamp)
+        if i == len(self.starts): return None
+        return self.texts[i]
+
+class Db_schedule():
+    def __init__(self, module):
+        self.module = module
+        # map a key with the calendar value indexed and its schedule
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    # convert the date of an event into a timestamp
+    def to_timestamp(self, date):
+        return self.module.date.timezone(self.module.date.timezone(int(time.mktime(date.timetuple()))))
+
+    # return the schedule of the given calendar value of a key, parsing it only if changed since the last time. None if the calendar has no events
+    def get(self, key, value):
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is not None and entry[0] == value: return entry[1]
+        # the calendar string holds a list whose events are at position 1
+        calendar = json.loads(value)
+        schedule = Schedule(json.loads(calendar[1]), self.to_timestamp) if len(calendar) == 2 else None
+        with self.lock:
+            self.entries[key] = (value, schedule)
+        return schedule
+
+    # forget the schedule of the given key after its data has changed
+    def forget(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    # forget all the schedules (e.g. when the timezone changes)
+    def clear(self):
+        with self.lock:
+            self.entries = {}
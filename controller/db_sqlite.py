@@ -0,0 +1,399 @@
+# controller/db: database driver for SQLite
+
+import sqlite3
+import threading
+import time
+import sys
+import os
+
+import sdk.python.utils.exceptions as exception
+import sdk.python.utils.numbers
+import sdk.python.utils.strings
+
+import db_downsample
+import db_geo
+
+# return the value as a number or None if not numeric, so to be ignored by the aggregate functions
+def to_number(value):
+    if value is None or not sdk.python.utils.numbers.is_number(value): return None
+    return float(value)
+
+class Db_sqlite():
+    def __init__(self, module):
+        self.db = None
+        self.connected = False
+        self.db_schema_version = 1
+        self.query_debug = False
+        self.module = module
+        self.db_version = None
+        self.filename = None
+        # writes are committed in batches, every commit_count writes or commit_interval seconds
+        self.commit_count = 1000
+        self.commit_interval = 1
+        self.pending = 0
+        self.committed = time.time()
+        # the connection is shared across threads
+        self.lock = threading.RLock()
+
+    # connect to the database
+    def connect(self):
+        self.filename = str(self.module.database if self.module.database is not None else self.module.config["database"])
+        while not self.connected:
+            try:
+                self.module.log_debug("Opening database "+self.filename)
+                self.db = sqlite3.connect(self.filename, check_same_thread=False)
+                # return strings as they have been stored, like the other drivers
+                self.db.text_factory = str
+                self.db.create_function("to_number", 1, to_number)
+                self.db.create_function("distance", 4, db_geo.distance)
+                # write-ahead log lets readers proceed while writing
+                self.db.execute("PRAGMA journal_mode=WAL")
+                self.db.execute("PRAGMA synchronous=NORMAL")
+                # timeseries are clustered by key and timestamp, like a sorted set
+                self.db.execute("CREATE TABLE IF NOT EXISTS series (key TEXT NOT NULL, timestamp INTEGER NOT NULL, value TEXT, PRIMARY KEY (key, timestamp)) WITHOUT ROWID")
+                self.db.execute("CREATE TABLE IF NOT EXISTS keyvalues (key TEXT NOT NULL PRIMARY KEY, value TEXT)")
+                # members of the geospatial indexes, either timestamps or names
+                self.db.execute("CREATE TABLE IF NOT EXISTS geo (key TEXT NOT NULL, member NOT NULL, longitude REAL NOT NULL, latitude REAL NOT NULL, PRIMARY KEY (key, member)) WITHOUT ROWID")
+                self.db.commit()
+                self.db_version = sqlite3.sqlite_version
+                self.module.log_info("Opened database "+self.filename+", sqlite version "+self.db_version)
+                self.connected = True
+            except Exception,e:
+                self.module.log_error("Unable to open "+self.filename+" - "+exception.get(e))
+                self.module.sleep(5)
+                if self.module.stopping: break
+
+    # disconnect from the database
+    def disconnect(self):
+        if not self.connected: return
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+            self.connected = False
+
+    # run a query, returning all the rows
+    def query(self, sql, args=()):
+        if self.query_debug: self.module.log_debug(sql+" "+str(args))
+        with self.lock:
+            return self.db.execute(sql, args).fetchall()
+
+    # run a statement changing the database, returning the number of rows affected. Changes are committed in batches
+    def write(self, sql, args=()):
+        if self.query_debug: self.module.log_debug(sql+" "+str(args))
+        with self.lock:
+            count = self.db.execute(sql, args).rowcount
+            self.written()
+            return count
+
+    # keep track of the pending writes, committing them when enough are waiting or enough time has passed
+    def written(self, count=1):
+        with self.lock:
+            self.pending = self.pending + count
+            if self.pending < self.commit_count and time.time() - self.committed < self.commit_interval: return
+            self.commit()
+
+    # commit the pending writes if the commit interval has passed, so the last writes are not left uncommitted when no more writes follow
+    def commit_pending(self):
+        with self.lock:
+            if not self.connected or self.pending == 0 or time.time() - self.committed < self.commit_interval: return
+            self.commit()
+
+    # commit the pending writes
+    def commit(self):
+        with self.lock:
+            self.db.commit()
+            self.pending = 0
+            self.committed = time.time()
+
+    # turn a score boundary into a timestamp
+    def bound(self, value):
+        if value == "-inf": return -sys.maxint-1
+        if value == "+inf": return sys.maxint
+        return value
+
+    # translate a range of positions (negative positions count from the end) into (offset, limit), None if the range is empty
+    def absolute(self, key, start, end):
+        total = self.query("SELECT COUNT(*) FROM series WHERE key = ?", (key,))[0][0]
+        if start < 0: start = max(total+start, 0)
+        if end < 0: end = total+end
+        end = min(end, total-1)
+        if start > end: return None
+        return start, end-start+1
+
+    # show the available keys applying the given filter
+    def keys(self, key):
+        rows = self.query("SELECT DISTINCT key FROM series WHERE key GLOB ? UNION SELECT key FROM keyvalues WHERE key GLOB ?", (key, key))
+        return [row[0] for row in rows]
+
+    # save a timeseries value to the db
+    def set_series(self, key, value, timestamp, log=True):
+        if timestamp is None:
+            if log: self.module.log_warning("no timestamp provided for key "+key)
+            return
+        return self.write("INSERT OR REPLACE INTO series (key, timestamp, value) VALUES (?, ?, ?)", (key, timestamp, str(value)))
+
+    # save a timeseries value applying count/new_only retention policies and skipping duplicates. Return saved, replaced, old or duplicate
+    def save(self, key, value, timestamp, retain=None):
+        if timestamp is None:
+            self.module.log_warning("no timestamp provided for key "+key)
+            return None
+        with self.lock:
+            # if we have to keep up to "count" values, delete old values from the db
+            if retain is not None and "count" in retain:
+                self.delete_by_position(key, 0, -retain["count"])
+            # if only measures with a newer timestamp than the latest can be added, apply the policy
+            if retain is not None and "new_only" in retain and retain["new_only"]:
+                last = self.query("SELECT MAX(timestamp) FROM series WHERE key = ?", (key,))[0][0]
+                if last is not None and timestamp <= last: return "old"
+            # check if there is already something stored with the same timestamp
+            status = "saved"
+            old = self.query("SELECT value FROM series WHERE key = ? AND timestamp = ?", (key, timestamp))
+            if len(old) > 0:
+                if old[0][0] == str(value): return "duplicate"
+                # same timestamp but different value, the new one replaces the old one
+                status = "replaced"
+            self.set_series(key, value, timestamp)
+            return status
+
+    # save multiple timeseries values (list of key, value, timestamp, retain) within the same transaction. Return the status of each save
+    def save_batch(self, records):
+        with self.lock:
+            return [self.save(key, value, timestamp, retain) for key, value, timestamp, retain in records]
+
+    # set a single value into the db
+    def set_value(self, key, value):
+        self.write("INSERT OR REPLACE INTO keyvalues (key, value) VALUES (?, ?)", (key, str(value)))
+
+    # get a single value from the db
+    def get_value(self, key):
+        rows = self.query("SELECT value FROM keyvalues WHERE key = ?", (key,))
+        if len(rows) == 0: return None
+        return rows[0][0]
+
+    # get a range of values from the db based on the timestamp
+    def get_by_timeframe(self, key, start=None, end=None, withscores=True, milliseconds=False, format_date=False, formatter=None, max_items=None, max_points=None, downsample="avg"):
+        if start is None: start = self.module.date.now()-24*3600
+        if end is None: end = self.module.date.now()
+        bounded = start not in ["-inf", "+inf"] and end not in ["-inf", "+inf"]
+        start = self.bound(start)
+        end = self.bound(end)
+        # if requested, stream the range out of the db and downsample it
+        if max_points is not None:
+            points = self.normalize_entries(self.iterate_by_timeframe(key, start, end), True, False, False, formatter)
+            if bounded: data = db_downsample.downsample(points, max_points, downsample, start=start, end=end)
+            else: data = db_downsample.downsample(points, max_points, downsample, total=self.aggregate(key, "count", start, end))
+            data = db_downsample.format_points(data, withscores, milliseconds, format_date, self.module.date)
+        else:
+            rows = self.query("SELECT timestamp, value FROM series WHERE key = ? AND timestamp >= ? AND timestamp <= ? ORDER BY timestamp", (key, start, end))
+            data = self.normalize_dataset(rows, withscores, milliseconds, format_date, formatter)
+        if max_items is not None and len(data) > max_items: data = data[-max_items:]
+        return data
+
+    # get up to count [timestamp, value] entries between two timestamps, reading only the requested page from the db
+    def get_page(self, key, start, end, count, formatter=None):
+        rows = self.query("SELECT timestamp, value FROM series WHERE key = ? AND timestamp >= ? AND timestamp <= ? ORDER BY timestamp LIMIT ?", (key, self.bound(start), self.bound(end), count))
+        return self.normalize_dataset(rows, True, False, False, formatter)
+
+    # run multiple plain queries (list of key, start, end, by_position, formatter). Return the [timestamp, value] entries of each
+    def get_many(self, queries):
+        # the database is local, there is no round trip to save
+        return [self.get_by_position(key, start, end, withscores=True, formatter=formatter) if by_position else self.get_by_timeframe(key, start, end, withscores=True, formatter=formatter) for key, start, end, by_position, formatter in queries]
+
+    # get a range of values from the db
+    def get_by_position(self, key, start=-1, end=-1, withscores=True, milliseconds=False, format_date=False, formatter=None, max_items=None, max_points=None, downsample="avg"):
+        # if requested, stream the range out of the db between the timestamps of its first and last position and downsample it
+        if max_points is not None:
+            positions = self.absolute(key, start, end)
+            if positions is None: return []
+            first = self.query("SELECT timestamp FROM series WHERE key = ? ORDER BY timestamp LIMIT 1 OFFSET ?", (key, positions[0]))[0][0]
+            last = self.query("SELECT timestamp FROM series WHERE key = ? ORDER BY timestamp LIMIT 1 OFFSET ?", (key, positions[0]+positions[1]-1))[0][0]
+            points = self.normalize_entries(self.iterate_by_timeframe(key, first, last), True, False, False, formatter)
+            data = db_downsample.downsample(points, max_points, downsample, total=positions[1])
+            data = db_downsample.format_points(data, withscores, milliseconds, format_date, self.module.date)
+            if max_items is not None and len(data) > max_items: data = data[-max_items:]
+            return data
+        # if requested from the end, walk the index backwards
+        if start < 0 and end < 0:
+            rows = self.query("SELECT timestamp, value FROM series WHERE key = ? ORDER BY timestamp DESC LIMIT ? OFFSET ?", (key, max(abs(start)-abs(end)+1, 0), abs(end+1)))
+            rows.reverse()
+        else:
+            positions = self.absolute(key, start, end)
+            if positions is None: rows = []
+            else: rows = self.query("SELECT timestamp, value FROM series WHERE key = ? ORDER BY timestamp LIMIT ? OFFSET ?", (key, positions[1], positions[0]))
+        data = self.normalize_dataset(rows, withscores, milliseconds, format_date, formatter)
+        if max_items is not None and len(data) > max_items: data = data[-max_items:]
+        return data
+
+    # iterate over the raw entries between two timestamps, reading them from the db in chunks
+    def iterate_by_timeframe(self, key, start, end, chunk=1000):
+        position = self.bound(start)
+        end = self.bound(end)
+        while True:
+            rows = self.query("SELECT timestamp, value FROM series WHERE key = ? AND timestamp >= ? AND timestamp <= ? ORDER BY timestamp LIMIT ?", (key, position, end, chunk))
+            for row in rows:
+                yield row
+            if len(rows) < chunk: break
+            position = rows[-1][0]+1
+
+    # calculate within the database an aggregation (count, avg, min, max, sum) of the values between two timestamps or positions
+    def aggregate(self, key, aggregation, start=None, end=None, by_position=False):
+        function = "COUNT(*)" if aggregation == "count" else aggregation.upper()+"(to_number(value))"
+        if by_position:
+            positions = self.absolute(key, start, end)
+            if positions is None: return 0 if aggregation == "count" else None
+            rows = self.query("SELECT "+function+" FROM (SELECT value FROM series WHERE key = ? ORDER BY timestamp LIMIT ? OFFSET ?)", (key, positions[1], positions[0]))
+        else:
+            if start is None: start = self.module.date.now()-24*3600
+            if end is None: end = self.module.date.now()
+            rows = self.query("SELECT "+function+" FROM series WHERE key = ? AND timestamp >= ? AND timestamp <= ?", (key, self.bound(start), self.bound(end)))
+        return rows[0][0]
+
+    # get the latest value of a key as (timestamp, raw entry), None if the key is empty
+    def get_latest(self, key):
+        rows = self.query("SELECT timestamp, value FROM series WHERE key = ? ORDER BY timestamp DESC LIMIT 1", (key,))
+        if len(rows) == 0: return None
+        return (rows[0][0], rows[0])
+
+    # build a raw entry (as returned by the database) out of a value, to be normalized with normalize_dataset()
+    def make_entry(self, value, timestamp):
+        return (timestamp, str(value))
+
+    # add or update the members (list of member, longitude, latitude) of a geospatial index
+    def geo_add(self, key, locations):
+        with self.lock:
+            for member, longitude, latitude in locations:
+                self.write("INSERT OR REPLACE INTO geo (key, member, longitude, latitude) VALUES (?, ?, ?, ?)", (key, member, longitude, latitude))
+
+    # return [member, distance in km] of the members of a geospatial index within the given radius in km (anywhere if None) from a point, nearest first, optionally up to count members
+    def geo_radius(self, key, longitude, latitude, radius=None, count=None):
+        sql = "SELECT member, distance(longitude, latitude, ?, ?) AS distance FROM geo WHERE key = ?"
+        args = [longitude, latitude, key]
+        if radius is not None: 
+            sql = "SELECT * FROM ("+sql+") WHERE distance <= ?"
+            args.append(radius)
+        # a negative limit means no limit
+        rows = self.query(sql+" ORDER BY distance LIMIT ?", tuple(args+[count if count is not None else -1]))
+        return [list(row) for row in rows]
+
+    # return [timestamp, distance in km] from a point of the members of a geospatial index (timestamps) saved into the given timeseries between start and end
+    def geo_distances(self, key, series_key, longitude, latitude, start, end):
+        rows = self.query("SELECT member, distance(longitude, latitude, ?, ?) FROM geo WHERE key = ? AND member >= ? AND member <= ? ORDER BY member", (longitude, latitude, key, start, end))
+        return [list(row) for row in rows]
+
+    # delete from a geospatial index the (numeric) members lower than the given one. Return the number of members deleted
+    def geo_trim(self, key, before):
+        return self.write("DELETE FROM geo WHERE key = ? AND member < ?", (key, before))
+
+    # delete the given members from a geospatial index
+    def geo_remove(self, key, members):
+        with self.lock:
+            return sum([self.write("DELETE FROM geo WHERE key = ? AND member = ?", (key, member)) for member in members])
+
+    # delete a key
+    def delete(self, key):
+        with self.lock:
+            return self.write("DELETE FROM series WHERE key = ?", (key,)) + self.write("DELETE FROM keyvalues WHERE key = ?", (key,)) + self.write("DELETE FROM geo WHERE key = ?", (key,))
+
+    # rename a key, overwriting the destination if already existing
+    def rename(self, key, new_key):
+        with self.lock:
+            self.delete(new_key)
+            self.write("UPDATE series SET key = ? WHERE key = ?", (new_key, key))
+            self.write("UPDATE keyvalues SET key = ? WHERE key = ?", (new_key, key))
+            self.write("UPDATE geo SET key = ? WHERE key = ?", (new_key, key))
+
+    # delete all elements between a given score
+    def delete_by_timeframe(self, key, start, end):
+        return self.write("DELETE FROM series WHERE key = ? AND timestamp >= ? AND timestamp <= ?", (key, self.bound(start), self.bound(end)))
+
+    # delete the elements between the given scores of multiple keys (list of key, start, end) within the same transaction. Return the number of elements deleted from each key
+    def delete_by_timeframe_batch(self, ranges):
+        with self.lock:
+            return [self.delete_by_timeframe(key, start, end) for key, start, end in ranges]
+
+    # delete all elements between a given rank
+    def delete_by_position(self, key, start, end):
+        with self.lock:
+            positions = self.absolute(key, start, end)
+            if positions is None: return 0
+            return self.write("DELETE FROM series WHERE key = ? AND timestamp IN (SELECT timestamp FROM series WHERE key = ? ORDER BY timestamp LIMIT ? OFFSET ?)", (key, key, positions[1], positions[0]))
+
+    # check if a key exists
+    def exists(self, key):
+        if len(self.query("SELECT 1 FROM series WHERE key = ? LIMIT 1", (key,))) > 0: return True
+        if len(self.query("SELECT 1 FROM geo WHERE key = ? LIMIT 1", (key,))) > 0: return True
+        return len(self.query("SELECT 1 FROM keyvalues WHERE key = ?", (key,))) > 0
+
+    # empty the database
+    def flushdb(self):
+        with self.lock:
+            self.write("DELETE FROM series")
+            self.write("DELETE FROM keyvalues")
+            self.write("DELETE FROM geo")
+
+    # generate statistics of the whole database (size, type, version)
+    def database_stats(self):
+        output = {}
+        output["database_size"] = sum([os.path.getsize(filename) for filename in [self.filename, self.filename+"-wal"] if os.path.exists(filename)])
+        output["database_type"] = self.module.config["type"]
+        output["database_version"] = self.db_version
+        return output
+
+    # generate the statistics of a page of keys (key, #items, size, earliest timestamp, latest timestamp, latest value) starting from the given cursor (0 to start).
+    # Return the cursor of the next page (0 when done) and the statistics
+    def stats_page(self, cursor=0, count=500, prefix=None):
+        keys = self.query("SELECT DISTINCT key FROM series WHERE key GLOB ? ORDER BY key LIMIT ? OFFSET ?", ((prefix if prefix is not None else "")+"*", count, cursor))
+        output = []
+        for row in keys:
+            key = row[0]
+            # the size is estimated from the length of the values and of the timestamps
+            items, size, start, end = self.query("SELECT COUNT(*), SUM(LENGTH(value))+COUNT(*)*8, MIN(timestamp), MAX(timestamp) FROM series WHERE key = ?", (key,))[0]
+            latest = self.get_latest(key)
+            value = latest[1][1] if latest is not None else ""
+            output.append([key, items, size, start, end, sdk.python.utils.strings.truncate(value, 300)])
+        cursor = cursor+count if len(keys) == count else 0
+        return cursor, output
+
+    # initialize an empty database
+    def init_database(self):
+        version = self.get_value(self.module.version_key)
+        # no version found, assuming first installation
+        if version is None:
+            self.module.log_info("Setting database schema to v"+str(self.db_schema_version))
+            self.set_value(self.module.version_key, self.db_schema_version)
+        else:
+            version = int(version)
+            # already at the latest version
+            if version == self.db_schema_version:
+                pass
+            # database schema needs to be upgraded
+            elif version < self.db_schema_version:
+                pass
+            # higher version, something strange is happening
+            elif version > self.db_schema_version:
+                self.module.log_error("database schema v"+str(version)+" is higher than the supported schema v"+str(self.db_schema_version))
+
+    # normalize the output
+    def normalize_dataset(self, data, withscores, milliseconds, format_date, formatter):
+        return list(self.normalize_entries(data, withscores, milliseconds, format_date, formatter))
+
+    # normalize the output one entry at a time
+    def normalize_entries(self, data, withscores, milliseconds, format_date, formatter):
+        for entry in data:
+            # get the timestamp
+            timestamp = int(entry[0])
+            if format_date: timestamp = self.module.date.timestamp2date(timestamp)
+            elif milliseconds: timestamp = timestamp*1000
+            # normalize the value
+            value_string = str(entry[1])
+            if formatter is None:
+                # no formatter provided, guess the type
+                value = float(value_string) if sdk.python.utils.numbers.is_number(value_string) else str(value_string)
+            else:
+                # formatter provided, normalize the value
+                value = sdk.python.utils.numbers.normalize(value_string, formatter)
+            # normalize "None" in null
+            if value == "None": value = None
+            # prepare the output
+            if (withscores): yield [timestamp, value]
+            else: yield value
@@ -15,7 +15,7 @@
 # - service/* IN: invoke the service associated to the sensor
 # - service/* OUT: trigger an action to an actuator
 # - controller/db CALC_HOUR_STATS/CALC_DAY_STATS: periodically calculate aggregates
-# - controller/db PURGE_SENSOR: periodically purge old data
+# - controller/db PURGE_SENSORS: periodically purge old data
 # - controller/db SAVE: save new measures
 
 from sdk.python.module.controller import Controller
@@ -78,17 +78,22 @@ class Hub(Controller):
 
     # apply configured retention policies for all the sensors
     def retention_policies(self):
+        policies = {}
+        sensors = {}
         for sensor_id in self.sensors:
             sensor = self.sensors[sensor_id]["config"]
             # if we need to apply retention policies for this sensor
             if "retain" in sensor and sensor["retain"] in self.config["retain"]:
-                # ask the database module to purge the data
-                message = Message(self)
-                message.recipient = "controller/db"
-                message.command = "PURGE_SENSOR"
-                message.args = sensor_id
-                message.set_data(self.config["retain"][sensor["retain"]]["policies"])
-                self.send(message)
+                policies[sensor["retain"]] = self.config["retain"][sensor["retain"]]["policies"]
+                sensors[sensor_id] = sensor["retain"]
+        if len(sensors) == 0: return
+        # ask the database module to purge the data of all the sensors at once
+        message = Message(self)
+        message.recipient = "controller/db"
+        message.command = "PURGE_SENSORS"
+        message.set("policies", policies)
+        message.set("sensors", sensors)
+        self.send(message)
 
     # schedule a given sensor for execution
     def add_sensor(self, sensor_id, sensor):